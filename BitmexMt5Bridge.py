@@ -1,14 +1,45 @@
 # Bitmex MT5 bridge
+import asyncio
 import logging
 import threading
 from time import sleep
-from NamedPipe import NamedPipe
 from bitmex_rest import BitmexRestAPI
 from bitmex_websocket import BitMEXWebsocket
+from wire_protocol import MessageWriter
+from publisher import Publisher
+from metrics import Metrics, MeteredPipe, MetricsServer
 
 enablePipe = True
+# MT5 transport: 'namedpipe' (Windows), 'sharedmemory' (memory mapped ring buffers) or
+# 'hub' (Unix domain socket, any number of terminals with their own channel/symbol subscription)
+pipeTransport = 'namedpipe'
+# Send price data in the binary framing protocol instead of the text messages
+binaryProtocol = False
+# Write to the pipe from a sender thread that conflates quotes and depth if MT5 falls behind
+usePublisher = True
 TestServer = True
-websocketSymbol = 'XBTUSD'
+# 1m bars of history pushed to MT5 on start and the directory they are cached in
+historyBars = 750
+historyCacheDir = 'history'
+# Keep all candles in the memory mapped columnar store (needs numpy) instead of the plain cache
+useCandleStore = False
+# Seconds between full order table snapshots sent to MT5 for resync, 0 sends only changes
+orderSnapshotInterval = 60
+# Symbols carried over the one websocket connection
+websocketSymbols = ['XBTUSD']
+# Run the websocket ingest and the REST forwarding on one asyncio event loop
+asyncMode = False
+# Number of L2 order book levels sent to MT5 as depth messages, 0 disables the order book
+depthLevels = 10
+# Bars built from the trade feed and streamed while they form (seconds), [] disables them
+barIntervals = [1, 5, 15, 60]
+# Record latency histograms and counters, logged every statsInterval seconds
+enableMetrics = True
+statsInterval = 60
+# Serve the metrics as JSON on http://127.0.0.1:<metricsPort>/metrics, 0 disables the endpoint
+metricsPort = 8089
+# Record the raw websocket feed into this directory for replay (feed_recorder.py), None disables it
+recordFeedDir = None
 
 
 # Live Account
@@ -37,30 +68,120 @@ def run():
 
     # connect to named pipe
     logger.info("Wait for MT5 pipes....")
-    pipe_price = NamedPipe('Bitmex.Pipe.ServerPrice',enablePipe)
-    pipe_order = NamedPipe('Bitmex.Pipe.ServerOrder',enablePipe)
+    pipe_price = create_pipe('Bitmex.Pipe.ServerPrice')
+    pipe_order = create_pipe('Bitmex.Pipe.ServerOrder')
     pipe_price.Connect()
     pipe_order.Connect()
     logger.info("Price Pipe is :".format(pipe_price.GetStatus()) )
     logger.info("Order Pipe is :".format(pipe_order.GetStatus()) )
 
+    metrics = None
+    if(enableMetrics):
+        metrics = Metrics()
+        if(pipeTransport == 'hub'):
+            metrics.gauge('hub', pipe_price.GetStats)
+        pipe_price = MeteredPipe(pipe_price, metrics, 'pipe_price')
+        if(metricsPort):
+            MetricsServer(metrics, metricsPort)
+            logger.info("Metrics on http://127.0.0.1:{}/metrics".format(metricsPort))
+
+    writer = MessageWriter(pipe_price, binaryProtocol)
+
+    candleStore = None
+    if(useCandleStore):
+        from candle_store import CandleStore
+        candleStore = CandleStore(historyCacheDir)
+
     logger.info("login to rest api account")
-    restApi = BitmexRestAPI(pipe_price,pipe_order,TestServer,API_ID,API_SECRET)
+    restApi = BitmexRestAPI(pipe_price,pipe_order,TestServer,API_ID,API_SECRET,writer=writer,
+                            cacheDir=historyCacheDir,cache=candleStore)
 
     logger.info("Download history")
-    restApi.DownloadHistory(websocketSymbol)
-
+    for symbol in websocketSymbols:
+        restApi.DownloadHistory(symbol, historyBars)
+
+    # From now on the websocket writes through the publisher
+    if(usePublisher):
+        writer = Publisher(writer, metrics=metrics)
+
+    recorder = None
+    if(recordFeedDir):
+        from feed_recorder import FeedRecorder
+        recorder = FeedRecorder(recordFeedDir)
+        if(metrics is not None):
+            metrics.gauge('recorder', recorder.GetStats)
+
+    if(asyncMode):
+        asyncio.run(run_async(logger, restApi, writer, candleStore, pipe_price, websocketUrl, API_ID, API_SECRET,
+                              metrics, recorder))
+        return
+
+    logger.info("Instantiating the WS.")
+    ws = BitMEXWebsocket(namedpipe=pipe_price, endpoint=websocketUrl, symbol=websocketSymbols,
+                         api_key=API_ID, api_secret=API_SECRET, depth=depthLevels,
+                         writer=writer, candleStore=candleStore,
+                         orderSnapshotInterval=orderSnapshotInterval, metrics=metrics, recorder=recorder,
+                         gapFill=restApi.FetchCandles, barIntervals=barIntervals, connect=False)
+
+    # Position, margin and execution queries are answered from the websocket tables.
+    # Start it before connecting, MT5 commands are read while we wait for the partials.
     logger.info("Create rest mesage forward thread")
-    rest_thread = threading.Thread(target=restApi.RestForward)
+    rest_thread = threading.Thread(target=restApi.RestForward, args=(ws,))
     rest_thread.start()
 
+    logger.info("Make the WS connect.")
+    ws.connect()
+
+    # The websocket reconnects by itself, it only exits when told to
+    while(not ws.exited):
+        logger.info("Connection is active.")
+        log_stats(logger, writer, metrics)
+        sleep(statsInterval)
+
+async def run_async(logger, restApi, writer, candleStore, pipe_price, websocketUrl, API_ID, API_SECRET,
+                    metrics=None, recorder=None):
+    from bitmex_websocket_async import AsyncBitMEXWebsocket
+    loop = asyncio.get_running_loop()
+
     logger.info("Instantiating the WS and make it connect.")
-    ws = BitMEXWebsocket(namedpipe=pipe_price, endpoint=websocketUrl, symbol=websocketSymbol,
-                         api_key=API_ID, api_secret=API_SECRET)
+    ws = AsyncBitMEXWebsocket(namedpipe=pipe_price, endpoint=websocketUrl, symbol=websocketSymbols,
+                              api_key=API_ID, api_secret=API_SECRET, depth=depthLevels,
+                              writer=writer, candleStore=candleStore,
+                              orderSnapshotInterval=orderSnapshotInterval, metrics=metrics, recorder=recorder,
+                              gapFill=restApi.FetchCandles, barIntervals=barIntervals)
+
+    # Reading the order pipe blocks, keep it in the loop's executor.
+    # Queries are answered from the websocket tables.
+    logger.info("Create rest mesage forward task")
+    loop.run_in_executor(None, restApi.RestForward, ws)
+
+    await ws.connect()
 
-    while(ws.ws.sock.connected):
+    while True:
         logger.info("Connection is active.")
-        sleep(300)
+        log_stats(logger, writer, metrics)
+        try:
+            await asyncio.wait_for(asyncio.shield(ws.wait_closed()), statsInterval)
+            break
+        except asyncio.TimeoutError:
+            pass
+
+def log_stats(logger, writer, metrics):
+    if(metrics is not None):
+        metrics.dump()
+    elif(isinstance(writer, Publisher)):
+        logger.info("Publisher: {}".format(writer.GetStats()))
+
+def create_pipe(pipeName):
+    # win32pipe is only available on Windows, import the transport that is used
+    if(pipeTransport == 'sharedmemory'):
+        from SharedMemoryPipe import SharedMemoryPipe
+        return SharedMemoryPipe(pipeName,enablePipe)
+    if(pipeTransport == 'hub'):
+        from PipeHub import PipeHub
+        return PipeHub(pipeName,enablePipe)
+    from NamedPipe import NamedPipe
+    return NamedPipe(pipeName,enablePipe)
 
 def setup_logger():
     # Prints logger info to terminal
@@ -1,5 +1,9 @@
-import win32pipe, win32file
+import threading
+import pywintypes, win32event, win32pipe, win32file, winerror
 
+# The pipe is opened for overlapped I/O: Windows serializes synchronous I/O on one handle, so a
+# reply written from another thread would wait for the ReadFile that is pending until MT5 sends
+# its next command. Reads and writes have their own OVERLAPPED and can be in progress together.
 class NamedPipe:
     def __init__(self, pipeName, enablePipe):
         self.status = 'init'
@@ -8,14 +12,40 @@ class NamedPipe:
         if(self.enablePipe != True):
             return
         self.pipeHandler= win32pipe.CreateNamedPipe(self.pipeName,
-                                                    win32pipe.PIPE_ACCESS_DUPLEX,
+                                                    win32pipe.PIPE_ACCESS_DUPLEX | win32file.FILE_FLAG_OVERLAPPED,
                                                     win32pipe.PIPE_TYPE_MESSAGE | win32pipe.PIPE_WAIT,
                                                     1, 65536, 65536,300,None)
+        self.__readOverlapped = self.__overlapped()
+        self.__writeOverlapped = self.__overlapped()
+        self.__writeLock = threading.Lock()
+
+    def __overlapped(self):
+        overlapped = pywintypes.OVERLAPPED()
+        overlapped.hEvent = win32event.CreateEvent(None, True, False, None)
+        return overlapped
+
+    def __wait(self, overlapped):
+        '''Block until the operation of overlapped is done, returns the bytes transferred.'''
+        return win32file.GetOverlappedResult(self.pipeHandler, overlapped, True)
+
+    def __read(self, size):
+        buffer = win32file.AllocateReadBuffer(size)
+        win32file.ReadFile(self.pipeHandler, buffer, self.__readOverlapped)
+        try:
+            count = self.__wait(self.__readOverlapped)
+        except pywintypes.error as e:
+            # The message is longer than size, the rest is read next
+            if e.winerror != winerror.ERROR_MORE_DATA:
+                raise
+            count = size
+        return bytes(buffer[:count])
 
     def Connect(self):
         if(self.enablePipe != True):
             return
-        win32pipe.ConnectNamedPipe(self.pipeHandler, None)
+        rc = win32pipe.ConnectNamedPipe(self.pipeHandler, self.__readOverlapped)
+        if rc == winerror.ERROR_IO_PENDING:
+            self.__wait(self.__readOverlapped)
         self.status = 'connected'
 
     def Disconnect(self):
@@ -28,12 +58,19 @@ class NamedPipe:
         return self.status
 
     def Send(self,pstring):
+        if(self.enablePipe != True):
+            return
+        self.SendRaw(bytes(pstring, 'utf-8'))
+
+    def SendRaw(self,message):
         if(self.enablePipe != True):
             return
         try:
-            message = bytes(pstring, 'utf-8')
-            message_len= len(pstring).to_bytes(4, byteorder='little', signed=False)
-            win32file.WriteFile(self.pipeHandler,  message_len + message)
+            message_len= len(message).to_bytes(4, byteorder='little', signed=False)
+            # Writers of several threads (e.g. order replies) share the write OVERLAPPED
+            with self.__writeLock:
+                win32file.WriteFile(self.pipeHandler,  message_len + message, self.__writeOverlapped)
+                self.__wait(self.__writeOverlapped)
         except Exception as e:
             exception_txt = str(e)
             print("--------Exception:" + exception_txt);
@@ -45,11 +82,10 @@ class NamedPipe:
         if(self.enablePipe != True):
             return
         try:
-            rc, data = win32file.ReadFile(self.pipeHandler, 4)
+            data = self.__read(4)
             size = int.from_bytes(data, byteorder='little')
-            if(rc == 0):
-                rc, data = win32file.ReadFile(self.pipeHandler, size)
-                result = data.decode("utf-8")
+            if(len(data) == 4 and size > 0):
+                result = self.__read(size).decode("utf-8")
             return result
         except Exception as e:
             exception_txt = str(e)
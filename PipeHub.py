@@ -0,0 +1,512 @@
+import logging
+import os
+import queue
+import selectors
+import socket
+import struct
+import sys
+import tempfile
+import threading
+from collections import deque
+from wire_protocol import FRAME_HEADER, MAGIC, VERSION, record_size, REC_QUOTE, REC_CANDLE, REC_ORDERS_UPDATE, \
+    REC_ORDER, REC_DEPTH, REC_BAR, REC_POSITION, REC_MARGIN
+
+# Publish/subscribe hub with the same interface as NamedPipe, for many MT5 terminals on one feed.
+# The hub listens on a Unix domain socket, every connected client gets the messages of the
+# channels and symbols it subscribed to. Messages are framed like on the named pipe (4 byte
+# little endian length + payload) in both directions.
+#
+# Channels:
+#   quotes  - qt, depth
+#   candles - cndl, bar
+#   orders  - ordersupdt, ordrtbl, pos, margin and ratelimit
+# The symbol filter applies to the messages that carry a symbol, except the order table: an
+# ordersupdt count covers all orders, so the order table always goes out complete.
+#
+# Clients subscribe with "sub,<channels>,<symbols>", lists separated by ';' and '*' for all,
+# e.g. "sub,quotes;candles,XBTUSD". A new client is subscribed to everything, a sub command
+# replaces the subscription and sends the latest quote, depth, position and margin of the new
+# subscription. Every other message from a client is a command returned by Receive(), so the
+# hub can be the order pipe too. Receive() tags the correlation id of a command with the
+# client it came from ("order,7,[...]" of client 3 becomes "order,h3:7,[...]", a command
+# without id gets "h3:"), the ack/err reply to it goes only to that client, untagged again.
+#
+# A message is encoded once by the writer and framed once by the hub, then written to every
+# client that wants it. Binary frames are split by record: a client that wants only some of the
+# records gets a frame of those, built once per distinct subscription.
+#
+# Backpressure is per client. Send writes straight to the socket when the client keeps up,
+# otherwise the rest is queued and written by the hub thread. When a client has more than
+# maxQueuedBytes queued, quotes and depth for it are dropped (counted), any other message
+# disconnects it, because a gap in candles or orders can't be repaired on the client side.
+
+DEFAULT_MAX_QUEUED = 4 * 1024 * 1024
+
+CHANNELS = ('quotes', 'candles', 'orders')
+
+# text message type -> (channel, symbol field or None)
+TEXT_ROUTES = {
+    'qt': ('quotes', True), 'depth': ('quotes', True),
+    'cndl': ('candles', True), 'bar': ('candles', True),
+    'pos': ('orders', True), 'margin': ('orders', False),
+    'ordersupdt': ('orders', False), 'ordrtbl': ('orders', False), 'ratelimit': ('orders', False),
+}
+
+# Replies to a client command, sent only to the client of the tagged correlation id
+REPLIES = ('ack', 'err')
+
+# binary record type -> (channel, has symbol)
+RECORD_ROUTES = {
+    REC_QUOTE: ('quotes', True), REC_DEPTH: ('quotes', True),
+    REC_CANDLE: ('candles', True), REC_BAR: ('candles', True),
+    REC_POSITION: ('orders', True), REC_MARGIN: ('orders', False),
+    REC_ORDERS_UPDATE: ('orders', False), REC_ORDER: ('orders', False),
+}
+
+# Messages whose latest value is kept for new subscribers
+LAST_VALUE_TEXT = ('qt', 'depth', 'pos', 'margin')
+LAST_VALUE_RECORDS = (REC_QUOTE, REC_DEPTH, REC_POSITION, REC_MARGIN)
+
+_length = struct.Struct('<I')
+
+
+def hub_socket_path(pipeName):
+    return os.path.join(tempfile.gettempdir(), pipeName + '.sock')
+
+
+class _Client:
+
+    def __init__(self, sock, number):
+        self.sock = sock
+        self.number = number
+        self.name = 'client-%d' % number
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.pendingBytes = 0
+        self.received = bytearray()
+        self.channels = None
+        self.symbols = None
+        self.closed = False
+        # metrics
+        self.sent = 0
+        self.dropped = 0
+
+    def subscription(self):
+        return (self.channels, self.symbols)
+
+    def wants(self, channel, symbol):
+        return (self.channels is None or channel in self.channels) and \
+            (symbol is None or self.symbols is None or symbol in self.symbols)
+
+
+class PipeHub:
+
+    def __init__(self, pipeName, enablePipe, maxQueuedBytes=DEFAULT_MAX_QUEUED):
+        self.logger = logging.getLogger(__name__)
+        self.status = 'init'
+        self.pipeName = hub_socket_path(pipeName)
+        self.enablePipe = enablePipe
+        self.maxQueuedBytes = maxQueuedBytes
+        self.clients = []
+        self.commands = queue.Queue()
+        self.__lastValues = {}
+        self.__clientCount = 0
+        self.__lock = threading.Lock()
+        self.__selector = None
+        self.__server = None
+        self.__wakeup = None
+        self.__thread = None
+        # metrics
+        self.messages = 0
+        self.disconnects = 0
+
+    def Connect(self):
+        '''Start listening. Unlike the named pipe this doesn't wait for a client.'''
+        if(self.enablePipe != True):
+            return
+        try:
+            os.remove(self.pipeName)
+        except OSError:
+            pass
+        self.__server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__server.bind(self.pipeName)
+        self.__server.listen(64)
+        self.__server.setblocking(False)
+        self.__wakeup = socket.socketpair()
+        self.__wakeup[0].setblocking(False)
+        self.__wakeup[1].setblocking(False)
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(self.__server, selectors.EVENT_READ, 'accept')
+        self.__selector.register(self.__wakeup[0], selectors.EVENT_READ, 'wakeup')
+        self.status = 'connected'
+        self.__thread = threading.Thread(target=self.__run, name='pipe-hub')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def Disconnect(self):
+        if(self.enablePipe != True):
+            return
+        self.status = 'disconnected'
+        self.__wake()
+        if self.__thread is not None:
+            self.__thread.join(2)
+        for client in list(self.clients):
+            self.__close(client)
+        if self.__server is not None:
+            self.__server.close()
+            self.__selector.close()
+            for sock in self.__wakeup:
+                sock.close()
+        try:
+            os.remove(self.pipeName)
+        except OSError:
+            pass
+
+    def GetStatus(self):
+        return self.status
+
+    def GetStats(self):
+        return {'clients': len(self.clients), 'messages': self.messages, 'disconnects': self.disconnects,
+                'sent': sum(client.sent for client in self.clients),
+                'dropped': sum(client.dropped for client in self.clients),
+                'queuedBytes': sum(client.pendingBytes for client in self.clients)}
+
+    # Publishing
+
+    def Send(self, pstring):
+        if(self.enablePipe != True or self.status != 'connected'):
+            return
+        parts = pstring.split(',', 2)
+        if parts[0] in REPLIES:
+            self.__reply(parts)
+            return
+        data = bytes(pstring, 'utf-8')
+        self.__publish_text(parts[0], parts[1] if len(parts) > 1 else None, _length.pack(len(data)) + data)
+
+    def SendRaw(self, message):
+        if(self.enablePipe != True or self.status != 'connected'):
+            return
+        if message[:2] == MAGIC and len(message) >= FRAME_HEADER.size:
+            self.__publish_frame(message)
+            return
+        parts = bytes(message[:64]).decode('utf-8', 'replace').split(',', 2)
+        if parts[0] in REPLIES:
+            self.__reply(bytes(message).decode('utf-8').split(',', 2))
+            return
+        self.__publish_text(parts[0], parts[1] if len(parts) > 1 else None, _length.pack(len(message)) + bytes(message))
+
+    def __publish_text(self, kind, name, data):
+        '''name is the second field: the symbol of market messages, the currency of margin.'''
+        self.messages += 1
+        route = TEXT_ROUTES.get(kind)
+        channel = route[0] if route is not None else None
+        symbol = name if route is not None and route[1] else None
+        if kind in LAST_VALUE_TEXT:
+            self.__lastValues[(kind, name)] = (channel, symbol, data, False)
+        lossy = channel == 'quotes'
+        for client in self.clients:
+            if channel is None or client.wants(channel, symbol):
+                self.__write(client, data, lossy)
+
+    def __reply(self, parts):
+        '''Send an ack/err to the client that sent the command, without the client tag.'''
+        self.messages += 1
+        tag, tagged, corrId = (parts[1] if len(parts) > 1 else '').partition(':')
+        client = None
+        if tagged and tag[:1] == 'h' and tag[1:].isdigit():
+            number = int(tag[1:])
+            client = next((client for client in self.clients if client.number == number), None)
+        if client is None:
+            # The client is gone or the command didn't come through the hub
+            self.logger.debug("No client for reply %s" % ','.join(parts)[:100])
+            return
+        data = bytes(','.join([parts[0], corrId] + parts[2:]), 'utf-8')
+        self.__write(client, _length.pack(len(data)) + data, False)
+
+    def __publish_frame(self, frame):
+        '''Route the records of a binary frame, a client gets only the records it wants.'''
+        self.messages += 1
+        magic, version, flags, count, length = FRAME_HEADER.unpack_from(frame, 0)
+        records = []
+        offset = FRAME_HEADER.size
+        for _ in range(count):
+            recordType = frame[offset]
+            size = record_size(frame, offset)
+            channel, hasSymbol = RECORD_ROUTES.get(recordType, (None, False))
+            symbol = None
+            if hasSymbol:
+                symbol = bytes(frame[offset + 1:offset + 13]).rstrip(b'\x00').decode('utf-8')
+            if recordType in LAST_VALUE_RECORDS:
+                # Margin records are kept by currency, at the place of the symbol
+                name = symbol if hasSymbol else bytes(frame[offset + 1:offset + 13])
+                self.__lastValues[(recordType, name)] = (channel, symbol, bytes(frame[offset:offset + size]), True)
+            records.append((channel, symbol, offset, offset + size))
+            offset += size
+
+        full = None
+        subsets = {}
+        for client in self.clients:
+            subscription = client.subscription()
+            if subscription == (None, None):
+                if full is None:
+                    full = _length.pack(len(frame)) + bytes(frame)
+                self.__write(client, full, False)
+                continue
+            if subscription not in subsets:
+                selected = [frame[start:end] for channel, symbol, start, end in records
+                            if channel is None or client.wants(channel, symbol)]
+                lossy = all(channel == 'quotes' for channel, symbol, start, end in records
+                            if channel is None or client.wants(channel, symbol))
+                subsets[subscription] = (self.__frame(selected), lossy) if selected else (None, True)
+            data, lossy = subsets[subscription]
+            if data is not None:
+                self.__write(client, data, lossy)
+
+    def __frame(self, records):
+        payload = b''.join(records)
+        header = FRAME_HEADER.pack(MAGIC, VERSION, 0, len(records), len(payload))
+        return _length.pack(len(header) + len(payload)) + header + payload
+
+    def __write(self, client, data, lossy):
+        with client.lock:
+            if client.closed:
+                return
+            if not client.pending:
+                try:
+                    written = client.sock.send(data)
+                except BlockingIOError:
+                    written = 0
+                except OSError:
+                    self.__drop_client(client)
+                    return
+                client.sent += 1
+                if written == len(data):
+                    return
+                data = memoryview(data)[written:]
+            elif client.pendingBytes + len(data) > self.maxQueuedBytes:
+                if lossy:
+                    client.dropped += 1
+                    return
+                self.logger.warning("%s is too slow, disconnecting it" % client.name)
+                self.__drop_client(client)
+                return
+            else:
+                client.sent += 1
+            client.pending.append(data)
+            client.pendingBytes += len(data)
+        self.__wake()
+
+    def __drop_client(self, client):
+        '''Called with the client lock held, the hub thread closes the socket.'''
+        client.closed = True
+        self.disconnects += 1
+        self.__wake()
+
+    # Commands from the clients
+
+    def Receive(self):
+        '''Block until a client sends a command. Returns it as text, with the client tag in
+        the correlation id.'''
+        result = ""
+        if(self.enablePipe != True):
+            return
+        while self.status == 'connected':
+            try:
+                return self.commands.get(timeout=1)
+            except queue.Empty:
+                pass
+        return result
+
+    def __command(self, client, text):
+        if not text.startswith('sub,') and text != 'sub':
+            self.commands.put(self.__tag(client, text))
+            return
+        parts = text.split(',')
+        channels = parts[1] if len(parts) > 1 else '*'
+        symbols = parts[2] if len(parts) > 2 else '*'
+        with client.lock:
+            client.channels = None if channels == '*' else frozenset(c for c in channels.split(';') if c)
+            client.symbols = None if symbols == '*' else frozenset(s for s in symbols.split(';') if s)
+        self.logger.info("%s subscribed to %s %s" % (client.name, channels, symbols))
+        self.__send_last_values(client)
+
+    def __tag(self, client, text):
+        '''Put the client into the correlation id: "<cmd>,h<client>:<id>,<rest>".'''
+        cmd, _, rest = text.partition(',')
+        corrId = ''
+        if rest.lstrip()[:1] not in ('[', '{'):
+            corrId, _, rest = rest.partition(',')
+        return "{},h{}:{},{}".format(cmd, client.number, corrId.strip(), rest)
+
+    def __send_last_values(self, client):
+        records = []
+        for channel, symbol, data, isRecord in list(self.__lastValues.values()):
+            if not client.wants(channel, symbol):
+                continue
+            if isRecord:
+                records.append(data)
+            else:
+                self.__write(client, data, True)
+        if records:
+            self.__write(client, self.__frame(records), True)
+
+    # Hub thread
+
+    def __wake(self):
+        try:
+            self.__wakeup[1].send(b'\x00')
+        except (OSError, TypeError):
+            pass
+
+    def __run(self):
+        while self.status == 'connected':
+            for client in list(self.clients):
+                if client.closed:
+                    self.__close(client)
+                    continue
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.pending else 0)
+                if self.__selector.get_key(client.sock).events != events:
+                    self.__selector.modify(client.sock, events, client)
+            for key, events in self.__selector.select(timeout=1):
+                if key.data == 'accept':
+                    self.__accept()
+                elif key.data == 'wakeup':
+                    try:
+                        while self.__wakeup[0].recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    client = key.data
+                    if events & selectors.EVENT_WRITE:
+                        self.__flush(client)
+                    if events & selectors.EVENT_READ:
+                        self.__read(client)
+
+    def __accept(self):
+        try:
+            sock, _ = self.__server.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        self.__clientCount += 1
+        client = _Client(sock, self.__clientCount)
+        self.__selector.register(sock, selectors.EVENT_READ, client)
+        with self.__lock:
+            self.clients = self.clients + [client]
+        self.logger.info("%s connected" % client.name)
+
+    def __flush(self, client):
+        with client.lock:
+            while client.pending and not client.closed:
+                data = client.pending[0]
+                try:
+                    written = client.sock.send(data)
+                except BlockingIOError:
+                    return
+                except OSError:
+                    client.closed = True
+                    return
+                client.pendingBytes -= written
+                if written < len(data):
+                    client.pending[0] = memoryview(data)[written:]
+                    return
+                client.pending.popleft()
+
+    def __read(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            client.closed = True
+            self.__close(client)
+            return
+        client.received += data
+        while len(client.received) >= 4:
+            size = _length.unpack_from(client.received)[0]
+            if len(client.received) < 4 + size:
+                break
+            message = bytes(client.received[4:4 + size]).decode('utf-8', 'replace').replace('\x00', '')
+            del client.received[:4 + size]
+            self.__command(client, message)
+
+    def __close(self, client):
+        with self.__lock:
+            if client not in self.clients:
+                return
+            self.clients = [c for c in self.clients if c is not client]
+        client.closed = True
+        try:
+            self.__selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+        self.logger.info("%s disconnected" % client.name)
+
+
+class PipeHubClient:
+    '''Client side of the hub, for MT5 side tools and testing.'''
+
+    def __init__(self, pipeName):
+        self.pipeName = hub_socket_path(pipeName)
+        self.sock = None
+        self.status = 'init'
+
+    def Connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.pipeName)
+        self.status = 'connected'
+
+    def Subscribe(self, channels='*', symbols='*'):
+        if not isinstance(channels, str):
+            channels = ';'.join(channels)
+        if not isinstance(symbols, str):
+            symbols = ';'.join(symbols)
+        self.Send("sub,{},{}".format(channels, symbols))
+
+    def Send(self, pstring):
+        data = bytes(pstring, 'utf-8')
+        self.sock.sendall(_length.pack(len(data)) + data)
+
+    def ReceiveRaw(self):
+        '''Next message as bytes, None when the hub closed the connection.'''
+        header = self.__read(4)
+        if header is None:
+            return None
+        return self.__read(_length.unpack(header)[0])
+
+    def Receive(self):
+        message = self.ReceiveRaw()
+        if message is None:
+            self.status = 'disconnected'
+            return ""
+        return message if message[:2] == MAGIC else message.decode('utf-8')
+
+    def __read(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+    def Disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.status = 'disconnected'
+
+
+# Local reader for testing: connect to a hub and print what the bridge sends.
+#   python PipeHub.py Bitmex.Pipe.ServerPrice [channels] [symbols]
+if __name__ == '__main__':
+    client = PipeHubClient(sys.argv[1] if len(sys.argv) > 1 else 'Bitmex.Pipe.ServerPrice')
+    client.Connect()
+    client.Subscribe(sys.argv[2] if len(sys.argv) > 2 else '*', sys.argv[3] if len(sys.argv) > 3 else '*')
+    while client.status == 'connected':
+        message = client.Receive()
+        if message:
+            print(message)
@@ -0,0 +1,237 @@
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+
+# Shared memory transport with the same interface as NamedPipe.
+# The pipe is a memory mapped file holding two single producer / single consumer ring buffers,
+# one for each direction. Messages are framed like on the named pipe (4 byte little endian
+# length + utf-8 payload). Positions are free running 64 bit counters, the producer only
+# writes the write position and the consumer only writes the read position, so no locking is
+# needed. When the ring is full Send waits up to sendTimeout for the consumer to make room, the
+# caller is the publisher thread which keeps conflating while it waits. If there is still no
+# room the message is dropped, counted in the ring and Send returns False. The consumer checks
+# the drop count of the ring: when it went up it missed messages and has to resync (query the
+# orders again, reload the candles) instead of trusting its state.
+#
+# Layout: header (magic, version, ring capacity), ring 0 server -> client, ring 1 client -> server.
+# Each ring has a control block with the write position and drop count on one cache line and the
+# read position on the next.
+
+MAGIC = b'BMSR'
+VERSION = 2
+HEADER_SIZE = 64
+CONTROL_SIZE = 128
+DEFAULT_CAPACITY = 4 * 1024 * 1024
+
+_header = struct.Struct('<4sIQ')
+_position = struct.Struct('<Q')
+_length = struct.Struct('<I')
+
+
+def shared_memory_path(pipeName):
+    '''/dev/shm keeps the file in memory on Linux, elsewhere use the temp directory.'''
+    if os.path.isdir('/dev/shm'):
+        return os.path.join('/dev/shm', pipeName)
+    return os.path.join(tempfile.gettempdir(), pipeName)
+
+
+class _Ring:
+
+    def __init__(self, buffer, offset, capacity):
+        self.buffer = buffer
+        self.writeOffset = offset
+        self.dropOffset = offset + 8
+        self.readOffset = offset + 64
+        self.dataOffset = offset + CONTROL_SIZE
+        self.capacity = capacity
+        # The producer owns the write position and only looks at the read position again
+        # when its cached copy says the ring is full.
+        self.writePos = _position.unpack_from(buffer, self.writeOffset)[0]
+        self.readCache = _position.unpack_from(buffer, self.readOffset)[0]
+
+    def reset(self):
+        _position.pack_into(self.buffer, self.writeOffset, 0)
+        _position.pack_into(self.buffer, self.readOffset, 0)
+        _position.pack_into(self.buffer, self.dropOffset, 0)
+        self.writePos = 0
+        self.readCache = 0
+
+    def __copy_in(self, pos, data):
+        start = pos % self.capacity
+        first = min(len(data), self.capacity - start)
+        base = self.dataOffset
+        self.buffer[base + start:base + start + first] = data[:first]
+        if first < len(data):
+            self.buffer[base:base + len(data) - first] = data[first:]
+
+    def __copy_out(self, pos, size):
+        start = pos % self.capacity
+        first = min(size, self.capacity - start)
+        base = self.dataOffset
+        data = self.buffer[base + start:base + start + first]
+        if first < size:
+            data += self.buffer[base:base + size - first]
+        return data
+
+    def write(self, data):
+        '''Append one message. Returns False if there is no room for it.'''
+        write = self.writePos
+        size = 4 + len(data)
+        if size > self.capacity - (write - self.readCache):
+            self.readCache = _position.unpack_from(self.buffer, self.readOffset)[0]
+            if size > self.capacity - (write - self.readCache):
+                return False
+        self.__copy_in(write, _length.pack(len(data)) + data)
+        # Publish the message only after it is completely in the ring
+        self.writePos = write + size
+        _position.pack_into(self.buffer, self.writeOffset, self.writePos)
+        return True
+
+    def drop(self):
+        '''Count a message the producer could not write.'''
+        dropped = _position.unpack_from(self.buffer, self.dropOffset)[0] + 1
+        _position.pack_into(self.buffer, self.dropOffset, dropped)
+
+    def dropped(self):
+        return _position.unpack_from(self.buffer, self.dropOffset)[0]
+
+    def read(self):
+        '''Pop one message or return None if the ring is empty.'''
+        write = _position.unpack_from(self.buffer, self.writeOffset)[0]
+        read = _position.unpack_from(self.buffer, self.readOffset)[0]
+        if read == write:
+            return None
+        size = _length.unpack(self.__copy_out(read, 4))[0]
+        data = self.__copy_out(read + 4, size)
+        _position.pack_into(self.buffer, self.readOffset, read + 4 + size)
+        return data
+
+    def pending(self):
+        write = _position.unpack_from(self.buffer, self.writeOffset)[0]
+        read = _position.unpack_from(self.buffer, self.readOffset)[0]
+        return write - read
+
+
+class SharedMemoryPipe:
+    def __init__(self, pipeName, enablePipe, server=True, capacity=DEFAULT_CAPACITY, sendTimeout=0.5):
+        self.status = 'init'
+        self.pipeName = shared_memory_path(pipeName)
+        self.enablePipe = enablePipe
+        self.server = server
+        self.capacity = capacity
+        self.sendTimeout = sendTimeout
+        # Messages this side dropped, and the drop count of the other side seen so far
+        self.drops = 0
+        self.missed = 0
+        self.stalled = False
+        self.buffer = None
+        self.txRing = None
+        self.rxRing = None
+
+    def Connect(self):
+        '''The server creates the mapping, clients wait for it to show up and attach to it.'''
+        if(self.enablePipe != True):
+            return
+        size = HEADER_SIZE + 2 * (CONTROL_SIZE + self.capacity)
+        if self.server:
+            with open(self.pipeName, 'w+b') as f:
+                f.truncate(size)
+                self.buffer = mmap.mmap(f.fileno(), size)
+            _header.pack_into(self.buffer, 0, b'\x00' * 4, VERSION, self.capacity)
+        else:
+            while True:
+                try:
+                    with open(self.pipeName, 'r+b') as f:
+                        self.buffer = mmap.mmap(f.fileno(), 0)
+                    if _header.unpack_from(self.buffer, 0)[0] == MAGIC:
+                        break
+                    self.buffer.close()
+                except (OSError, ValueError, struct.error):
+                    pass
+                time.sleep(0.1)
+            magic, version, self.capacity = _header.unpack_from(self.buffer, 0)
+            if version != VERSION:
+                raise Exception("Unsupported shared memory pipe version: %s" % version)
+
+        ring0 = _Ring(self.buffer, HEADER_SIZE, self.capacity)
+        ring1 = _Ring(self.buffer, HEADER_SIZE + CONTROL_SIZE + self.capacity, self.capacity)
+        if self.server:
+            ring0.reset()
+            ring1.reset()
+            # Mark the mapping as ready for clients only when it is initialized
+            self.buffer[0:4] = MAGIC
+        self.txRing, self.rxRing = (ring0, ring1) if self.server else (ring1, ring0)
+        self.status = 'connected'
+
+    def Disconnect(self):
+        if(self.enablePipe != True):
+            return
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+        if self.server:
+            try:
+                os.remove(self.pipeName)
+            except OSError:
+                pass
+        self.status = 'disconnected'
+
+    def GetStatus(self):
+        return self.status
+
+    def Send(self, pstring):
+        if(self.enablePipe != True):
+            return
+        return self.SendRaw(bytes(pstring, 'utf-8'))
+
+    def SendRaw(self, message):
+        '''Returns False if the message was dropped because the ring stayed full.'''
+        if(self.enablePipe != True or self.txRing is None):
+            return False
+        if self.txRing.write(message):
+            self.stalled = False
+            return True
+        # Once a wait timed out the consumer is stalled (or gone), fail fast until it reads again
+        if not self.stalled:
+            deadline = time.monotonic() + self.sendTimeout
+            while time.monotonic() < deadline:
+                time.sleep(0.001)
+                if self.txRing.write(message):
+                    return True
+            self.stalled = True
+        self.txRing.drop()
+        self.drops += 1
+        return False
+
+    def Receive(self):
+        '''Block until a message arrives. Spins shortly before backing off to sleeps.'''
+        result = ""
+        if(self.enablePipe != True):
+            return
+        spins = 0
+        while self.status == 'connected':
+            data = self.rxRing.read()
+            if data is not None:
+                missed = self.rxRing.dropped()
+                if missed != self.missed:
+                    print("--------Missed {} messages".format(missed - self.missed))
+                    self.missed = missed
+                return data.decode("utf-8")
+            spins += 1
+            if spins > 1000:
+                time.sleep(0.001)
+        return result
+
+
+# Local reader for testing: attach to a pipe as client and print what the bridge sends.
+#   python SharedMemoryPipe.py Bitmex.Pipe.ServerPrice
+if __name__ == '__main__':
+    pipe = SharedMemoryPipe(sys.argv[1] if len(sys.argv) > 1 else 'Bitmex.Pipe.ServerPrice', True, server=False)
+    pipe.Connect()
+    while True:
+        message = pipe.Receive()
+        if message:
+            print(message)
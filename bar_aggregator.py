@@ -0,0 +1,126 @@
+from collections import deque
+
+# Builds bars from the trade table.
+# Every trade updates the forming bar of each configured interval (seconds), a bar is closed
+# by the first trade or advance() time past its end. Work per trade is constant: one bucket
+# computation and a few comparisons per interval.
+#
+# The websocket adds the trades of a message and then drains the aggregator: closed bars come
+# out in the order they closed, forming bars once per message with their latest state.
+# tradeBin1m from the exchange stays the reference for 1m bars, reconcile() corrects the
+# locally built bar if trades were missed (e.g. during a reconnect).
+
+
+class Bar:
+    __slots__ = ('start', 'open', 'high', 'low', 'close', 'volume', 'trades')
+
+    def __init__(self, start, price, size):
+        self.start = start
+        self.open = price
+        self.high = price
+        self.low = price
+        self.close = price
+        self.volume = size
+        self.trades = 1
+
+    def add(self, price, size):
+        if price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += size
+        self.trades += 1
+
+
+class BarAggregator:
+
+    # Closed bars kept per symbol for reconcile()
+    RECONCILE_BARS = 5
+    # Interval of the exchange bins that reconcile() compares against
+    BIN_INTERVAL = 60
+
+    def __init__(self, intervals=(1, 5, 15, 60)):
+        self.intervals = sorted(set(int(interval) for interval in intervals))
+        self.__forming = {}
+        self.__changed = {}
+        self.__closed = []
+        self.__recent = {}
+        # metrics
+        self.lateTrades = 0
+        self.corrections = 0
+
+    def add(self, symbol, timestamp, price, size):
+        '''Add a trade, timestamp in unix seconds.'''
+        for interval in self.intervals:
+            key = (symbol, interval)
+            start = int(timestamp // interval) * interval
+            bar = self.__forming.get(key)
+            if bar is not None and bar.start == start:
+                bar.add(price, size)
+            elif bar is not None and start < bar.start:
+                # Trade of a bar that is already closed, reconcile() repairs 1m bars
+                self.lateTrades += 1
+                continue
+            else:
+                if bar is not None:
+                    self.__close(key, bar)
+                bar = Bar(start, price, size)
+                self.__forming[key] = bar
+            self.__changed[key] = bar
+
+    def advance(self, symbol, timestamp):
+        '''Close the bars of symbol that end at or before timestamp (unix seconds).'''
+        for interval in self.intervals:
+            key = (symbol, interval)
+            bar = self.__forming.get(key)
+            if bar is not None and bar.start + interval <= timestamp:
+                self.__close(key, bar)
+                del self.__forming[key]
+
+    def __close(self, key, bar):
+        self.__closed.append((key[0], key[1], bar))
+        if self.__changed.get(key) is bar:
+            del self.__changed[key]
+        if key[1] == self.BIN_INTERVAL:
+            recent = self.__recent.get(key[0])
+            if recent is None:
+                recent = self.__recent[key[0]] = deque(maxlen=self.RECONCILE_BARS)
+            recent.append(bar)
+
+    def forming(self, symbol, interval):
+        return self.__forming.get((symbol, interval))
+
+    def drain(self):
+        '''Return (closed, forming) since the last drain as lists of (symbol, interval, bar).'''
+        closed = self.__closed
+        forming = [(key[0], key[1], bar) for key, bar in self.__changed.items()]
+        self.__closed = []
+        self.__changed = {}
+        return closed, forming
+
+    def reconcile(self, symbol, start, open, high, low, close, volume):
+        '''Compare the exchange bin starting at start with the local 1m bar. Returns the
+        corrected bar if they differ, None if they match or 1m bars are not built.'''
+        if self.BIN_INTERVAL not in self.intervals:
+            return None
+        recent = self.__recent.setdefault(symbol, deque(maxlen=self.RECONCILE_BARS))
+        bar = None
+        for candidate in recent:
+            if candidate.start == start:
+                bar = candidate
+                break
+        if bar is not None and (bar.open, bar.high, bar.low, bar.close, bar.volume) == (open, high, low, close, volume):
+            return None
+        if bar is None:
+            # No trades seen for the bin, e.g. while disconnected
+            bar = Bar(start, open, 0)
+            bar.trades = 0
+            recent.append(bar)
+        bar.open = open
+        bar.high = high
+        bar.low = low
+        bar.close = close
+        bar.volume = volume
+        self.corrections += 1
+        return bar
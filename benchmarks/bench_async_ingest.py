@@ -0,0 +1,71 @@
+# Offline ingest benchmark of AsyncBitMEXWebsocket against the local fake BitMEX server.
+# Measures frames/s with the server replaying as fast as possible, and the latency from the
+# server sending a frame to the bridge having written it to the pipe with paced frames.
+#
+# Run from the repository root:
+#   python -m benchmarks.bench_async_ingest [quotes]
+import asyncio
+import sys
+import time
+from bitmex_websocket_async import AsyncBitMEXWebsocket
+from fake_bitmex_server import FakeBitmexServer, default_script
+
+
+class NullPipe:
+
+    def __init__(self):
+        self.messages = 0
+
+    def Send(self, pstring):
+        self.messages += 1
+
+    def SendRaw(self, message):
+        self.messages += 1
+
+
+class TimedWebsocket(AsyncBitMEXWebsocket):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def process_message(self, message):
+        super().process_message(message)
+        # The fake server appends "sent": perf_counter_ns() as last field
+        if message.endswith('}') and '"sent": ' in message:
+            sent = int(message[message.rindex(':') + 1:-1])
+            self.latencies.append(time.perf_counter_ns() - sent)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run(title, quotes, interval):
+    server = FakeBitmexServer(default_script(quotes=quotes), stamp=True, interval=interval)
+    await server.start()
+    pipe = NullPipe()
+    ws = TimedWebsocket(namedpipe=pipe, endpoint=server.endpoint, symbol='XBTUSD')
+    start = time.perf_counter()
+    await ws.connect()
+    while len(ws.latencies) < quotes + 3:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    await ws.close()
+    await server.stop()
+    print(title)
+    print("%d frames in %.3f s: %.0f frames/s, %d pipe messages" %
+          (len(ws.latencies), elapsed, len(ws.latencies) / elapsed, pipe.messages))
+    print("latency us: p50 %.1f p99 %.1f max %.1f" % (percentile(ws.latencies, 50) / 1000,
+                                                     percentile(ws.latencies, 99) / 1000,
+                                                     max(ws.latencies) / 1000))
+
+
+async def main(quotes):
+    await run('max speed', quotes, None)
+    await run('paced 1 ms', 2000, 0.001)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,62 @@
+# Benchmark of the memory mapped candle store.
+# Measures the append rate (bulk and one bar at a time like the live feed) and the time to
+# resample the whole history to 5m/15m/1h/1d.
+#
+# Run from the repository root:
+#   python -m benchmarks.bench_candle_store [bars]
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from candle_store import CandleStore
+
+
+def make_bars(count, start=1262304060):
+    timestamps = start + np.arange(count, dtype=np.int64) * 60
+    rng = np.random.default_rng(1)
+    close = 10000.0 + np.cumsum(rng.normal(0, 5, count))
+    open = np.concatenate(([close[0]], close[:-1]))
+    high = np.maximum(open, close) + rng.random(count) * 3
+    low = np.minimum(open, close) - rng.random(count) * 3
+    volume = rng.integers(1, 1000000, count).astype(np.float64)
+    return timestamps, open, high, low, close, volume
+
+
+def main(count):
+    directory = tempfile.mkdtemp()
+    try:
+        store = CandleStore(directory)
+        bars = make_bars(count)
+
+        chunk = 100000
+        start = time.perf_counter()
+        for offset in range(0, count, chunk):
+            store.series('XBTUSD').append(*[column[offset:offset + chunk] for column in bars])
+        elapsed = time.perf_counter() - start
+        print("bulk append %d bars: %.3f s, %.0f bars/s" % (count, elapsed, count / elapsed))
+
+        live = 100000
+        liveBars = make_bars(live)
+        start = time.perf_counter()
+        for i in range(live):
+            store.append_candle('ETHUSD', *[column[i] for column in liveBars])
+        elapsed = time.perf_counter() - start
+        print("single append %d bars: %.3f s, %.0f bars/s" % (live, elapsed, live / elapsed))
+
+        for period in ['5m', '15m', '1h', '1d']:
+            start = time.perf_counter()
+            result = store.resample('XBTUSD', period)
+            elapsed = time.perf_counter() - start
+            print("resample %d bars to %-3s: %.3f s (%d bars)" % (count, period, elapsed, len(result['timestamp'])))
+
+        start = time.perf_counter()
+        candles = store.series('XBTUSD').range(bars[0][count // 2], bars[0][count // 2] + 86400 * 30)
+        elapsed = time.perf_counter() - start
+        print("range query 30 days: %.1f us (%d bars)" % (elapsed * 1e6, len(candles['timestamp'])))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000000)
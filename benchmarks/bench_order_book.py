@@ -0,0 +1,69 @@
+# Micro-benchmark of the L2 order book.
+# Applies a burst of synthetic orderBookL2 deltas around the touch, similar to XBTUSD traffic.
+#
+# Run from the repository root:
+#   python -m benchmarks.bench_order_book
+import random
+import time
+from order_book import OrderBook
+
+LEVELS = 2000
+TICK = 0.5
+MID = 10000.0
+
+
+def level_id(price):
+    return int(88000000000 - price * 100)
+
+
+def make_partial():
+    rows = []
+    for i in range(1, LEVELS + 1):
+        for side, price in (('Buy', MID - i * TICK), ('Sell', MID + i * TICK)):
+            rows.append({'symbol': 'XBTUSD', 'id': level_id(price), 'side': side, 'size': 1000, 'price': price})
+    return rows
+
+
+def make_deltas(count):
+    deltas = []
+    live = {}
+    for row in make_partial():
+        live[row['id']] = row
+    for _ in range(count):
+        side = random.choice(('Buy', 'Sell'))
+        offset = int(random.expovariate(0.1)) + 1
+        price = MID - offset * TICK if side == 'Buy' else MID + offset * TICK
+        levelId = level_id(price)
+        row = {'symbol': 'XBTUSD', 'id': levelId, 'side': side}
+        if levelId in live and random.random() < 0.2:
+            del live[levelId]
+            deltas.append(('delete', [row]))
+        elif levelId in live:
+            row['size'] = random.randrange(1, 100000)
+            deltas.append(('update', [row]))
+        else:
+            row['size'] = random.randrange(1, 100000)
+            row['price'] = price
+            live[levelId] = row
+            deltas.append(('insert', [row]))
+    return deltas
+
+
+def main():
+    random.seed(1)
+    deltas = make_deltas(200000)
+    book = OrderBook('XBTUSD', 10)
+    book.apply('partial', make_partial())
+    published = 0
+    start = time.perf_counter()
+    for action, rows in deltas:
+        if book.apply(action, rows):
+            book.top()
+            published += 1
+    elapsed = time.perf_counter() - start
+    print("%d deltas in %.3f s: %.0f deltas/s, %.2f us/delta, %d depth messages" %
+          (len(deltas), elapsed, len(deltas) / elapsed, elapsed * 1e6 / len(deltas), published))
+
+
+if __name__ == '__main__':
+    main()
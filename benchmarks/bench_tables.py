@@ -0,0 +1,90 @@
+# Micro-benchmark of the websocket table store.
+# Compares the old list store (linear findItemByKeys scan + list.remove) with KeyedTable on
+# synthetic update bursts against an order table.
+#
+# Run from the repository root:
+#   python -m benchmarks.bench_tables
+import random
+import time
+from table_store import KeyedTable
+
+KEYS = ['orderID']
+
+
+def findItemByKeys(keys, table, matchData):
+    for item in table:
+        matched = True
+        for key in keys:
+            if item[key] != matchData[key]:
+                matched = False
+        if matched:
+            return item
+
+
+def make_rows(count):
+    return [{'orderID': 'order-%06d' % i, 'price': 10000.0 + i, 'leavesQty': 100} for i in range(count)]
+
+
+def make_burst(count, updates):
+    return [{'orderID': 'order-%06d' % random.randrange(count), 'leavesQty': random.randrange(1, 100)}
+            for _ in range(updates)]
+
+
+def run_list(rows, burst):
+    table = [dict(row) for row in rows]
+    start = time.perf_counter()
+    for updateData in burst:
+        item = findItemByKeys(KEYS, table, updateData)
+        item.update(updateData)
+    for deleteData in burst[:len(burst) // 10]:
+        item = findItemByKeys(KEYS, table, deleteData)
+        if item:
+            table.remove(item)
+    return time.perf_counter() - start
+
+
+def run_keyed(rows, burst):
+    table = KeyedTable(KEYS)
+    table += [dict(row) for row in rows]
+    start = time.perf_counter()
+    for updateData in burst:
+        table.update(updateData)
+    for deleteData in burst[:len(burst) // 10]:
+        table.remove(deleteData)
+    return time.perf_counter() - start
+
+
+def run_ring(inserts, maxlen):
+    rows = make_rows(inserts)
+    table = []
+    start = time.perf_counter()
+    for row in rows:
+        table += [row]
+        if len(table) > maxlen:
+            table = table[int(maxlen / 2):]
+    list_time = time.perf_counter() - start
+
+    ring = KeyedTable(maxlen=maxlen)
+    start = time.perf_counter()
+    for row in rows:
+        ring += [row]
+    return list_time, time.perf_counter() - start
+
+
+def main():
+    random.seed(1)
+    print("%8s %8s %12s %12s %8s" % ('rows', 'updates', 'list [ms]', 'keyed [ms]', 'speedup'))
+    for count in [10, 100, 500, 2000, 10000]:
+        rows = make_rows(count)
+        burst = make_burst(count, 5000)
+        list_time = run_list(rows, burst)
+        keyed_time = run_keyed(rows, burst)
+        print("%8d %8d %12.2f %12.2f %7.1fx" % (count, len(burst), list_time * 1000, keyed_time * 1000,
+                                                list_time / keyed_time))
+
+    list_time, ring_time = run_ring(100000, 200)
+    print("capped inserts 100000: list %.2f ms, ring %.2f ms" % (list_time * 1000, ring_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Throughput benchmark of the MT5 wire protocol.
+# Encodes the 750 candle history push and an order table burst in text and binary mode and
+# counts the pipe writes, then decodes the binary frames with the reference decoder.
+#
+# Run from the repository root:
+#   python -m benchmarks.bench_wire
+import time
+from wire_protocol import MessageWriter, decode_frame
+
+
+class CountingPipe:
+    '''Stands in for NamedPipe and only counts writes.'''
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+        self.frames = []
+
+    def Send(self, pstring):
+        self.SendRaw(bytes(pstring, 'utf-8'))
+
+    def SendRaw(self, message):
+        self.writes += 1
+        self.bytes += 4 + len(message)
+        self.frames.append(message)
+
+
+def make_order(i):
+    return {'orderID': '6b2a0e4c-5a4d-4a8e-9d3b-%012d' % i, 'clOrdID': 'mt5-%d' % i, 'clOrdLinkID': '',
+            'account': 123456, 'symbol': 'XBTUSD', 'side': 'Buy' if i % 2 else 'Sell', 'orderQty': 100,
+            'price': 10000.5 + i, 'ordType': 'Limit', 'ordStatus': 'New', 'triggered': '', 'leavesQty': 100,
+            'text': 'Submitted via API.', 'transactTime': '2020-01-01T00:00:00.000Z'}
+
+
+def history(writer, bars):
+    for i in range(bars):
+        writer.Candle('XBTUSD', 1577836800 + i * 60, 10000.0, 10010.5, 9990.0, 10005.0, 1.5)
+    writer.Flush()
+
+
+def orders(writer, count):
+    writer.OrdersUpdate(count)
+    for i in range(count):
+        writer.Order(make_order(i))
+    writer.Flush()
+
+
+def measure(name, binary, job, size, repeat):
+    pipe = CountingPipe()
+    writer = MessageWriter(pipe, binary)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        job(writer, size)
+    elapsed = time.perf_counter() - start
+    records = repeat * size
+    print("%-8s %-6s %8.0f records/s %6d writes/push %8d bytes/push" %
+          (name, 'binary' if binary else 'text', records / elapsed, pipe.writes / repeat, pipe.bytes / repeat))
+    return pipe
+
+
+def main():
+    for name, job, size in (('history', history, 750), ('orders', orders, 300)):
+        measure(name, False, job, size, 200)
+        pipe = measure(name, True, job, size, 200)
+        start = time.perf_counter()
+        decoded = sum(len(decode_frame(frame)) for frame in pipe.frames)
+        elapsed = time.perf_counter() - start
+        print("%-8s decode %8.0f records/s" % (name, decoded / elapsed))
+
+
+if __name__ == '__main__':
+    main()
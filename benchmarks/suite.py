@@ -0,0 +1,217 @@
+# Benchmark suite of the ingest path on synthetic BitMEX traffic.
+# Every scenario feeds pre-generated frames through BitMEXWebsocket.process_message into a
+# MemoryPipe, which frames the messages like NamedPipe (4 byte length prefix) into memory.
+# Micro benchmarks cover the table store, the legacy findItemByKeys scan, the quote/candle/order formatting
+# and the pipe framing on their own.
+#
+# Results are JSON: messages/s and latency percentiles in ns per scenario, plus the per stage
+# breakdown of metrics.Metrics. Compare two runs to spot regressions:
+#
+# Run from the repository root:
+#   python -m benchmarks.suite [--quick] [--output results.json] [--compare baseline.json]
+import argparse
+import json
+import platform
+import sys
+import time
+from bitmex_websocket import BitMEXWebsocket
+from metrics import Histogram, Metrics
+from table_store import KeyedTable
+from wire_protocol import MessageWriter
+from benchmarks.bench_tables import findItemByKeys
+from benchmarks.synthetic import SyntheticFeed
+
+SYMBOLS = ('XBTUSD', 'ETHUSD', 'XRPUSD')
+# A result is reported as regression if it is this much slower than the baseline
+TOLERANCE = 0.10
+
+
+class MemoryPipe:
+    '''In-memory transport with the framing of NamedPipe.'''
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.messages = 0
+
+    def Send(self, pstring):
+        self.SendRaw(bytes(pstring, 'utf-8'))
+
+    def SendRaw(self, message):
+        self.buffer += len(message).to_bytes(4, byteorder='little', signed=False)
+        self.buffer += message
+        self.messages += 1
+
+    def Clear(self):
+        del self.buffer[:]
+        self.messages = 0
+
+
+def summary(histogram, count, elapsed):
+    result = histogram.summary()
+    result['mean'] = int(result['mean'])
+    result['msgs_per_sec'] = round(count / elapsed) if elapsed else 0
+    return result
+
+
+def make_websocket(pipe, binary=False, depth=0, metrics=None):
+    writer = MessageWriter(pipe, binary)
+    return BitMEXWebsocket(pipe, '', list(SYMBOLS), depth=depth, writer=writer, connect=False, metrics=metrics)
+
+
+# Scenarios: name -> (partial arguments, frame generator, order book depth)
+SCENARIOS = {
+    'quote_storm': (dict(), lambda feed, n: feed.quote_storm(n), 0),
+    'candles': (dict(), lambda feed, n: feed.candles(n), 0),
+    'order_churn': (dict(orders=500), lambda feed, n: feed.order_churn(n, 500), 0),
+    'l2_deltas': (dict(tables=('quote', 'tradeBin1m', 'order', 'orderBookL2'), levels=500),
+                  lambda feed, n: feed.l2_deltas(n), 10),
+    'mixed': (dict(tables=('quote', 'tradeBin1m', 'order', 'orderBookL2'), orders=200, levels=500),
+              lambda feed, n: feed.mixed(n), 10),
+}
+
+
+def run_scenario(name, count, binary):
+    partialArgs, generate, depth = SCENARIOS[name]
+    feed = SyntheticFeed(SYMBOLS)
+    partials = feed.partials(**partialArgs)
+    frames = generate(feed, count)
+
+    # Throughput and latency without instrumentation
+    pipe = MemoryPipe()
+    ws = make_websocket(pipe, binary, depth)
+    for message in partials:
+        ws.process_message(message)
+    pipe.Clear()
+    histogram = Histogram()
+    clock = time.perf_counter_ns
+    process = ws.process_message
+    start = time.perf_counter()
+    for message in frames:
+        begin = clock()
+        process(message)
+        histogram.record(clock() - begin)
+    elapsed = time.perf_counter() - start
+    result = summary(histogram, len(frames), elapsed)
+    result['pipe_messages'] = pipe.messages
+    result['pipe_bytes'] = len(pipe.buffer)
+
+    # Stage breakdown from a second, instrumented run
+    metrics = Metrics()
+    feed = SyntheticFeed(SYMBOLS)
+    partials = feed.partials(**partialArgs)
+    frames = generate(feed, count)
+    ws = make_websocket(MemoryPipe(), binary, depth, metrics)
+    for message in partials + frames:
+        ws.process_message(message)
+    stages = metrics.snapshot()['latency_ns']
+    result['stages'] = {key: {field: stages[key][field] for field in ('count', 'p50', 'p99')}
+                        for key in stages if not key.startswith('exchange:')}
+    return result
+
+
+def timed(count, job):
+    histogram = Histogram()
+    clock = time.perf_counter_ns
+    start = time.perf_counter()
+    for i in range(count):
+        begin = clock()
+        job(i)
+        histogram.record(clock() - begin)
+    return summary(histogram, count, time.perf_counter() - start)
+
+
+def run_micro(count):
+    results = {}
+    feed = SyntheticFeed(SYMBOLS)
+    orders = [json.loads(message)['data'][0] for message in feed.order_churn(500, 500)]
+    updates = [{'orderID': order['orderID'], 'leavesQty': 50} for order in orders]
+
+    table = KeyedTable(['orderID'])
+    table.extend(orders)
+    results['table_update'] = timed(count, lambda i: table.update(updates[i % len(updates)]))
+    rows = list(table)
+    results['findItemByKeys'] = timed(min(count, 20000),
+                                      lambda i: findItemByKeys(['orderID'], rows, updates[i % len(updates)]))
+
+    for binary in (False, True):
+        mode = 'binary' if binary else 'text'
+        pipe = MemoryPipe()
+        writer = MessageWriter(pipe, binary)
+
+        def quote(i):
+            writer.Quote('XBTUSD', 1577836800 + i, 10000.0 + i % 20, 10000.5 + i % 20)
+            writer.Flush()
+            pipe.Clear()
+
+        def candle(i):
+            writer.Candle('XBTUSD', 1577836800 + i * 60, 10000.0, 10010.5, 9990.0, 10005.0, 1.5)
+            writer.Flush()
+            pipe.Clear()
+
+        def order(i):
+            writer.Order(orders[i % len(orders)])
+            writer.Flush()
+            pipe.Clear()
+
+        results['format_quote_' + mode] = timed(count, quote)
+        results['format_candle_' + mode] = timed(count, candle)
+        results['format_order_' + mode] = timed(count, order)
+
+    pipe = MemoryPipe()
+    payload = b'qt,XBTUSD,1577836800,10000.0,10000.5'
+
+    def frame(i):
+        pipe.SendRaw(payload)
+        if len(pipe.buffer) > 1 << 20:
+            pipe.Clear()
+
+    results['pipe_framing'] = timed(count, frame)
+    return results
+
+
+def compare(results, baseline):
+    '''Benchmarks whose throughput dropped by more than TOLERANCE against the baseline.'''
+    regressions = []
+    for group in ('scenarios', 'micro'):
+        for name, result in results.get(group, {}).items():
+            old = baseline.get(group, {}).get(name)
+            if not old or not old.get('msgs_per_sec'):
+                continue
+            ratio = result['msgs_per_sec'] / old['msgs_per_sec']
+            if ratio < 1 - TOLERANCE:
+                regressions.append({'name': group + '.' + name, 'msgs_per_sec': result['msgs_per_sec'],
+                                    'baseline': old['msgs_per_sec'], 'ratio': round(ratio, 3)})
+    return regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Ingest benchmark suite on synthetic BitMEX traffic')
+    parser.add_argument('--quick', action='store_true', help='fewer messages per scenario')
+    parser.add_argument('--binary', action='store_true', help='use the binary wire protocol')
+    parser.add_argument('--only', help='comma separated scenarios to run')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    parser.add_argument('--compare', help='results of an earlier run to check for regressions')
+    options = parser.parse_args(args)
+
+    count = 5000 if options.quick else 50000
+    names = options.only.split(',') if options.only else list(SCENARIOS)
+    results = {'python': platform.python_version(), 'platform': platform.platform(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               'protocol': 'binary' if options.binary else 'text', 'messages': count,
+               'scenarios': {name: run_scenario(name, count, options.binary) for name in names},
+               'micro': run_micro(count)}
+    if options.compare:
+        with open(options.compare) as f:
+            results['regressions'] = compare(results, json.load(f))
+
+    output = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return 1 if results.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
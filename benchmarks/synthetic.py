@@ -0,0 +1,215 @@
+# Synthetic BitMEX websocket traffic for the benchmarks.
+# SyntheticFeed builds raw frames (JSON text, as they come off the socket) for quote storms,
+# tradeBin1m closes, order table churn and orderBookL2 deltas. Frames are generated up front
+# so the benchmarks only measure the bridge. A seed makes every run produce the same traffic.
+import json
+import random
+from fake_bitmex_server import bitmex_time
+
+START = 1577836800
+TICK = 0.5
+
+
+def level_id(price):
+    return int(88000000000 - price * 100)
+
+
+def frame(table, action, data, **fields):
+    message = {'table': table, 'action': action, 'data': data}
+    message.update(fields)
+    return json.dumps(message)
+
+
+class SyntheticFeed:
+
+    def __init__(self, symbols=('XBTUSD',), seed=1, start=START):
+        self.symbols = list(symbols)
+        self.random = random.Random(seed)
+        self.time = float(start)
+        self.mid = {symbol: 10000.0 + 1000.0 * i for i, symbol in enumerate(self.symbols)}
+        self.orders = {}
+        self.nextOrder = 0
+        self.levels = {}
+
+    def __now(self, step=0.001):
+        self.time += step
+        return bitmex_time(self.time)
+
+    def __move(self, symbol):
+        self.mid[symbol] += self.random.choice((-TICK, 0.0, 0.0, TICK))
+        return self.mid[symbol]
+
+    # Partials
+
+    def partials(self, tables=('quote', 'tradeBin1m', 'order'), orders=0, levels=0):
+        '''Partial of every table for every symbol, like the answer to the subscription.'''
+        frames = []
+        for symbol in self.symbols:
+            for table in tables:
+                if table == 'quote':
+                    data = [self.__quote(symbol)]
+                    keys = []
+                elif table == 'tradeBin1m':
+                    data = [self.__candle(symbol)]
+                    keys = []
+                elif table == 'order':
+                    data = [self.__new_order(symbol) for _ in range(orders)]
+                    keys = ['orderID']
+                elif table == 'orderBookL2':
+                    data = self.__book(symbol, levels)
+                    keys = ['symbol', 'id', 'side']
+                else:
+                    continue
+                frames.append(frame(table, 'partial', data, keys=keys, filter={'symbol': symbol}))
+        return frames
+
+    # Quotes
+
+    def __quote(self, symbol):
+        bid = self.__move(symbol)
+        return {'timestamp': self.__now(), 'symbol': symbol, 'bidSize': self.random.randrange(1, 100000),
+                'bidPrice': bid, 'askPrice': bid + TICK, 'askSize': self.random.randrange(1, 100000)}
+
+    def quote_storm(self, count, batch=1):
+        '''Quote inserts rotating over the symbols, batch quotes per frame. About half of the
+        quotes only change the sizes, as on the real feed.'''
+        frames = []
+        for i in range(count):
+            symbol = self.symbols[i % len(self.symbols)]
+            rows = []
+            for _ in range(batch):
+                rows.append(self.__quote(symbol))
+            frames.append(frame('quote', 'insert', rows))
+        return frames
+
+    # Candles
+
+    def __candle(self, symbol):
+        open = self.mid[symbol]
+        close = self.__move(symbol)
+        return {'timestamp': bitmex_time(int(self.time / 60) * 60 + 60), 'symbol': symbol, 'open': open,
+                'high': max(open, close) + TICK, 'low': min(open, close) - TICK, 'close': close,
+                'trades': self.random.randrange(1, 1000), 'volume': self.random.randrange(1, 10000000)}
+
+    def candles(self, count):
+        '''One closed tradeBin1m bar per symbol and minute.'''
+        frames = []
+        for i in range(count):
+            symbol = self.symbols[i % len(self.symbols)]
+            if i % len(self.symbols) == 0:
+                self.time += 60
+            frames.append(frame('tradeBin1m', 'insert', [self.__candle(symbol)]))
+        return frames
+
+    # Orders
+
+    def __new_order(self, symbol):
+        self.nextOrder += 1
+        side = self.random.choice(('Buy', 'Sell'))
+        price = self.mid[symbol] + (-1 if side == 'Buy' else 1) * TICK * self.random.randrange(1, 200)
+        order = {'orderID': '6b2a0e4c-5a4d-4a8e-9d3b-%012d' % self.nextOrder, 'clOrdID': 'mt5-%d' % self.nextOrder,
+                 'clOrdLinkID': '', 'account': 123456, 'symbol': symbol, 'side': side, 'orderQty': 100,
+                 'price': price, 'ordType': 'Limit', 'ordStatus': 'New', 'triggered': '', 'leavesQty': 100,
+                 'cumQty': 0, 'text': 'Submitted via API.', 'transactTime': self.__now(),
+                 'timestamp': bitmex_time(self.time)}
+        self.orders[order['orderID']] = order
+        return order
+
+    def order_churn(self, count, orders=500):
+        '''Inserts, amends, partial fills, fills and cancels that keep about orders live orders.'''
+        frames = []
+        for _ in range(count):
+            symbol = self.random.choice(self.symbols)
+            if len(self.orders) < orders or self.random.random() < 0.2:
+                frames.append(frame('order', 'insert', [dict(self.__new_order(symbol))]))
+                continue
+            orderID = self.random.choice(list(self.orders))
+            order = self.orders[orderID]
+            update = {'orderID': orderID, 'symbol': order['symbol'], 'timestamp': self.__now()}
+            kind = self.random.random()
+            if kind < 0.5:
+                order['price'] += TICK
+                update.update(price=order['price'], transactTime=update['timestamp'])
+            elif kind < 0.8:
+                fill = self.random.randrange(1, order['leavesQty'] + 1)
+                order['leavesQty'] -= fill
+                order['cumQty'] += fill
+                order['ordStatus'] = 'PartiallyFilled' if order['leavesQty'] else 'Filled'
+                update.update(leavesQty=order['leavesQty'], cumQty=order['cumQty'], ordStatus=order['ordStatus'])
+            else:
+                order['leavesQty'] = 0
+                order['ordStatus'] = 'Canceled'
+                update.update(leavesQty=0, ordStatus='Canceled', text='Canceled: Canceled via API.')
+            if not order['leavesQty']:
+                del self.orders[orderID]
+            frames.append(frame('order', 'update', [update]))
+        return frames
+
+    # Order book
+
+    def __book(self, symbol, levels):
+        book = self.levels.setdefault(symbol, {})
+        book.clear()
+        rows = []
+        mid = self.mid[symbol]
+        for i in range(1, levels + 1):
+            for side, price in (('Buy', mid - i * TICK), ('Sell', mid + i * TICK)):
+                book[level_id(price)] = (side, price)
+                rows.append({'symbol': symbol, 'id': level_id(price), 'side': side,
+                             'size': self.random.randrange(1, 100000), 'price': price})
+        return rows
+
+    def l2_deltas(self, count, batch=3):
+        '''Size updates, inserts and deletes of levels near the touch, batch rows per frame.'''
+        frames = []
+        for i in range(count):
+            symbol = self.symbols[i % len(self.symbols)]
+            book = self.levels.setdefault(symbol, {})
+            kind = self.random.random()
+            rows = {}
+            mid = self.mid[symbol]
+            for _ in range(batch):
+                side = self.random.choice(('Buy', 'Sell'))
+                price = mid + (-1 if side == 'Buy' else 1) * TICK * self.random.randrange(1, 25)
+                id = level_id(price)
+                rows[id] = {'symbol': symbol, 'id': id, 'side': side, 'size': self.random.randrange(1, 100000),
+                            'price': price, 'timestamp': self.__now()}
+            rows = list(rows.values())
+            if kind < 0.7:
+                action = 'update'
+                rows = [row for row in rows if row['id'] in book]
+                for row in rows:
+                    del row['price']
+            elif kind < 0.85:
+                action = 'insert'
+                rows = [row for row in rows if row['id'] not in book]
+                for row in rows:
+                    book[row['id']] = (row['side'], row['price'])
+            else:
+                action = 'delete'
+                rows = [{'symbol': row['symbol'], 'id': row['id'], 'side': row['side'], 'timestamp': row['timestamp']}
+                        for row in rows if row['id'] in book]
+                for row in rows:
+                    del book[row['id']]
+            if rows:
+                frames.append(frame('orderBookL2', action, rows))
+        return frames
+
+    def mixed(self, count, orders=200):
+        '''Traffic mix of a busy market: mostly L2 deltas and quotes, some order churn and
+        a candle per symbol every 60 seconds of feed time.'''
+        frames = []
+        lastMinute = int(self.time / 60)
+        for _ in range(count):
+            kind = self.random.random()
+            if kind < 0.6:
+                frames += self.l2_deltas(1)
+            elif kind < 0.95:
+                frames += self.quote_storm(1)
+            else:
+                frames += self.order_churn(1, orders)
+            if int(self.time / 60) != lastMinute:
+                lastMinute = int(self.time / 60)
+                for symbol in self.symbols:
+                    frames.append(frame('tradeBin1m', 'insert', [self.__candle(symbol)]))
+        return frames
@@ -0,0 +1,203 @@
+import calendar
+import http.client
+import json
+import queue
+import select
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+from util.api_key import generate_signature
+
+# Small signed REST client for the BitMEX endpoints the bridge uses.
+# Replaces the bravado based bitmex client: there is no Swagger spec to load on start and no
+# model layer per call, requests are plain JSON over a pool of keep-alive connections.
+#
+# Every call returns (result, headers), result is the decoded JSON body and headers the
+# response headers with lower case names (x-ratelimit-* for the rate limit).
+# Errors raise RestError with the HTTP status and the headers of the response.
+#
+# A keep-alive connection the server closed while it was idle is detected before the request
+# is written and replaced. A connection that breaks later is retried only when the request
+# was not completely written or the verb is idempotent: a POST whose response was lost may
+# have placed the order, sending it again would place it twice.
+
+LIVE_URL = "https://www.bitmex.com/api/v1"
+TEST_URL = "https://testnet.bitmex.com/api/v1"
+
+# Seconds a signed request stays valid
+EXPIRES = 5
+# Requests that may be sent again when their response was lost
+IDEMPOTENT = ('GET', 'PUT', 'DELETE')
+
+
+class RestError(Exception):
+    def __init__(self, status, message, headers=None):
+        Exception.__init__(self, "HTTP {}: {}".format(status, message))
+        self.status_code = status
+        self.headers = headers or {}
+
+
+def parse_timestamp(timestamp):
+    '''BitMEX ISO 8601 time (2020-01-01T00:00:00.000Z) to unix seconds.'''
+    seconds = calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                               int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19])))
+    if len(timestamp) > 20 and timestamp[19] == '.':
+        seconds += int(timestamp[20:23]) / 1000.0
+    return seconds
+
+
+def _query_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return str(value)
+
+
+class BitmexClient:
+
+    def __init__(self, test=True, api_key=None, api_secret=None, baseUrl=None, poolSize=4, timeout=10):
+        self.baseUrl = baseUrl or (TEST_URL if test else LIVE_URL)
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.timeout = timeout
+        url = urllib.parse.urlparse(self.baseUrl)
+        self.__https = url.scheme == 'https'
+        self.__host = url.hostname
+        self.__port = url.port
+        self.__basePath = url.path.rstrip('/')
+        self.__pool = queue.LifoQueue()
+        self.__poolSize = poolSize
+        self.__created = 0
+        self.__lock = threading.Lock()
+
+    # Endpoints
+
+    def Instrument_get(self, **params):
+        return self.request('GET', '/instrument', params)
+
+    def Trade_getBucketed(self, **params):
+        return self.request('GET', '/trade/bucketed', params)
+
+    def Order_newBulk(self, orders):
+        return self.request('POST', '/order/bulk', body={'orders': self.__list(orders)})
+
+    def Order_amendBulk(self, orders):
+        return self.request('PUT', '/order/bulk', body={'orders': self.__list(orders)})
+
+    def Order_cancel(self, orderID=None, clOrdID=None, text=None):
+        body = {}
+        if orderID is not None:
+            body['orderID'] = self.__list(orderID)
+        if clOrdID is not None:
+            body['clOrdID'] = self.__list(clOrdID)
+        if text is not None:
+            body['text'] = text
+        return self.request('DELETE', '/order', body=body)
+
+    def __list(self, value):
+        '''Accept lists or JSON strings like the bravado client did.'''
+        if isinstance(value, str):
+            value = json.loads(value) if value[:1] in ('[', '{') else [value]
+        return value
+
+    # Connection pool
+
+    def __connection(self):
+        try:
+            return self.__pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self.__lock:
+            if self.__created < self.__poolSize:
+                self.__created += 1
+                return self.__new_connection()
+        return self.__pool.get()
+
+    def __new_connection(self):
+        if self.__https:
+            return http.client.HTTPSConnection(self.__host, self.__port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.__host, self.__port, timeout=self.timeout)
+
+    def __release(self, connection):
+        self.__pool.put(connection)
+
+    def close(self):
+        '''Close the idle connections of the pool.'''
+        while True:
+            try:
+                self.__pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def __drop_stale(self, connection):
+        '''Close the connection if the server closed it while it was idle in the pool. An idle
+        keep-alive socket has nothing to read, unless the server sent its close (EOF).'''
+        sock = connection.sock
+        if sock is None:
+            return
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            readable = True
+        if readable:
+            connection.close()
+
+    # Requests
+
+    def __headers(self, verb, path, body):
+        headers = {'content-type': 'application/json', 'accept': 'application/json', 'connection': 'keep-alive'}
+        if self.api_key:
+            expires = int(time.time()) + EXPIRES
+            headers['api-expires'] = str(expires)
+            headers['api-key'] = self.api_key
+            headers['api-signature'] = generate_signature(self.api_secret, verb, path, expires, body)
+        return headers
+
+    def request(self, verb, endpoint, params=None, body=None):
+        '''Send a signed request. Returns (result, headers).'''
+        path = self.__basePath + endpoint
+        if params:
+            path += '?' + urllib.parse.urlencode({key: _query_value(value) for key, value in params.items()
+                                                  if value is not None})
+        data = json.dumps(body, separators=(',', ':')) if body is not None else ''
+        headers = self.__headers(verb, path, data)
+
+        connection = self.__connection()
+        try:
+            for attempt in range(2):
+                self.__drop_stale(connection)
+                sent = False
+                try:
+                    connection.request(verb, path, body=data or None, headers=headers)
+                    sent = True
+                    response = connection.getresponse()
+                    payload = response.read()
+                    break
+                except (BrokenPipeError, ConnectionResetError):
+                    # RemoteDisconnected is a ConnectionResetError too. The connection is
+                    # reopened on the retry, but only if the request can't have been executed.
+                    connection.close()
+                    if attempt or (sent and verb not in IDEMPOTENT):
+                        raise
+                except:
+                    connection.close()
+                    raise
+        finally:
+            self.__release(connection)
+
+        responseHeaders = {key.lower(): value for key, value in response.getheaders()}
+        try:
+            result = json.loads(payload) if payload else None
+        except ValueError:
+            # Gateway errors come as html
+            result = None
+            if response.status < 400:
+                raise RestError(response.status, "invalid JSON response", responseHeaders)
+        if response.status >= 400:
+            message = result.get('error', {}).get('message', '') if isinstance(result, dict) else payload[:200]
+            raise RestError(response.status, message, responseHeaders)
+        return result, responseHeaders
@@ -1,62 +1,140 @@
 # Bitmex history download
 import time
-import bitmex
-from NamedPipe import NamedPipe
+from concurrent.futures import ThreadPoolExecutor
+from wire_protocol import MessageWriter
+from candle_cache import CandleCache, missing_ranges
+from order_pipeline import OrderPipeline, RateLimit
+from bitmex_client import BitmexClient, parse_timestamp
 from datetime import datetime
 
 baseUrl = "https://www.bitmex.com/api/v1"
 granularity = "1m"
 requestBars = 750
+# Max bars BitMEX returns for one Trade_getBucketed request
+pageBars = 1000
+# Concurrent history requests and request budget per minute
+historyWorkers = 4
+requestsPerMinute = 60
+# Requests of the budget the history download (and the gap fills) leave to the orders
+historyReserve = 10
+# Order requests that may run at the same time
+ordersInFlight = 4
 
 class BitmexRestAPI:
-    def __init__(self, pipe_price, pipe_order , TestServer, api_key, api_secret):
+    def __init__(self, pipe_price, pipe_order , TestServer, api_key, api_secret, writer=None, cacheDir=None, cache=None,
+                 restUrl=None):
         self.__pipe_price = pipe_price
+        self.__writer = writer if writer is not None else MessageWriter(pipe_price)
         self.__pipe_order = pipe_order
-        self.client = bitmex.bitmex(test=TestServer, api_key=api_key, api_secret=api_secret)
+        # One budget for history and orders, they share the API key
+        self.rateLimit = RateLimit(requestsPerMinute)
+        # cache can be any store with last_timestamp/read/append/merge, e.g. a CandleStore
+        self.cache = cache
+        if self.cache is None and cacheDir:
+            self.cache = CandleCache(cacheDir, granularity)
+        # Keep enough keep-alive connections for the concurrent history and order requests
+        self.client = BitmexClient(test=TestServer, api_key=api_key, api_secret=api_secret, baseUrl=restUrl,
+                                   poolSize=historyWorkers + ordersInFlight)
 
-    def DownloadHistory(self, pair):
+    def DownloadHistory(self, pair, bars=requestBars):
         # Get current time
         try:
-            response = self.client.Instrument.Instrument_get(symbol=pair, count=1, reverse=False).result()
+            self.rateLimit.take(historyReserve)
+            response = self.client.Instrument_get(symbol=pair, count=1, reverse=False)
         except Exception as e:
-            print("Error in history request:" + e)
+            self.rateLimit.update(getattr(e, 'headers', None), getattr(e, 'status_code', None))
+            print("Error in history request:" + str(e))
             return False
+        self.rateLimit.update(response[1])
 
-        # calculate history start time 
-        timestamp = response[0][0]['timestamp'].timestamp()
-        timestamp = (int(timestamp/60) * 60) - ((requestBars - 100) * 60)    
-        startTime = datetime.utcfromtimestamp(timestamp) 
-        # Download last 750 bars
-        try:
-            response = self.client.Trade.Trade_getBucketed(binSize=granularity,partial=False,symbol=pair,count=requestBars ,reverse=False, startTime=startTime).result()
-        except Exception as e:
-            print("Error in history request:" + e)
-            return False
+        # calculate history range, bucket timestamps are the close of the bin
+        timestamp = parse_timestamp(response[0][0]['timestamp'])
+        endTime = int(timestamp/60) * 60
+        startTime = endTime - (bars - 1) * 60
 
-        for candle in response[0]:
-            timestamp = candle['timestamp'].timestamp()
-            timestamp = int(timestamp/60) * 60 - 60
+        # Only the bins missing in the cache have to be downloaded: the head before the cached
+        # ones (e.g. after bars was raised), gaps inside and the tail up to now
+        candles = []
+        missing = [(startTime, endTime)]
+        if self.cache is not None:
+            candles = self.cache.read(pair, startTime, endTime)
+            missing = missing_ranges(candles, startTime, endTime)
+
+        fetched = []
+        for fetchFrom, fetchTo in missing:
+            page = self.FetchCandles(pair, fetchFrom, fetchTo)
+            if page is None:
+                return False
+            fetched += page
+        if fetched:
+            if self.cache is not None:
+                self.cache.merge(pair, fetched)
+            merged = {candle['timestamp']: candle for candle in fetched}
+            merged.update((candle['timestamp'], candle) for candle in candles)
+            candles = [merged[timestamp] for timestamp in sorted(merged)]
+
+        for candle in candles:
+            timestamp = int(candle['timestamp']/60) * 60 - 60
             volume = int(candle['volume'])/100000 + 1
-            self.__pipe_price.Send("cndl,{},{},{},{},{},{},{}".format(pair,timestamp,candle['open'],candle['high'],candle['low'],candle['close'],volume))
+            self.__writer.Candle(pair,timestamp,candle['open'],candle['high'],candle['low'],candle['close'],volume)
+        self.__writer.Flush()
 
         return True
 
-    def RestForward(self):
+    def FetchCandles(self, pair, startTime, endTime):
+        '''Download the complete bins between startTime and endTime (unix seconds, inclusive).
+        The range is split in pages that are fetched concurrently. Returns the candles sorted by
+        time with the timestamp in unix seconds or None on error.'''
+        if startTime > endTime:
+            return []
+        pages = list(range(startTime, endTime + 1, pageBars * 60))
+        with ThreadPoolExecutor(max_workers=historyWorkers) as executor:
+            results = list(executor.map(lambda pageStart: self.__fetch_page(pair, pageStart, endTime), pages))
+        if None in results:
+            return None
+
+        candles = []
+        for page in results:
+            for candle in page:
+                if candles and candle['timestamp'] <= candles[-1]['timestamp']:
+                    continue
+                candles.append(candle)
+        return candles
+
+    def __fetch_page(self, pair, pageStart, endTime):
+        count = min(pageBars, int((endTime - pageStart) / 60) + 1)
+        for attempt in range(3):
+            self.rateLimit.take(historyReserve)
+            try:
+                response = self.client.Trade_getBucketed(binSize=granularity,partial=False,symbol=pair,count=count,reverse=False,
+                                                         startTime=datetime.utcfromtimestamp(pageStart))
+                break
+            except Exception as e:
+                self.rateLimit.update(getattr(e, 'headers', None), getattr(e, 'status_code', None))
+                print("Error in history request:" + str(e))
+                time.sleep(2 ** attempt)
+        else:
+            return None
+        self.rateLimit.update(response[1])
+        return [{'timestamp': int(parse_timestamp(candle['timestamp'])), 'open': candle['open'], 'high': candle['high'],
+                 'low': candle['low'], 'close': candle['close'], 'volume': candle['volume']}
+                for candle in response[0]]
+
+    def RestForward(self, account=None):
+        # Order commands go through the pipeline, it answers on the order pipe.
+        # Position, margin, execution and order queries are answered from account (the websocket).
+        pipeline = OrderPipeline(self.client, self.__pipe_order, maxInFlight=ordersInFlight, account=account,
+                                 rateLimit=self.rateLimit)
         while True:
             # read message from pipe
             message = self.__pipe_order.Receive()
+            if not message:
+                # pipe error or closed, don't spin on it
+                time.sleep(0.5)
+                continue
             message = message.replace('\x00','')
             try:
-                split  = message.split(',',1)
-            except:
-                time.sleep(0.5)
-                continue;
-            cmd = split[0]
-            data = split[1]
-
-            if(cmd == 'order'):
-                # send rest request with the orders
-                try:
-                    result = self.client.Order.Order_newBulk(orders = data).result()
-                except Exception as e:
-                    print("Order exception:" + e)
\ No newline at end of file
+                pipeline.Submit(message)
+            except Exception as e:
+                # A bad command must not end the thread, later orders would be dropped
+                print("Error in order command:" + str(e))
@@ -7,8 +7,15 @@ import json
 import logging
 import urllib
 import math
+import random
+from collections import deque
 from util.api_key import generate_nonce, generate_signature
-from NamedPipe import NamedPipe
+from table_store import KeyedTable
+from order_book import OrderBook
+from order_tracker import OrderTracker
+from bar_aggregator import BarAggregator
+from wire_protocol import MessageWriter, format_order, POSITION_FIELDS, MARGIN_FIELDS
+from bitmex_client import parse_timestamp
 
 # Naive implementation of connecting to BitMEX websocket for streaming realtime data.
 # The Marketmaker still interacts with this as if it were a REST Endpoint, but now it can get
@@ -23,16 +30,66 @@ class BitMEXWebsocket:
     # Don't grow a table larger than this amount. Helps cap memory usage.
     MAX_TABLE_LEN = 200
 
-    def __init__(self, namedpipe, endpoint, symbol, api_key=None, api_secret=None):
-        '''Connect to the websocket and initialize data stores.'''
+    # Reconnect backoff in seconds. The delay doubles with every failed attempt and is reset
+    # once a connection stayed up for STABLE_CONNECTION seconds.
+    RECONNECT_MIN_DELAY = 0.25
+    RECONNECT_MAX_DELAY = 30
+    STABLE_CONNECTION = 60
+    # Keepalive pings detect dead connections that never get a close frame
+    PING_INTERVAL = 15
+    PING_TIMEOUT = 10
+
+    def __init__(self, namedpipe, endpoint, symbol, api_key=None, api_secret=None, depth=0, writer=None,
+                 connect=True, candleStore=None, orderSnapshotInterval=0, metrics=None, recorder=None,
+                 gapFill=None, barIntervals=None):
+        '''Connect to the websocket and initialize data stores.
+        symbol is a single symbol or a list of symbols that share the connection.
+        With depth > 0 the L2 order book is subscribed and the top depth levels are sent
+        to the pipe every time they change. writer encodes the messages for the pipe,
+        by default the text protocol is used. namedpipe and writer can also be dicts by symbol
+        to route every symbol to its own pipe. With connect=False only the data stores are
+        set up and messages can be fed through process_message, or connect() is called later. Closed tradeBin1m bars are
+        appended to candleStore if one is given. Orders are sent when they change, with
+        orderSnapshotInterval > 0 the whole order table is resent every that many seconds.
+        With a metrics.Metrics the latency of every processing stage is recorded by table.
+        Raw frames from the connection are passed to recorder (a FeedRecorder) if one is given.
+        The connection is reestablished when it drops. Closed 1m bins missed in the meantime
+        are loaded with gapFill(symbol, startTime, endTime), e.g. BitmexRestAPI.FetchCandles,
+        on a worker while the other tables keep flowing, and sent before the bins of the new
+        connection, which wait for them. With barIntervals (seconds) the
+        trade table is subscribed and bars of those intervals are built locally and streamed
+        while they form.'''
         self.logger = logging.getLogger(__name__)
 
         self.logger.debug("Initializing WebSocket.")
         self.endpoint = endpoint
-        self.symbol = symbol
+        self.symbols = [symbol] if isinstance(symbol, str) else list(symbol)
+        self.symbol = self.symbols[0]
         self.pipe = namedpipe
-        self.lastBid = 0.0
-        self.lastAsk = 0.0
+        if isinstance(writer, dict):
+            self.writers = dict(writer)
+        elif isinstance(namedpipe, dict):
+            self.writers = {sym: MessageWriter(namedpipe[sym]) for sym in self.symbols}
+        else:
+            writer = writer if writer is not None else MessageWriter(namedpipe)
+            self.writers = {sym: writer for sym in self.symbols}
+        self.writer = self.writers[self.symbol]
+        self.candleStore = candleStore
+        self.metrics = metrics
+        self.recorder = recorder
+        self.gapFill = gapFill
+        # Close time of the last tradeBin1m bin sent for every symbol
+        self.lastCandles = {}
+        # Live bins by symbol held back while its gap is loaded, and the loaded gaps
+        self.__gapFills = {}
+        self.__filledGaps = deque()
+        self.reconnects = 0
+        self.orderTracker = OrderTracker(orderSnapshotInterval)
+        # Last bid/ask sent for every symbol
+        self.lastQuotes = {}
+        self.depth = depth
+        self.orderBooks = {sym: OrderBook(sym, depth) for sym in self.symbols} if depth > 0 else {}
+        self.barAggregator = BarAggregator(barIntervals) if barIntervals else None
 
         if api_key is not None and api_secret is None:
             raise ValueError('api_secret is required if api_key is provided')
@@ -46,16 +103,40 @@ class BitMEXWebsocket:
         self.keys = {}
         self.exited = False
 
+        # Tables subscribed for every symbol. We wait for their partials before starting.
+        self.marketTables = ["quote","tradeBin1m"]
+        if self.orderBooks:
+            self.marketTables.append("orderBookL2")
+        if self.barAggregator is not None:
+            self.marketTables.append("trade")
+        self.accountTables = ["order"]
+        # Subscriptions that are not scoped by symbol
+        self.genericTables = []
+        if api_key:
+            self.accountTables += ["position", "execution"]
+            self.genericTables.append("margin")
+        # Last position / margin values sent, by table and row keys
+        self.__accountSent = {}
+        self.__partials = set()
+        self.__partialsReady = threading.Condition()
+
+        if connect:
+            self.connect()
+
+    def connect(self):
+        '''Connect and wait for the partials of the subscribed tables. Blocks until they are
+        there, other threads can use the object meanwhile (query() answers once the table
+        has its partial).'''
         # We can subscribe right in the connection querystring, so let's build that.
         # Subscribe to all pertinent endpoints
-        wsURL = self.__get_url()
+        wsURL = self._get_url()
         self.logger.info("Connecting to %s" % wsURL)
-        self.__connect(wsURL, symbol)
+        self.__connect(wsURL, self.symbol)
         self.logger.info('Connected to WS.')
 
         # Connected. Wait for partials
-        self.__wait_for_symbol(symbol)
-        if api_key:
+        self.__wait_for_symbol(self.symbol)
+        if self.api_key:
             self.__wait_for_account()
         self.logger.info('Got all market data. Starting.')
 
@@ -68,29 +149,64 @@ class BitMEXWebsocket:
         '''Connect to the websocket in a thread.'''
         self.logger.debug("Starting thread")
 
-        self.ws = websocket.WebSocketApp(wsURL,
-                                         on_message=self.__on_message,
-                                         on_close=self.__on_close,
-                                         on_open=self.__on_open,
-                                         on_error=self.__on_error,
-                                         header=self.__get_auth())
-
-        self.wst = threading.Thread(target=lambda: self.ws.run_forever())
+        self.ws = self.__new_app(wsURL)
+        self.wst = threading.Thread(target=self.__run_forever)
         self.wst.daemon = True
         self.wst.start()
         self.logger.debug("Started thread")
 
         # Wait for connect before continuing
-        conn_timeout = 5
-        while not self.ws.sock or not self.ws.sock.connected and conn_timeout:
-            time.sleep(1)
+        conn_timeout = 50
+        while (not self.ws.sock or not self.ws.sock.connected) and conn_timeout:
+            time.sleep(0.1)
             conn_timeout -= 1
         if not conn_timeout:
             self.logger.error("Couldn't connect to WS! Exiting.")
             self.exit()
             raise websocket.WebSocketTimeoutException('Couldn\'t connect to WS! Exiting.')
 
-    def __get_auth(self):
+    def __new_app(self, wsURL):
+        # Auth headers carry a nonce, every connection needs new ones
+        return websocket.WebSocketApp(wsURL,
+                                      on_message=self.__on_message,
+                                      on_close=self.__on_close,
+                                      on_open=self.__on_open,
+                                      on_error=self.__on_error,
+                                      on_pong=self.__on_pong,
+                                      header=self._get_auth())
+
+    def __run_forever(self):
+        '''Run the connection and reconnect with a jittered backoff until exit() is called.'''
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                self.ws.run_forever(ping_interval=self.PING_INTERVAL, ping_timeout=self.PING_TIMEOUT)
+            except:
+                self.logger.error(traceback.format_exc())
+            if self.exited:
+                return
+            if time.monotonic() - started >= self.STABLE_CONNECTION:
+                attempt = 0
+            delay = self._reconnect_delay(attempt)
+            attempt += 1
+            self.logger.warning("Websocket disconnected, reconnecting in %.2f s" % delay)
+            time.sleep(delay)
+            if self.exited:
+                return
+            self.__reset_partials()
+            self.reconnects += 1
+            if self.metrics is not None:
+                self.metrics.incr('reconnects')
+            self.ws = self.__new_app(self._get_url())
+
+    def _reconnect_delay(self, attempt):
+        '''Seconds to wait before reconnect attempt number attempt (0 based).'''
+        delay = min(self.RECONNECT_MAX_DELAY, self.RECONNECT_MIN_DELAY * 2 ** attempt)
+        # Jitter so many bridges don't hit the exchange at the same moment after an outage
+        return delay * random.uniform(0.5, 1.0)
+
+    def _get_auth(self):
         '''Return auth headers. Will use API Keys if present in settings.'''
         if self.api_key:
             self.logger.info("Authenticating with API Key.")
@@ -106,7 +222,7 @@ class BitMEXWebsocket:
             self.logger.info("Not authenticating.")
             return []
 
-    def __get_url(self):
+    def _get_url(self):
         '''
         Generate a connection URL. We can define subscriptions right in the querystring.
         Most subscription topics are scoped by the symbol we're listening to.
@@ -116,8 +232,9 @@ class BitMEXWebsocket:
         #symbolSubs = ["execution", "instrument", "order", "orderBookL2", "position", "quote", "trade"]
         #genericSubs = ["margin"]
 
-        symbolSubs = ["quote","tradeBin1m","order"]
-        subscriptions = [sub + ':' + self.symbol for sub in symbolSubs]
+        symbolSubs = self.marketTables + self.accountTables
+        subscriptions = [sub + ':' + symbol for symbol in self.symbols for sub in symbolSubs]
+        subscriptions += self.genericTables
 
         urlParts = list(urllib.parse.urlparse(self.endpoint))
         urlParts[0] = urlParts[0].replace('http', 'ws')
@@ -127,14 +244,31 @@ class BitMEXWebsocket:
 
     def __wait_for_account(self):
         '''On subscribe, this data will come down. Wait for it.'''
-        # Wait for the keys to show up from the ws
-        while not {'margin', 'position', 'order', 'orderBookL2'} <= set(self.data):
-            time.sleep(0.1)
+        # Wait for the partials to show up from the ws
+        with self.__partialsReady:
+            self.__partialsReady.wait_for(lambda: self.__subscriptions(self.accountTables + self.genericTables)
+                                          <= self.__partials)
 
     def __wait_for_symbol(self, symbol):
         '''On subscribe, this data will come down. Wait for it.'''
-        while not {'instrument', 'trade', 'quote'} <= set(self.data):
-            time.sleep(0.1)
+        with self.__partialsReady:
+            self.__partialsReady.wait_for(lambda: self.__subscriptions(self.marketTables) <= self.__partials)
+
+    def __reset_partials(self):
+        '''Forget the partials of the old connection, the new one sends its own.'''
+        with self.__partialsReady:
+            self.__partials.clear()
+
+    def __subscriptions(self, tables):
+        return {(table, symbol) for table in tables for symbol in self.symbols}
+
+    def _table_ready(self, table, symbol=None):
+        '''Called when the partial of a table has been applied. BitMEX sends one partial per
+        subscription, symbol is None when the partial covers all symbols.'''
+        with self.__partialsReady:
+            for sym in (self.symbols if symbol is None else [symbol]):
+                self.__partials.add((table, sym))
+            self.__partialsReady.notify_all()
 
     def __send_command(self, command, args=None):
         '''Send a raw command.'''
@@ -142,6 +276,13 @@ class BitMEXWebsocket:
             args = []
         self.ws.send(json.dumps({"op": command, "args": args}))
 
+    def __new_table(self, table, keys):
+        '''Create the store for a table. Limit the max length of the table to avoid excessive
+        memory usage. Don't trim orders or account state because we'll lose valuable state if we do.'''
+        if table in ['order', 'orderBookL2', 'position', 'margin']:
+            return KeyedTable(keys)
+        return KeyedTable(keys, maxlen=BitMEXWebsocket.MAX_TABLE_LEN)
+
     def __update_tables(self, message, table, action):
         try:
             if 'subscribe' in message:
@@ -149,7 +290,7 @@ class BitMEXWebsocket:
             elif action:
 
                 if table not in self.data:
-                    self.data[table] = []
+                    self.data[table] = self.__new_table(table, self.keys.get(table))
 
                 # There are four possible actions from the WS:
                 # 'partial' - full table image
@@ -158,27 +299,30 @@ class BitMEXWebsocket:
                 # 'delete'  - delete row
                 if action == 'partial':
                     self.logger.debug("%s: partial" % table)
-                    self.data[table] += message['data']
                     # Keys are communicated on partials to let you know how to uniquely identify
-                    # an item. We use it for updates.
+                    # an item. We use them to index the table for updates.
                     self.keys[table] = message['keys']
+                    # Every subscription gets its own partial. Only replace the rows of the
+                    # symbol it is filtered on, the other symbols share the table.
+                    symbol = message.get('filter', {}).get('symbol')
+                    if symbol is not None and len(self.data[table]) > 0:
+                        self.data[table].remove_where('symbol', symbol)
+                    else:
+                        self.data[table] = self.__new_table(table, message['keys'])
+                    self.data[table] += message['data']
+                    self._table_ready(table, symbol)
                 elif action == 'insert':
                     self.logger.debug('%s: inserting %s' % (table, message['data']))
+                    # Capped tables are rings and drop their oldest rows by themselves.
                     self.data[table] += message['data']
 
-                    # Limit the max length of the table to avoid excessive memory usage.
-                    # Don't trim orders because we'll lose valuable state if we do.
-                    if table not in ['order', 'orderBookL2'] and len(self.data[table]) > BitMEXWebsocket.MAX_TABLE_LEN:
-                        self.data[table] = self.data[table][int(BitMEXWebsocket.MAX_TABLE_LEN / 2):]
-
                 elif action == 'update':
                     self.logger.debug('%s: updating %s' % (table, message['data']))
                     # Locate the item in the collection and update it.
                     for updateData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], updateData)
+                        item = self.data[table].update(updateData)
                         if not item:
-                            return  # No item found to update. Could happen before push
-                        item.update(updateData)
+                            continue  # No item found to update. Could happen before push
                         # Remove cancelled / filled orders moved after message is send
                         #if table == 'order' and item['leavesQty'] <= 0:
                         #    self.data[table].remove(item)
@@ -186,8 +330,7 @@ class BitMEXWebsocket:
                     self.logger.debug('%s: deleting %s' % (table, message['data']))
                     # Locate the item in the collection and remove it.
                     for deleteData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], deleteData)
-                        self.data[table].remove(item)
+                        self.data[table].remove(deleteData)
                 else:
                     raise Exception("Unknown action: %s" % action)
         except:
@@ -195,91 +338,351 @@ class BitMEXWebsocket:
 
     def __on_message(self, ws, message):
         '''Handler for parsing WS messages.'''
-        # display message before processing
+        if self.recorder is not None:
+            self.recorder.record(message)
+        self.process_message(message)
+
+    def process_message(self, message):
+        '''Decode a raw WS message, apply it to the tables and send the changes to the pipe.'''
+        metrics = self.metrics
+        if metrics is not None:
+            received = time.perf_counter_ns()
+            receivedWall = time.time_ns()
+            size = len(message)
+
+        if self.__filledGaps:
+            self.__publish_gap_fills()
 
         message = json.loads(message)
-        self.logger.debug(json.dumps(message))
+        # display message before processing
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(json.dumps(message))
 
         table = message['table'] if 'table' in message else None
         action = message['action'] if 'action' in message else None
-
-        self.__update_tables(message, table, action)
-
+        if metrics is not None:
+            decoded = time.perf_counter_ns()
+
+        # The order book keeps its own price ladders, don't copy L2 rows into the tables.
+        if(table == 'orderBookL2'):
+            self.__update_book(message, action)
+            if metrics is not None:
+                applied = published = time.perf_counter_ns()
+        else:
+            self.__update_tables(message, table, action)
+            if metrics is not None:
+                applied = time.perf_counter_ns()
+            self.__publish(message, table, action)
+            if metrics is not None:
+                published = time.perf_counter_ns()
+        self.__snapshot_if_due()
+        for writer in set(self.writers.values()):
+            writer.Flush()
+
+        if metrics is not None:
+            flushed = time.perf_counter_ns()
+            name = table or 'control'
+            metrics.incr('messages')
+            metrics.incr('bytes', size)
+            metrics.record('decode', name, decoded - received)
+            metrics.record('apply', name, applied - decoded)
+            metrics.record('publish', name, published - applied)
+            metrics.record('flush', name, flushed - published)
+            metrics.record('total', name, flushed - received)
+            self.__record_exchange_latency(message, name, receivedWall)
+
+    def __record_exchange_latency(self, message, table, receivedWall):
+        '''Time from the exchange timestamp of the last row to the receipt of the frame.
+        Includes the clock offset to BitMEX, negative values are recorded as 0.'''
+        data = message.get('data')
+        if not data or message.get('action') == 'partial':
+            return
+        timestamp = data[-1].get('timestamp')
+        if not isinstance(timestamp, str):
+            return
+        try:
+            exchangeTime = int(parse_timestamp(timestamp) * 1000) * 1000000
+        except ValueError:
+            return
+        self.metrics.record('exchange', table, receivedWall - exchangeTime)
+
+    def __writer_for(self, symbol):
+        return self.writers.get(symbol, self.writer)
+
+    def __latest_by_symbol(self, message):
+        '''Last row of the message for every symbol.'''
+        rows = {}
+        for row in message.get('data', []):
+            rows[row.get('symbol')] = row
+        return rows
+
+    def __publish(self, message, table, action):
+        '''Send the rows of a table that changed to the pipe.'''
         if(table == 'quote'):
-            quote = self.data['quote'][-1]
-            bid = float(quote['bidPrice'])
-            ask = float(quote['askPrice'])
-            if(bid != self.lastBid or ask != self.lastAsk):
-                self.lastBid = bid 
-                self.lastAsk = ask
-                timestrct =  time.strptime(quote['timestamp'], '%Y-%m-%dT%H:%M:%S.%fZ')
-                timestamp = int(calendar.timegm(timestrct))
-                self.pipe.Send("qt,{},{},{},{}".format(self.symbol,timestamp,bid,ask))
-                self.logger.debug("Quote - symbol:{} time:{} bid:{} ask:{}".format(self.symbol,quote['timestamp'],bid,ask))
+            for symbol, quote in self.__latest_by_symbol(message).items():
+                bid = float(quote['bidPrice'])
+                ask = float(quote['askPrice'])
+                if self.barAggregator is not None:
+                    # Quotes keep coming when there are no trades, they close the due bars
+                    self.barAggregator.advance(symbol, parse_timestamp(quote['timestamp']))
+                    self.__publish_bars()
+                if((bid, ask) != self.lastQuotes.get(symbol)):
+                    self.lastQuotes[symbol] = (bid, ask)
+                    timestrct =  time.strptime(quote['timestamp'], '%Y-%m-%dT%H:%M:%S.%fZ')
+                    timestamp = int(calendar.timegm(timestrct))
+                    self.__writer_for(symbol).Quote(symbol,timestamp,bid,ask)
+                    self.logger.debug("Quote - symbol:{} time:{} bid:{} ask:{}".format(symbol,quote['timestamp'],bid,ask))
         elif(table == 'tradeBin1m'):
-            candle = self.data['tradeBin1m'][-1]
-            timestrct = time.strptime(candle['timestamp'], '%Y-%m-%dT%H:%M:%S.%fZ')
-            timestamp = int(calendar.timegm(timestrct))
-            timestamp = int(timestamp/60) * 60 - 60
-            volume = int(candle['volume'])/100000 + 1
-            self.pipe.Send("cndl,{},{},{},{},{},{},{}".format(self.symbol,timestamp,candle['open'],candle['high'],candle['low'],candle['close'],volume))
-            self.logger.debug("Candle - symbol:{} time:{} open:{} high:{} low:{} close:{} volume:{}".format(self.symbol,candle['timestamp'],candle['open'],candle['high'],candle['low'],candle['close'],volume))
+            for symbol, candle in self.__latest_by_symbol(message).items():
+                timestrct = time.strptime(candle['timestamp'], '%Y-%m-%dT%H:%M:%S.%fZ')
+                timestamp = int(calendar.timegm(timestrct))
+                self.__publish_candle(symbol, timestamp, candle)
+        elif(table == 'trade'):
+            # The partial repeats trades from before the subscription, bars start with live trades
+            if self.barAggregator is not None and action == 'insert':
+                for trade in message['data']:
+                    self.barAggregator.add(trade['symbol'], parse_timestamp(trade['timestamp']), trade['price'], trade['size'])
+                self.__publish_bars()
         elif(table=='order'):
-            orders = self.data['order']
-            if(len(orders) > 0):
-                self.pipe.Send("ordersupdt,{}".format(len(orders)))
-                self.logger.info('----------------Orders----------------')
-                remove_items = []
-                for order in orders:
-                    fmsg = "ordrtbl,{},{},{},{},{},{},{},{},{},{},{},{},{},{}".format(  order['orderID'],
-                                                                                        order['clOrdID'],
-                                                                                        order['clOrdLinkID'],
-                                                                                        order['account'],
-                                                                                        order['symbol'],
-                                                                                        order['side'],
-                                                                                        order['orderQty'],
-                                                                                        order['price'],
-                                                                                        order['ordType'],
-                                                                                        order['ordStatus'],
-                                                                                        order['triggered'],
-                                                                                        order['leavesQty'],
-                                                                                        order['text'],
-                                                                                        order['transactTime'])
-                    self.pipe.Send(fmsg)
-                    self.logger.info(fmsg)
-                    if (order['leavesQty'] <= 0):
-                        remove_items.append(order)
-                #Remove cancelled / filled orders
-                for item in remove_items:
-                    self.data['order'].remove(item)
+            # The rows of a delete are gone from the table already, a snapshot tells MT5 to drop them
+            if(action in ['partial', 'delete']):
+                self.send_order_snapshot()
+            elif(action in ['insert', 'update']):
+                self.__publish_orders(message)
+        elif(table in ['position', 'margin']):
+            self.__publish_account(message, table, action)
+
+    def __publish_account(self, message, table, action):
+        '''Send the positions / margins of the message whose PnL or size changed.'''
+        if action == 'partial':
+            self.__accountSent = {key: value for key, value in self.__accountSent.items() if key[0] != table}
+            rows = list(self.data[table])
+        elif action in ['insert', 'update']:
+            rows = [row for row in (self.data[table].find(data) for data in message['data']) if row is not None]
+        else:
+            return
+        fields = POSITION_FIELDS if table == 'position' else MARGIN_FIELDS
+        for row in rows:
+            key = (table,) + tuple(row.get(k) for k in self.data[table].keys)
+            values = tuple(row.get(field) for field in fields)
+            if self.__accountSent.get(key) == values:
+                continue
+            self.__accountSent[key] = values
+            if table == 'position':
+                self.__writer_for(row['symbol']).Position(*values)
+            else:
+                for writer in set(self.writers.values()):
+                    writer.Margin(*values)
+
+    def query(self, table, filter=None):
+        '''Rows of an account table (order, position, margin, execution) that match all fields
+        of filter, as copies. Safe to call from other threads. filter may contain count to get
+        only the latest rows.'''
+        if table not in self.accountTables + self.genericTables:
+            raise ValueError("not subscribed: %s" % table)
+        if table not in self.data:
+            raise ValueError("no data yet: %s" % table)
+        filter = dict(filter or {})
+        count = filter.pop('count', None)
+        if count is not None:
+            try:
+                count = int(count)
+            except (TypeError, ValueError):
+                raise ValueError("count must be a number: %s" % (count,))
+        # One copy of the live rows, the websocket thread changes the table meanwhile
+        rows = [dict(row) for row in list(self.data[table])
+                if all(row.get(field) == value for field, value in filter.items())]
+        if count is not None:
+            rows = rows[-count:] if count > 0 else []
+        return rows
+
+    def __send_candle(self, symbol, timestamp, candle):
+        '''Send a closed 1m bin, timestamp is the close time in unix seconds.'''
+        if self.candleStore is not None:
+            self.candleStore.append_candle(symbol,timestamp,candle['open'],candle['high'],candle['low'],candle['close'],candle['volume'])
+        self.lastCandles[symbol] = timestamp
+        # MT5 bars are stamped with their open time
+        openTime = int(timestamp/60) * 60 - 60
+        volume = int(candle['volume'])/100000 + 1
+        self.__writer_for(symbol).Candle(symbol,openTime,candle['open'],candle['high'],candle['low'],candle['close'],volume)
+
+    def __publish_bars(self):
+        '''Send the bars that closed and the latest state of the forming bars.'''
+        closed, forming = self.barAggregator.drain()
+        for symbol, interval, bar in closed:
+            self.__writer_for(symbol).Bar(symbol,interval,bar.start,bar.open,bar.high,bar.low,bar.close,bar.volume,True)
+        for symbol, interval, bar in forming:
+            self.__writer_for(symbol).Bar(symbol,interval,bar.start,bar.open,bar.high,bar.low,bar.close,bar.volume,False)
+
+    def __reconcile_bar(self, symbol, timestamp, candle):
+        '''Close the local 1m bar of the exchange bin (timestamp is its close) and resend it
+        with the exchange values if they differ.'''
+        self.barAggregator.advance(symbol, timestamp)
+        self.__publish_bars()
+        bar = self.barAggregator.reconcile(symbol, timestamp - 60, candle['open'], candle['high'], candle['low'],
+                                           candle['close'], candle['volume'])
+        if bar is not None:
+            self.logger.debug("Bar of %s at %s corrected from tradeBin1m" % (symbol, bar.start))
+            self.__writer_for(symbol).Bar(symbol,60,bar.start,bar.open,bar.high,bar.low,bar.close,bar.volume,True)
+
+    def __publish_candle(self, symbol, timestamp, candle, fillGap=True):
+        '''Send a live tradeBin1m bin, timestamp is its close time in unix seconds. Bins missed
+        before it are loaded first, the bins of the symbol wait until they are sent.'''
+        queued = self.__gapFills.get(symbol)
+        if queued is not None:
+            queued.append((timestamp, candle))
+            return
+        lastCandle = self.lastCandles.get(symbol)
+        if lastCandle is not None:
+            if timestamp <= lastCandle:
+                return  # Already sent, the partial after a reconnect repeats the last bin
+            if timestamp - lastCandle > 60:
+                if fillGap and self.gapFill is not None:
+                    self.logger.info("Filling tradeBin1m gap of %s from %s to %s" % (symbol, lastCandle + 60, timestamp - 60))
+                    self.__gapFills[symbol] = [(timestamp, candle)]
+                    self._start_gap_fill(symbol, lastCandle + 60, timestamp - 60)
+                    return
+                self.logger.warning("Missed tradeBin1m bins of %s between %s and %s" % (symbol, lastCandle + 60, timestamp - 60))
+        self.__send_candle(symbol, timestamp, candle)
+        self.logger.debug("Candle - symbol:{} time:{} open:{} high:{} low:{} close:{} volume:{}".format(symbol,candle['timestamp'],candle['open'],candle['high'],candle['low'],candle['close'],candle['volume']))
+        if self.barAggregator is not None:
+            self.__reconcile_bar(symbol, timestamp, candle)
+
+    def _start_gap_fill(self, symbol, startTime, endTime):
+        '''Load the missed bins on a worker thread, the websocket keeps processing meanwhile.'''
+        thread = threading.Thread(target=self._run_gap_fill, args=(symbol, startTime, endTime), name='gap-fill')
+        thread.daemon = True
+        thread.start()
+
+    def _run_gap_fill(self, symbol, startTime, endTime):
+        '''Runs on the worker. The result is sent by the next message or heartbeat.'''
+        try:
+            candles = self.gapFill(symbol, startTime, endTime)
+        except:
+            self.logger.error(traceback.format_exc())
+            candles = None
+        self.__filledGaps.append((symbol, startTime, endTime, candles))
+
+    def __publish_gap_fills(self):
+        '''Send the loaded gaps and then the live bins held back for them. Returns True if
+        a gap was done.'''
+        done = False
+        while self.__filledGaps:
+            symbol, startTime, endTime, candles = self.__filledGaps.popleft()
+            done = True
+            if candles is None:
+                self.logger.error("tradeBin1m gap fill of %s failed" % symbol)
+            else:
+                for candle in candles:
+                    if startTime <= candle['timestamp'] <= endTime and candle['timestamp'] > self.lastCandles.get(symbol, 0):
+                        self.__send_candle(symbol, int(candle['timestamp']), candle)
+            # A failed fill is not retried, the bins that waited go out after the gap
+            for timestamp, candle in self.__gapFills.pop(symbol, []):
+                self.__publish_candle(symbol, timestamp, candle, fillGap=False)
+        return done
+
+    def __publish_orders(self, message):
+        '''Send only the orders of the message that changed since they were last sent.'''
+        orders = []
+        for row in message['data']:
+            order = self.data['order'].find(row)
+            if order is not None:
+                orders.append(order)
+        remove_items = []
+        for order in self.orderTracker.changed(orders):
+            self.__writer_for(order['symbol']).Order(order)
+            self.logger.debug(format_order(order))
+            if self.orderTracker.is_terminal(order):
+                remove_items.append(order)
+        #Remove cancelled / filled orders
+        for item in remove_items:
+            self.data['order'].remove(item)
+            self.orderTracker.forget(item['orderID'])
+
+    def heartbeat(self):
+        '''Periodic work that must not wait for a message, e.g. the order snapshot of a quiet
+        account or a loaded candle gap. Call it on the thread that processes the messages.'''
+        sent = self.__publish_gap_fills()
+        if self.__snapshot_if_due() or sent:
+            for writer in set(self.writers.values()):
+                writer.Flush()
+
+    def __snapshot_if_due(self):
+        if 'order' in self.data and self.orderTracker.snapshot_due():
+            self.send_order_snapshot()
+            return True
+        return False
+
+    def send_order_snapshot(self):
+        '''Send the whole order table, MT5 replaces its order list with it. Every pipe gets
+        the count, also when it has no orders, so MT5 drops orders that are gone.'''
+        if 'order' not in self.data:
+            return
+        # Every pipe gets the orders of the symbols routed to it
+        tables = {writer: [] for writer in set(self.writers.values())}
+        for order in self.data['order']:
+            tables.setdefault(self.__writer_for(order['symbol']), []).append(order)
+        self.logger.debug('Order snapshot')
+        remove_items = []
+        for writer, orders in tables.items():
+            writer.OrdersUpdate(len(orders))
+            for order in orders:
+                writer.Order(order)
+                self.logger.debug(format_order(order))
+                if self.orderTracker.is_terminal(order):
+                    remove_items.append(order)
+        #Remove cancelled / filled orders
+        for item in remove_items:
+            self.data['order'].remove(item)
+        self.orderTracker.snapshot(self.data['order'])
+
+    def __update_book(self, message, action):
+        '''Apply an orderBookL2 delta and send the top levels of every book that changed.'''
+        if not self.orderBooks or not action:
+            return
+        rows = {}
+        for row in message['data']:
+            rows.setdefault(row['symbol'], []).append(row)
+        if action == 'partial':
+            # An empty partial still resets the book of the subscription
+            symbol = message.get('filter', {}).get('symbol')
+            if symbol is not None:
+                rows.setdefault(symbol, [])
+        for symbol, symbolRows in rows.items():
+            orderBook = self.orderBooks.get(symbol)
+            if orderBook is None:
+                continue
+            try:
+                changed = orderBook.apply(action, symbolRows)
+            except:
+                self.logger.error(traceback.format_exc())
+                continue
+            if action == 'partial':
+                self._table_ready('orderBookL2', symbol)
+            if(changed):
+                bids, asks = orderBook.top()
+                if orderBook.timestamp:
+                    timestrct = time.strptime(orderBook.timestamp, '%Y-%m-%dT%H:%M:%S.%fZ')
+                    timestamp = int(calendar.timegm(timestrct))
+                else:
+                    timestamp = int(time.time())
+                self.__writer_for(symbol).Depth(symbol,timestamp,bids,asks)
 
     def __on_error(self, ws, error):
-        '''Called on fatal websocket errors. We exit on these.'''
+        '''Called on websocket errors. The connection is closed and reestablished after them.'''
         if not self.exited:
             self.logger.error("Error : %s" % error)
-            raise websocket.WebSocketException(error)
 
     def __on_open(self, ws):
         '''Called when the WS opens.'''
         self.logger.debug("Websocket Opened.")
+        if self.metrics is not None:
+            self.metrics.incr('connects')
 
-    def __on_close(self, ws):
+    def __on_pong(self, ws, data):
+        '''Called on the connection thread every PING_INTERVAL, drives the heartbeat.'''
+        self.heartbeat()
+
+    def __on_close(self, ws, *args):
         '''Called on websocket close.'''
         self.logger.info('Websocket Closed')
-
-
-# Utility method for finding an item in the store.
-# When an update comes through on the websocket, we need to figure out which item in the array it is
-# in order to match that item.
-#
-# Helpfully, on a data push (or on an HTTP hit to /api/v1/schema), we have a "keys" array. These are the
-# fields we can use to uniquely identify an item. Sometimes there is more than one, so we iterate through all
-# provided keys.
-def findItemByKeys(keys, table, matchData):
-    for item in table:
-        matched = True
-        for key in keys:
-            if item[key] != matchData[key]:
-                matched = False
-        if matched:
-            return item
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+import traceback
+import websockets
+from bitmex_websocket import BitMEXWebsocket
+
+# asyncio version of BitMEXWebsocket.
+# It keeps the same tables, order book and pipe messages, but the socket is read by a task on
+# the event loop: every frame is decoded and dispatched right where it is received, without
+# handing it over to another thread, and the partials are awaited instead of polled. Other
+# coroutines (REST forwarding, pipe writing) can run on the same loop. A dropped connection is
+# reestablished with the same backoff as the threaded client until close() is called.
+#
+#   ws = AsyncBitMEXWebsocket(namedpipe=pipe, endpoint=url, symbol='XBTUSD')
+#   await ws.connect()
+#   await ws.wait_closed()
+class AsyncBitMEXWebsocket(BitMEXWebsocket):
+
+    # Seconds to wait for the websocket handshake
+    CONNECT_TIMEOUT = 5
+
+    def __init__(self, namedpipe, endpoint, symbol, api_key=None, api_secret=None, depth=0, writer=None,
+                 candleStore=None, orderSnapshotInterval=0, metrics=None, recorder=None, gapFill=None,
+                 barIntervals=None):
+        '''Initialize the data stores. Call connect() from the event loop to start.'''
+        super().__init__(namedpipe, endpoint, symbol, api_key=api_key, api_secret=api_secret, depth=depth,
+                         writer=writer, connect=False, candleStore=candleStore,
+                         orderSnapshotInterval=orderSnapshotInterval, metrics=metrics,
+                         recorder=recorder, gapFill=gapFill, barIntervals=barIntervals)
+        self.logger = logging.getLogger(__name__)
+        self.ws = None
+        self.__reader = None
+        self.__heartbeat = None
+        self.__ready = {}
+
+    def __event(self, table, symbol):
+        if (table, symbol) not in self.__ready:
+            self.__ready[(table, symbol)] = asyncio.Event()
+        return self.__ready[(table, symbol)]
+
+    def _table_ready(self, table, symbol=None):
+        super()._table_ready(table, symbol)
+        for sym in (self.symbols if symbol is None else [symbol]):
+            self.__event(table, sym).set()
+
+    async def connect(self):
+        '''Connect, start reading and wait for the partials of the subscribed tables.'''
+        await self.__open()
+        self.__reader = asyncio.ensure_future(self.__run())
+        self.__heartbeat = asyncio.ensure_future(self.__beat())
+
+        await self.wait_for_tables(self.marketTables)
+        if self.api_key:
+            await self.wait_for_tables(self.accountTables + self.genericTables)
+        self.logger.info('Got all market data. Starting.')
+
+    async def __open(self):
+        wsURL = self._get_url()
+        self.logger.info("Connecting to %s" % wsURL)
+        # Auth headers carry a nonce, every connection needs new ones
+        headers = [tuple(part.strip() for part in header.split(':', 1)) for header in self._get_auth()]
+        self.ws = await websockets.connect(wsURL, additional_headers=headers, open_timeout=self.CONNECT_TIMEOUT,
+                                           max_size=None)
+        self.logger.info('Connected to WS.')
+        if self.metrics is not None:
+            self.metrics.incr('connects')
+
+    async def wait_for_tables(self, tables, timeout=None):
+        '''Wait until the partials of the tables have been applied for all symbols.'''
+        events = [self.__event(table, symbol).wait() for table in tables for symbol in self.symbols]
+        await asyncio.wait_for(asyncio.gather(*events), timeout)
+
+    async def __run(self):
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                async for message in self.ws:
+                    if self.recorder is not None:
+                        self.recorder.record(message)
+                    try:
+                        self.process_message(message)
+                    except Exception:
+                        # A bad message must not end the reader, like in the threaded client
+                        self.logger.error(traceback.format_exc())
+            except websockets.ConnectionClosed as e:
+                if not self.exited:
+                    self.logger.error("Error : %s" % e)
+            self.logger.info('Websocket Closed')
+            if self.exited:
+                return
+
+            if time.monotonic() - started >= self.STABLE_CONNECTION:
+                attempt = 0
+            delay = self._reconnect_delay(attempt)
+            attempt += 1
+            self.logger.warning("Websocket disconnected, reconnecting in %.2f s" % delay)
+            await asyncio.sleep(delay)
+            if self.exited:
+                return
+            try:
+                await self.__open()
+            except Exception as e:
+                # The old, closed connection ends the next read right away and we back off again
+                self.logger.error("Reconnect failed: %s" % e)
+                continue
+            self.reconnects += 1
+            if self.metrics is not None:
+                self.metrics.incr('reconnects')
+
+    def _start_gap_fill(self, symbol, startTime, endTime):
+        '''Load the missed bins in the loop's executor, send them as soon as they are there.'''
+        future = asyncio.get_running_loop().run_in_executor(None, self._run_gap_fill, symbol, startTime, endTime)
+        future.add_done_callback(lambda future: self.heartbeat())
+
+    async def __beat(self):
+        '''Call heartbeat() on the loop every PING_INTERVAL, like the pongs of the threaded client.'''
+        while not self.exited:
+            await asyncio.sleep(self.PING_INTERVAL)
+            try:
+                self.heartbeat()
+            except Exception:
+                self.logger.error(traceback.format_exc())
+
+    async def wait_closed(self):
+        '''Wait until the connection is closed for good by close().'''
+        if self.__reader is not None:
+            await self.__reader
+
+    async def close(self):
+        '''Close the websocket and stop reading.'''
+        self.exited = True
+        if self.__heartbeat is not None:
+            self.__heartbeat.cancel()
+        if self.ws is not None:
+            await self.ws.close()
+        await self.wait_closed()
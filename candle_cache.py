@@ -0,0 +1,116 @@
+import os
+import struct
+import threading
+
+# On-disk cache of downloaded 1m candles.
+# One file per symbol with fixed size records, sorted by time, appended to and only rewritten
+# when older candles are merged in. The timestamp is
+# the BitMEX bucket time in unix seconds (the close of the bin), volume is in contracts.
+# Only complete bins are stored, so a restart only has to fetch the bins that are missing in
+# the requested range (see missing_ranges).
+
+RECORD = struct.Struct('<qddddd')
+FIELDS = ['open', 'high', 'low', 'close', 'volume']
+NAN = float('nan')
+
+
+def missing_ranges(candles, start, end, step=60):
+    '''(first, last) timestamp ranges of the bins between start and end that are not in
+    candles (sorted by time): the head before the cache, gaps inside it and the tail.'''
+    ranges = []
+    expected = start
+    for candle in candles:
+        timestamp = candle['timestamp']
+        if timestamp < start or timestamp > end:
+            continue
+        if timestamp > expected:
+            ranges.append((expected, timestamp - step))
+        expected = max(expected, timestamp + step)
+    if expected <= end:
+        ranges.append((expected, end))
+    return ranges
+
+
+class CandleCache:
+
+    def __init__(self, directory, binSize='1m'):
+        self.directory = directory
+        self.binSize = binSize
+        self.__lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, symbol):
+        return os.path.join(self.directory, '{}_{}.bin'.format(symbol, self.binSize))
+
+    def last_timestamp(self, symbol):
+        '''Time of the newest cached candle or None.'''
+        try:
+            with open(self.path(symbol), 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell() - f.tell() % RECORD.size
+                if size == 0:
+                    return None
+                f.seek(size - RECORD.size)
+                return RECORD.unpack(f.read(RECORD.size))[0]
+        except FileNotFoundError:
+            return None
+
+    def read(self, symbol, start=None, end=None):
+        '''Cached candles with start <= timestamp <= end as dicts.'''
+        try:
+            with open(self.path(symbol), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        candles = []
+        for record in RECORD.iter_unpack(data[:len(data) - len(data) % RECORD.size]):
+            timestamp = record[0]
+            if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+                continue
+            candle = dict(zip(FIELDS, record[1:]))
+            candle['timestamp'] = timestamp
+            candles.append(candle)
+        return candles
+
+    def __pack(self, candle):
+        return RECORD.pack(candle['timestamp'], *[NAN if candle[field] is None else candle[field] for field in FIELDS])
+
+    def append(self, symbol, candles):
+        '''Append candles sorted by time. Candles not newer than the cache are skipped.'''
+        with self.__lock:
+            self.__append(symbol, candles)
+
+    def __append(self, symbol, candles):
+        last = self.last_timestamp(symbol)
+        records = bytearray()
+        for candle in candles:
+            if last is not None and candle['timestamp'] <= last:
+                continue
+            last = candle['timestamp']
+            records += self.__pack(candle)
+        if records:
+            with open(self.path(symbol), 'ab') as f:
+                # Drop a record that was only partly written before a crash
+                size = f.tell()
+                if size % RECORD.size:
+                    f.truncate(size - size % RECORD.size)
+                f.write(records)
+
+    def merge(self, symbol, candles):
+        '''Add candles of any time, e.g. older than the cache or inside a gap. Cached candles
+        are kept. Appends when all candles are newer, otherwise the file is rewritten.'''
+        if not candles:
+            return
+        candles = sorted(candles, key=lambda candle: candle['timestamp'])
+        with self.__lock:
+            last = self.last_timestamp(symbol)
+            if last is None or candles[0]['timestamp'] > last:
+                self.__append(symbol, candles)
+                return
+            merged = {candle['timestamp']: candle for candle in candles}
+            merged.update((candle['timestamp'], candle) for candle in self.read(symbol))
+            tmpPath = self.path(symbol) + '.tmp'
+            with open(tmpPath, 'wb') as f:
+                for timestamp in sorted(merged):
+                    f.write(self.__pack(merged[timestamp]))
+            os.replace(tmpPath, self.path(symbol))
@@ -0,0 +1,221 @@
+import os
+import threading
+import numpy as np
+
+# Persistent OHLCV store backed by memory mapped NumPy arrays.
+# Every symbol has one file holding the columns timestamp, open, high, low, close and volume
+# one after the other, each preallocated to the capacity of the file:
+#
+#   header (8 x int64: magic, version, capacity, length) | timestamp[capacity] | open[capacity] | ...
+#
+# When the file is full it is rewritten with twice the capacity, merging in older candles
+# rewrites it too. Readers get zero-copy views
+# of the columns, so long histories can be read and resampled without copying them or asking
+# BitMEX again.
+#
+# Timestamps are BitMEX bucket times in unix seconds, the close of the bin, and volume is in
+# contracts, like in CandleCache. The store has the same last_timestamp/read/append/merge methods
+# so it can be used as the history cache of BitmexRestAPI.
+
+MAGIC = 0x53435842  # 'BXCS'
+VERSION = 1
+HEADER_SIZE = 64
+COLUMNS = ['timestamp', 'open', 'high', 'low', 'close', 'volume']
+DTYPES = {'timestamp': np.dtype('<i8'), 'open': np.dtype('<f8'), 'high': np.dtype('<f8'),
+          'low': np.dtype('<f8'), 'close': np.dtype('<f8'), 'volume': np.dtype('<f8')}
+INITIAL_CAPACITY = 4096
+
+# Resampling periods by name
+PERIODS = {'1m': 60, '5m': 300, '15m': 900, '1h': 3600, '4h': 14400, '1d': 86400}
+
+
+class CandleSeries:
+    '''Memory mapped candles of one symbol.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        if not os.path.exists(path):
+            self.__create(path, INITIAL_CAPACITY)
+        self.__map()
+
+    def __create(self, path, capacity):
+        size = HEADER_SIZE + capacity * 8 * len(COLUMNS)
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        mm = np.memmap(path, dtype=np.uint8, mode='r+', shape=(size,))
+        header = mm[:HEADER_SIZE].view('<i8')
+        header[:4] = [MAGIC, VERSION, capacity, 0]
+        mm.flush()
+        del mm
+
+    def __map(self):
+        self.__mm = np.memmap(self.path, dtype=np.uint8, mode='r+')
+        self.__header = self.__mm[:HEADER_SIZE].view('<i8')
+        if self.__header[0] != MAGIC or self.__header[1] != VERSION:
+            raise Exception("Not a candle store file: %s" % self.path)
+        self.capacity = int(self.__header[2])
+        self.__columns = {}
+        offset = HEADER_SIZE
+        for name in COLUMNS:
+            self.__columns[name] = self.__mm[offset:offset + self.capacity * 8].view(DTYPES[name])
+            offset += self.capacity * 8
+
+    def __len__(self):
+        return int(self.__header[3])
+
+    def __grow(self, needed):
+        '''Rewrite the file with enough room for needed rows.'''
+        length = len(self)
+        self.__rewrite({name: self.__columns[name][:length] for name in COLUMNS}, needed)
+
+    def __rewrite(self, columns, needed):
+        '''Replace the file with the given columns and room for needed rows.'''
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        length = len(columns['timestamp'])
+        tmpPath = self.path + '.tmp'
+        self.__create(tmpPath, capacity)
+        mm = np.memmap(tmpPath, dtype=np.uint8, mode='r+')
+        offset = HEADER_SIZE
+        for name in COLUMNS:
+            mm[offset:offset + capacity * 8].view(DTYPES[name])[:length] = columns[name]
+            offset += capacity * 8
+        mm[:HEADER_SIZE].view('<i8')[3] = length
+        mm.flush()
+        del mm
+        self.__mm.flush()
+        os.replace(tmpPath, self.path)
+        self.__map()
+
+    def column(self, name):
+        '''Zero-copy view of a column.'''
+        return self.__columns[name][:len(self)]
+
+    def append(self, timestamps, open, high, low, close, volume):
+        '''Append columns of candles sorted by time. Rows not newer than the last stored
+        candle are skipped. Returns the number of rows appended.'''
+        timestamps = np.asarray(timestamps, dtype=DTYPES['timestamp'])
+        with self.__lock:
+            return self.__append(timestamps, open, high, low, close, volume)
+
+    def __append(self, timestamps, open, high, low, close, volume):
+        length = len(self)
+        start = 0
+        if length:
+            start = int(np.searchsorted(timestamps, self.__columns['timestamp'][length - 1], side='right'))
+        count = len(timestamps) - start
+        if count <= 0:
+            return 0
+        if length + count > self.capacity:
+            self.__grow(length + count)
+        for name, values in zip(COLUMNS, (timestamps, open, high, low, close, volume)):
+            self.__columns[name][length:length + count] = np.asarray(values, dtype=DTYPES[name])[start:]
+        # Make the rows visible only after they are written
+        self.__header[3] = length + count
+        return count
+
+    def merge(self, timestamps, open, high, low, close, volume):
+        '''Add candles of any time, e.g. older than the stored ones or inside a gap. Stored
+        candles are kept. Appends when all rows are newer, otherwise the file is rewritten.'''
+        timestamps = np.asarray(timestamps, dtype=DTYPES['timestamp'])
+        if len(timestamps) == 0:
+            return 0
+        order = np.argsort(timestamps, kind='stable')
+        values = [timestamps[order]] + [np.asarray(column, dtype=DTYPES[name])[order]
+                                        for name, column in zip(COLUMNS[1:], (open, high, low, close, volume))]
+        with self.__lock:
+            length = len(self)
+            if length == 0 or values[0][0] > self.__columns['timestamp'][length - 1]:
+                return self.__append(*values)
+            # Stored rows first, np.unique keeps the first row of every timestamp
+            combined = {name: np.concatenate((self.__columns[name][:length], column))
+                        for name, column in zip(COLUMNS, values)}
+            _, first = np.unique(combined['timestamp'], return_index=True)
+            self.__rewrite({name: column[first] for name, column in combined.items()}, len(first))
+            return len(first) - length
+
+    def flush(self):
+        self.__mm.flush()
+
+    def range(self, start=None, end=None):
+        '''Zero-copy views of the candles with start <= timestamp <= end.'''
+        timestamps = self.column('timestamp')
+        first = 0 if start is None else int(np.searchsorted(timestamps, start, side='left'))
+        last = len(timestamps) if end is None else int(np.searchsorted(timestamps, end, side='right'))
+        return {name: self.column(name)[first:last] for name in COLUMNS}
+
+    def resample(self, period, start=None, end=None):
+        '''Aggregate the 1m candles into bars of period seconds (or a name from PERIODS).
+        Bars are labelled with their close time like the BitMEX bins.'''
+        if isinstance(period, str):
+            period = PERIODS[period]
+        candles = self.range(start, end)
+        timestamps = candles['timestamp']
+        if len(timestamps) == 0:
+            return {name: np.empty(0, dtype=DTYPES[name]) for name in COLUMNS}
+        buckets = (timestamps + (period - 1)) // period
+        starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+        ends = np.concatenate((starts[1:], [len(timestamps)])) - 1
+        return {
+            'timestamp': buckets[starts] * period,
+            'open': candles['open'][starts],
+            'high': np.maximum.reduceat(candles['high'], starts),
+            'low': np.minimum.reduceat(candles['low'], starts),
+            'close': candles['close'][ends],
+            'volume': np.add.reduceat(candles['volume'], starts),
+        }
+
+
+class CandleStore:
+    '''Directory of memory mapped candle series, one file per symbol.'''
+
+    def __init__(self, directory, binSize='1m'):
+        self.directory = directory
+        self.binSize = binSize
+        self.__series = {}
+        self.__lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def series(self, symbol):
+        with self.__lock:
+            if symbol not in self.__series:
+                path = os.path.join(self.directory, '{}_{}.npc'.format(symbol, self.binSize))
+                self.__series[symbol] = CandleSeries(path)
+            return self.__series[symbol]
+
+    def last_timestamp(self, symbol):
+        timestamps = self.series(symbol).column('timestamp')
+        return int(timestamps[-1]) if len(timestamps) else None
+
+    def read(self, symbol, start=None, end=None):
+        '''Candles with start <= timestamp <= end as dicts.'''
+        candles = self.series(symbol).range(start, end)
+        columns = [candles[name].tolist() for name in COLUMNS]
+        return [dict(zip(COLUMNS, row)) for row in zip(*columns)]
+
+    def append(self, symbol, candles):
+        '''Append candle dicts sorted by time.'''
+        if not candles:
+            return 0
+        columns = [[np.nan if candle[name] is None else candle[name] for candle in candles] for name in COLUMNS]
+        return self.series(symbol).append(*columns)
+
+    def merge(self, symbol, candles):
+        '''Add candle dicts of any time, see CandleSeries.merge.'''
+        if not candles:
+            return 0
+        columns = [[np.nan if candle[name] is None else candle[name] for candle in candles] for name in COLUMNS]
+        return self.series(symbol).merge(*columns)
+
+    def append_candle(self, symbol, timestamp, open, high, low, close, volume):
+        return self.series(symbol).append([timestamp], [open], [high], [low], [close], [volume])
+
+    def resample(self, symbol, period, start=None, end=None):
+        return self.series(symbol).resample(period, start, end)
+
+    def flush(self):
+        with self.__lock:
+            for series in self.__series.values():
+                series.flush()
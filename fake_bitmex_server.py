@@ -0,0 +1,133 @@
+import asyncio
+import json
+import logging
+import sys
+import time
+import urllib.parse
+import websockets
+
+# Local stand-in for the BitMEX realtime API.
+# Accepts websocket connections on /realtime?subscribe=..., answers the subscriptions like
+# BitMEX does and then replays a script of partial/insert/update/delete frames. Used to run
+# the websocket ingest offline and measure its throughput and latency.
+#
+#   server = FakeBitmexServer(script)
+#   await server.start()
+#   ws = AsyncBitMEXWebsocket(namedpipe=pipe, endpoint=server.endpoint, symbol='XBTUSD')
+#
+# A script is a list of frames (dicts or already encoded strings), or a function of the
+# connection number that returns one. drop() disconnects the clients. With interval=None the
+# frames are sent as fast as possible, otherwise with interval seconds between them.
+# With stamp=True every dict frame gets a "sent" field with time.perf_counter_ns() so the
+# receiver can measure latency on the same host.
+
+WELCOME = {"info": "Welcome to the BitMEX Realtime API.", "version": "fake", "timestamp": "", "docs": "",
+           "limit": {"remaining": 39}}
+
+
+def bitmex_time(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + '.%03dZ' % (int(timestamp * 1000) % 1000)
+
+
+def default_script(symbol='XBTUSD', quotes=10000, start=1577836800):
+    '''Partials for quote, tradeBin1m and order followed by a stream of quote inserts.
+    symbol can be a list, the quotes then rotate over the symbols.'''
+    if not isinstance(symbol, str):
+        script = []
+        for sym in symbol:
+            script += default_script(sym, 0, start)
+        for i in range(quotes):
+            frame = default_script(symbol[i % len(symbol)], 1, start + i * 0.01)[-1]
+            script.append(frame)
+        return script
+    script = [
+        {"table": "quote", "action": "partial", "keys": [], "filter": {"symbol": symbol}, "data": [
+            {"timestamp": bitmex_time(start), "symbol": symbol, "bidSize": 100, "bidPrice": 10000.0,
+             "askPrice": 10000.5, "askSize": 100}]},
+        {"table": "tradeBin1m", "action": "partial", "keys": [], "filter": {"symbol": symbol}, "data": [
+            {"timestamp": bitmex_time(start), "symbol": symbol, "open": 10000.0, "high": 10001.0, "low": 9999.0,
+             "close": 10000.5, "trades": 10, "volume": 1000}]},
+        {"table": "order", "action": "partial", "keys": ["orderID"], "filter": {"symbol": symbol}, "data": []},
+    ]
+    for i in range(quotes):
+        bid = 10000.0 + (i % 20) * 0.5
+        script.append({"table": "quote", "action": "insert", "data": [
+            {"timestamp": bitmex_time(start + i * 0.01), "symbol": symbol, "bidSize": 100 + i, "bidPrice": bid,
+             "askPrice": bid + 0.5, "askSize": 100}]})
+    return script
+
+
+class FakeBitmexServer:
+
+    def __init__(self, script, host='127.0.0.1', port=0, interval=None, stamp=False):
+        self.logger = logging.getLogger(__name__)
+        self.script = script
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.stamp = stamp
+        self.server = None
+        self.connections = 0
+        self.__active = set()
+
+    @property
+    def endpoint(self):
+        return 'http://{}:{}/api/v1'.format(self.host, self.port)
+
+    async def start(self):
+        self.server = await websockets.serve(self.__handler, self.host, self.port, max_size=None)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.logger.info("Fake BitMEX listening on %s" % self.endpoint)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def drop(self):
+        '''Close all client connections, like the exchange does on maintenance.'''
+        for connection in list(self.__active):
+            await connection.close()
+
+    async def __handler(self, connection):
+        self.connections += 1
+        self.__active.add(connection)
+        try:
+            await self.__serve(connection)
+        finally:
+            self.__active.discard(connection)
+
+    async def __serve(self, connection):
+        query = urllib.parse.urlparse(connection.request.path).query
+        subscriptions = urllib.parse.parse_qs(query).get('subscribe', [''])[0].split(',')
+        await connection.send(json.dumps(WELCOME))
+        for subscription in subscriptions:
+            if subscription:
+                await connection.send(json.dumps({"success": True, "subscribe": subscription,
+                                                  "request": {"op": "subscribe", "args": subscription}}))
+        # A callable script gets the number of the connection, e.g. to resume after a drop
+        script = self.script(self.connections) if callable(self.script) else self.script
+        for frame in script:
+            if not isinstance(frame, str):
+                if self.stamp:
+                    frame = dict(frame, sent=time.perf_counter_ns())
+                frame = json.dumps(frame)
+            await connection.send(frame)
+            if self.interval is not None:
+                await asyncio.sleep(self.interval)
+        # Keep the connection open like the exchange until the client leaves
+        await connection.wait_closed()
+
+
+# Serve the default script on a fixed port:
+#   python fake_bitmex_server.py 8765
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    async def main():
+        server = FakeBitmexServer(default_script(), port=int(sys.argv[1]) if len(sys.argv) > 1 else 8765,
+                                  interval=0.01)
+        await server.start()
+        await asyncio.Future()
+
+    asyncio.run(main())
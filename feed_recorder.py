@@ -0,0 +1,207 @@
+import gzip
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import zlib
+from collections import deque
+
+# Raw websocket feed capture and replay.
+#
+# FeedRecorder keeps every raw frame with its receive time (time.time_ns()). record() only
+# appends to a deque, a background thread writes the frames to gzip compressed segments
+# "feed-<start time>.log.gz" and starts a new segment after segmentBytes of raw data or
+# segmentSeconds. Each line of a segment is "<receive time ns> <frame>", BitMEX frames are
+# single line JSON. Segments are only ever appended to and are flushed every drain, a crash
+# loses at most the last flushInterval seconds.
+#
+# FeedReplay reads the segments back and feeds the frames into BitMEXWebsocket.process_message
+# (the same path the websocket callback takes), at recorded pace or as fast as possible.
+#
+# Replay a captured day from the command line, prints frames/s and the latency histograms:
+#   python feed_recorder.py <directory or segment files> [--speed 1.0] [--depth 10] [--binary]
+
+SEGMENT_PREFIX = 'feed-'
+SEGMENT_SUFFIX = '.log.gz'
+
+
+class FeedRecorder:
+
+    def __init__(self, directory, segmentBytes=256 * 1024 * 1024, segmentSeconds=3600, flushInterval=0.5,
+                 compressLevel=6):
+        self.logger = logging.getLogger(__name__)
+        self.directory = directory
+        self.segmentBytes = segmentBytes
+        self.segmentSeconds = segmentSeconds
+        self.flushInterval = flushInterval
+        self.compressLevel = compressLevel
+        os.makedirs(directory, exist_ok=True)
+        self.__frames = deque()
+        self.__file = None
+        self.__segmentStart = 0
+        self.__segmentSize = 0
+        self.__running = True
+
+        # metrics
+        self.recorded = 0
+        self.written = 0
+        self.segments = 0
+
+        self.__thread = threading.Thread(target=self.__run, name='feed-recorder')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def record(self, frame):
+        '''Queue a raw frame. Called on the websocket thread, does no I/O.'''
+        self.__frames.append((time.time_ns(), frame))
+        self.recorded += 1
+
+    def GetStats(self):
+        return {'recorded': self.recorded, 'written': self.written, 'queued': len(self.__frames),
+                'segments': self.segments}
+
+    def Stop(self, timeout=None):
+        '''Write what is still queued and close the segment.'''
+        self.__running = False
+        self.__thread.join(timeout)
+
+    def __run(self):
+        while True:
+            running = self.__running
+            try:
+                self.__drain()
+            except:
+                self.logger.error(traceback.format_exc())
+            if not running:
+                break
+            time.sleep(self.flushInterval)
+        self.__close()
+
+    def __drain(self):
+        frames = self.__frames
+        if not frames:
+            return
+        while frames:
+            received, frame = frames.popleft()
+            if self.__file is None or self.__segmentSize >= self.segmentBytes or \
+                    received - self.__segmentStart >= self.segmentSeconds * 1000000000:
+                self.__rotate(received)
+            if isinstance(frame, bytes):
+                frame = frame.decode('utf-8')
+            line = "{} {}\n".format(received, frame.replace('\n', ' ')).encode('utf-8')
+            self.__file.write(line)
+            self.__segmentSize += len(line)
+            self.written += 1
+        self.__file.flush()
+
+    def __rotate(self, received):
+        self.__close()
+        name = SEGMENT_PREFIX + time.strftime('%Y%m%d-%H%M%S', time.gmtime(received / 1e9)) + \
+            '-{:09d}'.format(received % 1000000000) + SEGMENT_SUFFIX
+        path = os.path.join(self.directory, name)
+        self.__file = gzip.open(path, 'ab', compresslevel=self.compressLevel)
+        self.__segmentStart = received
+        self.__segmentSize = 0
+        self.segments += 1
+        self.logger.info("Recording feed to %s" % path)
+
+    def __close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+def segment_files(paths):
+    '''Segment files of directories and files in recording order.'''
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+        else:
+            files.append(path)
+    return files
+
+
+class FeedReplay:
+
+    def __init__(self, paths):
+        self.logger = logging.getLogger(__name__)
+        self.files = segment_files(paths)
+
+    def frames(self):
+        '''Yield (receive time ns, frame) of all segments.'''
+        for path in self.files:
+            with gzip.open(path, 'rb') as f:
+                try:
+                    for number, line in enumerate(f, 1):
+                        try:
+                            received, frame = line.rstrip(b'\n').split(b' ', 1)
+                            received = int(received)
+                            frame = frame.decode('utf-8')
+                        except ValueError:
+                            # Only this line is lost, e.g. the last one written before a crash
+                            self.logger.warning("Corrupt line %d in segment %s" % (number, path))
+                            continue
+                        yield received, frame
+                except (EOFError, zlib.error):
+                    # The segment of a crashed recorder ends without the gzip trailer
+                    self.logger.warning("Truncated segment %s" % path)
+
+    def replay(self, ws, speed=None):
+        '''Feed all frames into ws.process_message. speed=None replays as fast as possible,
+        otherwise at the recorded pace divided by speed. Returns (frames, seconds).'''
+        count = 0
+        first = None
+        start = time.perf_counter()
+        for received, frame in self.frames():
+            if speed:
+                if first is None:
+                    first = received
+                delay = (received - first) / 1e9 / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            ws.process_message(frame)
+            count += 1
+        return count, time.perf_counter() - start
+
+
+class _NullPipe:
+
+    def Send(self, pstring):
+        pass
+
+    def SendRaw(self, message):
+        pass
+
+
+def main(args):
+    import argparse
+    from bitmex_websocket import BitMEXWebsocket
+    from metrics import Metrics, MeteredPipe
+    from wire_protocol import MessageWriter
+
+    parser = argparse.ArgumentParser(description='Replay a recorded BitMEX feed through the bridge')
+    parser.add_argument('paths', nargs='+', help='segment files or recording directories')
+    parser.add_argument('--speed', type=float, default=None, help='replay at recorded pace times speed')
+    parser.add_argument('--symbols', default='XBTUSD', help='comma separated symbols of the recording')
+    parser.add_argument('--depth', type=int, default=0, help='order book levels, 0 ignores orderBookL2')
+    parser.add_argument('--binary', action='store_true', help='use the binary wire protocol')
+    options = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    metrics = Metrics()
+    writer = MessageWriter(MeteredPipe(_NullPipe(), metrics), options.binary)
+    ws = BitMEXWebsocket(None, '', options.symbols.split(','), depth=options.depth, writer=writer,
+                         connect=False, metrics=metrics)
+    count, elapsed = FeedReplay(options.paths).replay(ws, options.speed)
+    print("%d frames in %.3f s: %.0f frames/s" % (count, elapsed, count / elapsed if elapsed else 0))
+    metrics.dump()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,191 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Low overhead latency histograms and counters for the hot path.
+#
+# Histogram uses HDR style log-linear buckets: values below 2^SUB_BITS get their own bucket,
+# above that every power of two is split into 2^(SUB_BITS-1) buckets. Recording is a couple
+# of integer operations and a list increment, the relative error of a percentile is below
+# 1 / 2^(SUB_BITS-1) (about 3%). Values are nanoseconds unless noted otherwise.
+#
+# Updates are not locked: under the GIL a count can very rarely be lost when two threads
+# record into the same histogram, which is fine for monitoring.
+
+SUB_BITS = 6
+HALF = 1 << (SUB_BITS - 1)
+BUCKETS = (64 - SUB_BITS + 2) * HALF
+MAX_VALUE = (1 << 64) - 1
+
+
+def bucket_index(value):
+    bits = value.bit_length()
+    if bits <= SUB_BITS:
+        return value
+    shift = bits - SUB_BITS
+    return (shift << (SUB_BITS - 1)) + (value >> shift)
+
+
+def bucket_value(index):
+    '''Upper bound of the values in a bucket.'''
+    if index < (1 << SUB_BITS):
+        return index
+    shift = (index >> (SUB_BITS - 1)) - 1
+    return ((index - (shift << (SUB_BITS - 1)) + 1) << shift) - 1
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        elif value > MAX_VALUE:
+            value = MAX_VALUE
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        target = max(1, int(self.count * p / 100.0 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'p999': self.percentile(99.9),
+                'max': self.max}
+
+
+class Metrics:
+    '''Histograms by stage and table, plus named counters.'''
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.__lock = threading.Lock()
+
+    def histogram(self, stage, table=None):
+        key = stage if table is None else stage + ':' + table
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.__lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def record(self, stage, table, value):
+        self.histogram(stage, table).record(value)
+
+    def incr(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def gauge(self, name, function):
+        '''Register a function that is read on every snapshot, like the publisher stats.'''
+        self.gauges[name] = function
+
+    def snapshot(self):
+        with self.__lock:
+            histograms = dict(self.histograms)
+        gauges = {}
+        for name, function in self.gauges.items():
+            try:
+                gauges[name] = function()
+            except Exception as e:
+                gauges[name] = str(e)
+        return {'counters': dict(self.counters),
+                'gauges': gauges,
+                'latency_ns': {key: histogram.summary() for key, histogram in sorted(histograms.items())}}
+
+    def dump(self):
+        '''Log the current statistics.'''
+        snapshot = self.snapshot()
+        self.logger.info("Counters: {}".format(json.dumps(snapshot['counters'], sort_keys=True)))
+        for name, value in snapshot['gauges'].items():
+            self.logger.info("{}: {}".format(name, value))
+        for key, summary in snapshot['latency_ns'].items():
+            self.logger.info("{:<24} n={count} mean={mean:.0f} p50={p50} p99={p99} p999={p999} max={max} ns".format(
+                key, **summary))
+
+
+class MeteredPipe:
+    '''Wraps a pipe and records the time of every write.
+    Text messages are recorded by their message type (the text before the first comma),
+    binary frames as "frame". Everything else is passed to the wrapped pipe.'''
+
+    def __init__(self, pipe, metrics, name='pipe'):
+        self.pipe = pipe
+        self.metrics = metrics
+        self.name = name
+        metrics.gauge(name + '.drops', lambda: getattr(self.pipe, 'drops', 0))
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def Send(self, pstring):
+        start = time.perf_counter_ns()
+        sent = self.pipe.Send(pstring)
+        comma = pstring.find(',')
+        self.__sent(pstring[:comma] if comma > 0 else pstring, start, len(pstring))
+        return sent
+
+    def SendRaw(self, message):
+        start = time.perf_counter_ns()
+        sent = self.pipe.SendRaw(message)
+        self.__sent('frame', start, len(message))
+        return sent
+
+    def __sent(self, kind, start, size):
+        metrics = self.metrics
+        metrics.record('send', kind, time.perf_counter_ns() - start)
+        metrics.incr(self.name + '.messages')
+        metrics.incr(self.name + '.bytes', size)
+
+
+class MetricsServer:
+    '''Serves the metrics as JSON on http://host:port/metrics from a daemon thread.'''
+
+    def __init__(self, metrics, port=8089, host='127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = json.dumps(metrics.snapshot()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('content-type', 'application/json')
+                self.send_header('content-length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
@@ -0,0 +1,117 @@
+from bisect import bisect_left
+
+# L2 order book built from the orderBookL2 table.
+# BitMEX identifies every price level by an id. Updates and deletes only carry the id, side and
+# size, so we keep a map from id to price and the levels themselves in two sorted, array backed
+# price ladders. Deltas are applied in place and report the position of the changed level, so
+# we know in O(1) if the top N levels changed and a new depth message has to go out.
+class PriceLadder:
+
+    def __init__(self, descending=False):
+        # Bids are stored with negated prices so the best level is always at index 0.
+        self.sign = -1.0 if descending else 1.0
+        self.prices = []
+        self.sizes = []
+
+    def __len__(self):
+        return len(self.prices)
+
+    def set(self, price, size):
+        '''Insert or replace a level. Returns the index of the level.'''
+        key = price * self.sign
+        index = bisect_left(self.prices, key)
+        if index < len(self.prices) and self.prices[index] == key:
+            self.sizes[index] = size
+        else:
+            self.prices.insert(index, key)
+            self.sizes.insert(index, size)
+        return index
+
+    def remove(self, price):
+        '''Remove a level. Returns the index it had or -1 if it was not in the ladder.'''
+        key = price * self.sign
+        index = bisect_left(self.prices, key)
+        if index < len(self.prices) and self.prices[index] == key:
+            del self.prices[index]
+            del self.sizes[index]
+            return index
+        return -1
+
+    def clear(self):
+        self.prices = []
+        self.sizes = []
+
+    def top(self, count):
+        return [(price * self.sign, size) for price, size in zip(self.prices[:count], self.sizes[:count])]
+
+
+class OrderBook:
+
+    def __init__(self, symbol, depth=10):
+        self.symbol = symbol
+        self.depth = depth
+        self.bids = PriceLadder(descending=True)
+        self.asks = PriceLadder()
+        self.timestamp = None
+        self.__levels = {}
+
+    def __ladder(self, side):
+        return self.bids if side == 'Buy' else self.asks
+
+    def apply(self, action, rows):
+        '''Apply an orderBookL2 message. Returns True if the top depth levels changed.'''
+        if action == 'partial':
+            self.bids.clear()
+            self.asks.clear()
+            self.__levels = {}
+            for row in rows:
+                self.__insert(row)
+            changed = True
+        elif action == 'insert':
+            changed = False
+            for row in rows:
+                changed = (self.__insert(row) < self.depth) or changed
+        elif action == 'update':
+            changed = False
+            for row in rows:
+                changed = (self.__update(row) < self.depth) or changed
+        elif action == 'delete':
+            changed = False
+            for row in rows:
+                index = self.__delete(row)
+                changed = (index >= 0 and index < self.depth) or changed
+        else:
+            raise Exception("Unknown action: %s" % action)
+
+        if rows and 'timestamp' in rows[-1]:
+            self.timestamp = rows[-1]['timestamp']
+        return changed
+
+    def __insert(self, row):
+        self.__levels[row['id']] = row['price']
+        return self.__ladder(row['side']).set(row['price'], row['size'])
+
+    def __update(self, row):
+        price = self.__levels.get(row['id'])
+        if price is None:
+            return self.depth  # Level not in the book yet. Could happen before partial
+        removed = -1
+        if 'price' in row and row['price'] != price:
+            removed = self.__ladder(row['side']).remove(price)
+            price = row['price']
+            self.__levels[row['id']] = price
+        index = self.__ladder(row['side']).set(price, row['size'])
+        # A level that moves changes the book at the old and at the new position
+        return index if removed < 0 else min(removed, index)
+
+    def __delete(self, row):
+        price = self.__levels.pop(row['id'], None)
+        if price is None:
+            return -1
+        return self.__ladder(row['side']).remove(price)
+
+    def top(self, count=None):
+        '''Return the best levels as ([(bidPrice, bidSize), ...], [(askPrice, askSize), ...]).'''
+        if count is None:
+            count = self.depth
+        return self.bids.top(count), self.asks.top(count)
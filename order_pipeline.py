@@ -0,0 +1,315 @@
+import json
+import logging
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# Order pipeline between the MT5 order pipe and the BitMEX REST API.
+#
+# Commands from MT5 are "<cmd>,<json>" or "<cmd>,<correlation id>,<json>":
+#   order   - list of new orders             -> Order_newBulk
+#   amend   - list of order amendments       -> Order_amendBulk
+#   cancel  - list of orderIDs, or {"orderID": [...]} / {"clOrdID": [...]}  -> Order_cancel
+#
+# Queries are answered right away from the tables of the websocket, without a REST call:
+#   position|margin|execution|orders[,<correlation id>[,<json filter>]]
+# The filter matches row fields, e.g. {"symbol": "XBTUSD"}, "count" limits the result to the
+# latest rows. The answer is an ack with the list of matching rows.
+#
+# Consecutive commands of the same type that arrive within coalesceWindow seconds are merged
+# into one bulk request. Up to maxInFlight requests run at the same time on a thread pool that
+# shares the keep-alive connections of the BitmexClient, but a batch that touches an orderID or
+# clOrdID of a batch still in flight waits for it: an amend or cancel never overtakes the order
+# it refers to, commands go out in the order they came in. If BitMEX rejects a merged request
+# (4xx), its commands are sent again one by one, so one bad order only fails its own command.
+# Requests take a token of the RateLimit, which the history download of the same API key shares,
+# and its budget is corrected from the BitMEX rate-limit headers of every response, so requests
+# are held back when the budget is used up instead of running into 429s.
+#
+# Every command is answered on the order pipe:
+#   ack,<correlation id>,<json results of the command's orders>
+#   err,<correlation id>,<error text>
+#   ratelimit,<remaining>,<limit>,<reset unix time>
+class RateLimit:
+    '''Token bucket over the request budget of one API key. It holds up to limit tokens and
+    refills at limit per minute, so requests can go out in bursts as long as budget is left.
+    The x-ratelimit-* headers correct it to what BitMEX counted.'''
+
+    def __init__(self, limit=60, reserve=2):
+        # Tokens take() leaves for other callers unless told otherwise
+        self.reserve = reserve
+        self.limit = limit
+        self.remaining = None
+        self.reset = None
+        self.blockedUntil = 0.0
+        self.tokens = float(limit)
+        self.__refilled = time.time()
+        self.__lock = threading.Lock()
+
+    def __refill(self, now):
+        self.tokens = min(float(self.limit), self.tokens + (now - self.__refilled) * self.limit / 60.0)
+        self.__refilled = now
+
+    def update(self, headers, status=None):
+        if headers is None:
+            return False
+        with self.__lock:
+            try:
+                if 'x-ratelimit-limit' in headers:
+                    self.limit = int(headers['x-ratelimit-limit'])
+                if 'x-ratelimit-reset' in headers:
+                    self.reset = float(headers['x-ratelimit-reset'])
+                if 'x-ratelimit-remaining' in headers:
+                    self.remaining = int(headers['x-ratelimit-remaining'])
+                    # Requests still in flight already took their token, only ever lower the bucket
+                    self.__refill(time.time())
+                    self.tokens = min(self.tokens, float(self.remaining))
+                if status == 429 and 'retry-after' in headers:
+                    self.blockedUntil = time.time() + float(headers['retry-after'])
+            except (TypeError, ValueError):
+                return False
+        return True
+
+    def take(self, reserve=None):
+        '''Wait until a token is free beyond the reserve and take it.'''
+        reserve = self.reserve if reserve is None else reserve
+        while True:
+            with self.__lock:
+                now = time.time()
+                self.__refill(now)
+                delay = self.blockedUntil - now
+                if delay <= 0:
+                    if self.tokens >= reserve + 1:
+                        self.tokens -= 1
+                        if self.remaining is not None:
+                            self.remaining -= 1
+                        return
+                    delay = (reserve + 1 - self.tokens) * 60.0 / self.limit
+            time.sleep(min(delay, 1.0))
+
+
+class OrderPipeline:
+
+    COMMANDS = ('order', 'amend', 'cancel')
+    QUERIES = ('position', 'margin', 'execution', 'orders')
+
+    def __init__(self, client, pipe_order, maxInFlight=4, maxBulk=50, coalesceWindow=0.002, account=None,
+                 rateLimit=None):
+        '''account answers the queries, usually the BitMEXWebsocket (see BitMEXWebsocket.query).
+        rateLimit is shared with the other users of the API key, e.g. the history download.'''
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.pipe = pipe_order
+        self.account = account
+        self.maxBulk = maxBulk
+        self.coalesceWindow = coalesceWindow
+        self.rateLimit = rateLimit if rateLimit is not None else RateLimit()
+        self.__queue = queue.Queue()
+        self.__pending = None
+        self.__inFlight = threading.Semaphore(maxInFlight)
+        self.__executor = ThreadPoolExecutor(max_workers=maxInFlight)
+        self.__sendLock = threading.Lock()
+        # Order ids of the batches in flight -> number of batches
+        self.__busy = {}
+        self.__busyChanged = threading.Condition()
+        self.__thread = threading.Thread(target=self.__dispatch, name='order-pipeline')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def Submit(self, message):
+        '''Queue a raw command from the order pipe. Returns False if it can't be parsed.'''
+        if message.split(',', 1)[0].strip() in self.QUERIES:
+            return self.__query(message)
+        corrId = ''
+        try:
+            cmd, rest = message.split(',', 1)
+            rest = rest.strip()
+            if rest[:1] not in ('[', '{'):
+                corrId, rest = rest.split(',', 1)
+            data = json.loads(rest)
+        except ValueError:
+            self.__reply("err,{},malformed command: {}".format(corrId, message[:100]))
+            return False
+        if cmd not in self.COMMANDS:
+            self.__reply("err,{},unknown command: {}".format(corrId, cmd))
+            return False
+        if cmd == 'cancel':
+            # Only cancels by the same id field can share a request
+            key = 'orderID'
+            if isinstance(data, dict):
+                if 'clOrdID' in data:
+                    key = 'clOrdID'
+                elif 'orderID' not in data:
+                    self.__reply("err,{},cancel needs orderID or clOrdID".format(corrId))
+                    return False
+                data = data[key]
+            cmd = 'cancel:' + key
+        items = data if isinstance(data, list) else [data]
+        error = self.__invalid(cmd, items)
+        if error:
+            self.__reply("err,{},{}".format(corrId, error))
+            return False
+        self.__queue.put((cmd, corrId, items))
+        return True
+
+    def __invalid(self, cmd, items):
+        '''Reason why the items of a command can't be sent or None.'''
+        if not items:
+            return "no orders in command"
+        if cmd.startswith('cancel:'):
+            if not all(isinstance(item, str) and item for item in items):
+                return "cancel ids must be strings"
+        elif not all(isinstance(item, dict) for item in items):
+            return "orders must be objects"
+        return None
+
+    def __ids(self, cmd, batch):
+        '''Order ids a batch refers to, commands with a shared id must not overtake each other.'''
+        ids = set()
+        for command in batch:
+            for item in command[2]:
+                if cmd.startswith('cancel:'):
+                    ids.add(item)
+                    continue
+                for key in ('orderID', 'clOrdID', 'origClOrdID'):
+                    if isinstance(item.get(key), str) and item[key]:
+                        ids.add(item[key])
+        return ids
+
+    def __query(self, message):
+        query, _, rest = message.partition(',')
+        query = query.strip()
+        rest = rest.strip()
+        # Like commands the correlation id is optional, a filter can follow the query right away
+        corrId = ''
+        if rest[:1] not in ('[', '{'):
+            corrId, _, rest = rest.partition(',')
+            corrId = corrId.strip()
+        try:
+            filter = json.loads(rest) if rest.strip() else {}
+            if not isinstance(filter, dict):
+                raise ValueError("filter must be an object")
+        except ValueError as e:
+            self.__reply("err,{},malformed query: {}".format(corrId, e))
+            return False
+        if self.account is None:
+            self.__reply("err,{},account data not available".format(corrId))
+            return False
+        table = 'order' if query == 'orders' else query
+        try:
+            rows = self.account.query(table, filter)
+        except ValueError as e:
+            self.__reply("err,{},{}".format(corrId, e))
+            return False
+        self.__reply("ack,{},{}".format(corrId, json.dumps(rows, default=str)))
+        return True
+
+    def __reply(self, text):
+        with self.__sendLock:
+            self.pipe.Send(text)
+
+    def __next_command(self, timeout=None):
+        if self.__pending is not None:
+            command, self.__pending = self.__pending, None
+            return command
+        return self.__queue.get(timeout=timeout)
+
+    def __dispatch(self):
+        while True:
+            first = self.__next_command()
+            batch = [first]
+            count = len(first[2])
+            deadline = time.monotonic() + self.coalesceWindow
+            # Collect more commands of the same type for one bulk request
+            while count < self.maxBulk:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    command = self.__next_command(timeout=remaining)
+                except queue.Empty:
+                    break
+                if command[0] != first[0]:
+                    self.__pending = command
+                    break
+                batch.append(command)
+                count += len(command[2])
+            # Dispatch order is kept: wait for the batches in flight with the same ids
+            ids = self.__ids(first[0], batch)
+            with self.__busyChanged:
+                while any(id in self.__busy for id in ids):
+                    self.__busyChanged.wait()
+                for id in ids:
+                    self.__busy[id] = self.__busy.get(id, 0) + 1
+            self.__inFlight.acquire()
+            self.__executor.submit(self.__execute, first[0], batch, ids)
+
+    def __execute(self, cmd, batch, ids=()):
+        try:
+            status = self.__send(cmd, batch)
+            if status is not None and len(batch) > 1 and self.__rejected(status):
+                # A merged request was refused as a whole, find out which command it was for
+                for command in batch:
+                    self.__send(cmd, [command])
+        except:
+            self.logger.error(traceback.format_exc())
+        finally:
+            with self.__busyChanged:
+                for id in ids:
+                    self.__busy[id] -= 1
+                    if not self.__busy[id]:
+                        del self.__busy[id]
+                self.__busyChanged.notify_all()
+            self.__inFlight.release()
+
+    def __rejected(self, status):
+        '''True if BitMEX refused the request without executing any of it.'''
+        return 400 <= status < 500 and status not in (401, 403, 429)
+
+    def __send(self, cmd, batch):
+        '''Send one bulk request for the commands of batch and answer each of them. Returns
+        None on success, otherwise the HTTP status of the error (0 if there is none). Errors of
+        a merged request that BitMEX refused are left to the caller.'''
+        items = [item for command in batch for item in command[2]]
+        self.rateLimit.take()
+        try:
+            results, headers = self.__request(cmd, items)
+        except Exception as e:
+            headers, status = self.__error_response(e)
+            self.rateLimit.update(headers, status)
+            self.__send_ratelimit()
+            status = status or 0
+            if len(batch) > 1 and self.__rejected(status):
+                return status
+            for _, corrId, _ in batch:
+                self.__reply("err,{},{}".format(corrId, str(e).replace('\n', ' ')))
+            return status
+        self.rateLimit.update(headers)
+        self.__send_ratelimit()
+
+        # BitMEX answers in the order of the request, hand every command its part
+        offset = 0
+        for _, corrId, commandItems in batch:
+            part = results[offset:offset + len(commandItems)] if isinstance(results, list) else results
+            offset += len(commandItems)
+            self.__reply("ack,{},{}".format(corrId, json.dumps(part, default=str)))
+        return None
+
+    def __send_ratelimit(self):
+        if self.rateLimit.remaining is not None:
+            self.__reply("ratelimit,{},{},{}".format(self.rateLimit.remaining, self.rateLimit.limit,
+                                                    self.rateLimit.reset))
+
+    def __request(self, cmd, items):
+        '''Send one bulk request. Returns (results, response headers).'''
+        if cmd == 'order':
+            return self.client.Order_newBulk(orders=items)
+        if cmd == 'amend':
+            return self.client.Order_amendBulk(orders=items)
+        key = cmd.split(':', 1)[1]
+        return self.client.Order_cancel(**{key: items})
+
+    def __error_response(self, e):
+        return getattr(e, 'headers', None), getattr(e, 'status_code', None)
@@ -0,0 +1,46 @@
+import time
+
+# Keeps track of what has been sent to MT5 for every order.
+# An order is only sent again when one of the fields of the ordrtbl message changed. Orders
+# that are done (no quantity left or in a terminal state) are sent one last time and then
+# forgotten. A full snapshot of the order table can be requested every snapshotInterval
+# seconds so MT5 can resync.
+class OrderTracker:
+
+    # Fields of the ordrtbl message
+    FIELDS = ('orderID', 'clOrdID', 'clOrdLinkID', 'account', 'symbol', 'side', 'orderQty', 'price', 'ordType',
+              'ordStatus', 'triggered', 'leavesQty', 'text', 'transactTime')
+    TERMINAL_STATUS = ('Filled', 'Canceled', 'Rejected')
+
+    def __init__(self, snapshotInterval=0):
+        self.snapshotInterval = snapshotInterval
+        self.lastSnapshot = time.monotonic()
+        self.__versions = {}
+
+    def __version(self, order):
+        return tuple(order.get(field) for field in self.FIELDS)
+
+    def changed(self, orders):
+        '''Return the orders whose message differs from the last one sent and remember them.'''
+        result = []
+        for order in orders:
+            version = self.__version(order)
+            if self.__versions.get(order['orderID']) != version:
+                self.__versions[order['orderID']] = version
+                result.append(order)
+        return result
+
+    def snapshot(self, orders):
+        '''Remember all orders as sent with a full snapshot.'''
+        self.__versions = {order['orderID']: self.__version(order) for order in orders}
+        self.lastSnapshot = time.monotonic()
+
+    def snapshot_due(self):
+        return self.snapshotInterval > 0 and time.monotonic() - self.lastSnapshot >= self.snapshotInterval
+
+    def is_terminal(self, order):
+        return (order.get('leavesQty') is not None and order['leavesQty'] <= 0) or \
+            order.get('ordStatus') in self.TERMINAL_STATUS
+
+    def forget(self, orderID):
+        self.__versions.pop(orderID, None)
@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+import traceback
+from collections import deque
+
+# Decouples the websocket ingest from the MT5 pipe.
+# The publisher has the same methods as MessageWriter, but only queues the messages. A sender
+# thread drains the queue into the real writer and flushes it once per drain, so a stalled
+# MT5 terminal never blocks the websocket thread.
+#
+# Quotes, depth, forming bars, positions and margins are conflated per symbol (or currency):
+# while they wait in the queue a newer value replaces the older one (latest value wins) and
+# the replaced one is counted as dropped.
+# Candles, closed bars and order messages are kept in order and never dropped.
+# With a metrics.Metrics the time every message waited in the queue is recorded as "queue".
+class Publisher:
+
+    def __init__(self, writer, name='publisher', metrics=None):
+        self.logger = logging.getLogger(__name__)
+        self.writer = writer
+        self.metrics = metrics
+        self.__lossless = deque()
+        self.__conflated = {}
+        self.__cond = threading.Condition()
+        self.__running = True
+
+        # metrics
+        self.sent = 0
+        self.dropped = 0
+        self.maxDepth = 0
+        self.drains = 0
+
+        if metrics is not None:
+            metrics.gauge(name, self.GetStats)
+
+        self.__thread = threading.Thread(target=self.__run, name=name)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __queue(self, method, args):
+        with self.__cond:
+            self.__lossless.append((method, args, time.perf_counter_ns()))
+            self.__notify()
+
+    def __conflate(self, key, method, args):
+        with self.__cond:
+            if key in self.__conflated:
+                self.dropped += 1
+            self.__conflated[key] = (method, args, time.perf_counter_ns())
+            self.__notify()
+
+    def __queue_final(self, key, method, args):
+        '''Queue a message that supersedes the conflated one under key.'''
+        with self.__cond:
+            if self.__conflated.pop(key, None) is not None:
+                self.dropped += 1
+            self.__lossless.append((method, args, time.perf_counter_ns()))
+            self.__notify()
+
+    def __notify(self):
+        depth = len(self.__lossless) + len(self.__conflated)
+        if depth > self.maxDepth:
+            self.maxDepth = depth
+        if depth == 1:
+            self.__cond.notify()
+
+    def QueueDepth(self):
+        with self.__cond:
+            return len(self.__lossless) + len(self.__conflated)
+
+    def GetStats(self):
+        return {'queued': self.QueueDepth(), 'maxQueued': self.maxDepth, 'sent': self.sent,
+                'dropped': self.dropped, 'drains': self.drains}
+
+    def Quote(self, symbol, timestamp, bid, ask):
+        self.__conflate((symbol, 'qt'), 'Quote', (symbol, timestamp, bid, ask))
+
+    def Depth(self, symbol, timestamp, bids, asks):
+        self.__conflate((symbol, 'depth'), 'Depth', (symbol, timestamp, bids, asks))
+
+    def Bar(self, symbol, interval, timestamp, open, high, low, close, volume, closed):
+        # Forming bars are conflated per bar, the closed bar replaces its forming one if still queued
+        key = (symbol, 'bar', interval, timestamp)
+        args = (symbol, interval, timestamp, open, high, low, close, volume, closed)
+        if closed:
+            self.__queue_final(key, 'Bar', args)
+        else:
+            self.__conflate(key, 'Bar', args)
+
+    def Position(self, symbol, *values):
+        self.__conflate((symbol, 'pos'), 'Position', (symbol,) + values)
+
+    def Margin(self, currency, *values):
+        self.__conflate((currency, 'margin'), 'Margin', (currency,) + values)
+
+    def Candle(self, symbol, timestamp, open, high, low, close, volume):
+        self.__queue('Candle', (symbol, timestamp, open, high, low, close, volume))
+
+    def OrdersUpdate(self, count):
+        self.__queue('OrdersUpdate', (count,))
+
+    def Order(self, order):
+        # The table row keeps changing after this call, send it as it is now
+        self.__queue('Order', (dict(order),))
+
+    def Flush(self):
+        '''Messages are flushed by the sender thread.'''
+        pass
+
+    def Stop(self, timeout=None):
+        '''Send what is still queued and stop the sender thread.'''
+        with self.__cond:
+            self.__running = False
+            self.__cond.notify()
+        self.__thread.join(timeout)
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while self.__running and not self.__lossless and not self.__conflated:
+                    self.__cond.wait()
+                if not self.__running and not self.__lossless and not self.__conflated:
+                    return
+                lossless = self.__lossless
+                conflated = self.__conflated
+                self.__lossless = deque()
+                self.__conflated = {}
+            if self.metrics is not None:
+                self.__record_waits(lossless, conflated)
+            try:
+                for method, args, _ in lossless:
+                    getattr(self.writer, method)(*args)
+                for method, args, _ in conflated.values():
+                    getattr(self.writer, method)(*args)
+                self.writer.Flush()
+            except:
+                self.logger.error(traceback.format_exc())
+                time.sleep(0.1)
+            self.sent += len(lossless) + len(conflated)
+            self.drains += 1
+
+    def __record_waits(self, lossless, conflated):
+        now = time.perf_counter_ns()
+        for method, _, queued in lossless:
+            self.metrics.record('queue', method, now - queued)
+        for method, _, queued in conflated.values():
+            self.metrics.record('queue', method, now - queued)
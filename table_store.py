@@ -0,0 +1,112 @@
+from collections import deque
+from itertools import islice
+
+# Keyed store for the websocket tables.
+# BitMEX sends the "keys" of a table on the partial. Rows are kept in a dict indexed by the
+# tuple of those key values, so insert, update and delete are O(1) instead of a scan of the
+# whole table for every row in the message. Dicts keep insertion order, so iterating the
+# table and reading the last row behave like the old list store.
+#
+# Tables without keys (quote, tradeBin1m, ...) can't be updated or deleted by the exchange,
+# their rows are kept in a deque.
+#
+# When maxlen is set the table is a bounded ring: once it is full every insert evicts the
+# oldest row, instead of re-slicing the whole list when it grows past the limit.
+class KeyedTable:
+
+    def __init__(self, keys=None, maxlen=None):
+        self.keys = list(keys) if keys else []
+        self.maxlen = maxlen
+        self.__rows = {} if self.keys else deque(maxlen=maxlen)
+
+    def __len__(self):
+        return len(self.__rows)
+
+    def __iter__(self):
+        '''Iterates the live rows, copy with list() to change the table while iterating.'''
+        if not self.keys:
+            return iter(self.__rows)
+        return iter(self.__rows.values())
+
+    def __bool__(self):
+        return len(self.__rows) > 0
+
+    def __getitem__(self, index):
+        if not self.__rows:
+            raise IndexError('table index out of range')
+        if not self.keys:
+            return self.__rows[index]
+        if index == -1:
+            return next(reversed(self.__rows.values()))
+        if index == 0:
+            return next(iter(self.__rows.values()))
+        if index < 0:
+            index += len(self.__rows)
+        if index < 0 or index >= len(self.__rows):
+            raise IndexError('table index out of range')
+        return next(islice(self.__rows.values(), index, None))
+
+    def append(self, row):
+        '''Insert a row, replacing any row with the same keys.'''
+        if not self.keys:
+            self.__rows.append(row)
+            return
+        key = tuple(row[key] for key in self.keys)
+        if key in self.__rows:
+            del self.__rows[key]
+        self.__rows[key] = row
+        if self.maxlen is not None and len(self.__rows) > self.maxlen:
+            del self.__rows[next(iter(self.__rows))]
+
+    def extend(self, rows):
+        if not self.keys:
+            self.__rows.extend(rows)
+            return
+        for row in rows:
+            self.append(row)
+
+    def __iadd__(self, rows):
+        self.extend(rows)
+        return self
+
+    def find(self, matchData):
+        '''Return the row with the same keys as matchData or None.'''
+        if not self.keys:
+            return None
+        try:
+            return self.__rows.get(tuple(matchData[key] for key in self.keys))
+        except KeyError:
+            return None
+
+    def update(self, updateData):
+        '''Merge updateData into its row. Returns the row or None if it is not in the table.'''
+        item = self.find(updateData)
+        if item is not None:
+            item.update(updateData)
+        return item
+
+    def remove(self, item):
+        '''Delete the row with the same keys as item. Missing rows are ignored.'''
+        if not self.keys:
+            try:
+                self.__rows.remove(item)
+            except ValueError:
+                pass
+            return
+        try:
+            self.__rows.pop(tuple(item[key] for key in self.keys), None)
+        except KeyError:
+            pass
+
+    def remove_where(self, field, value):
+        '''Delete all rows with row[field] == value.'''
+        if not self.keys:
+            rows = [row for row in self.__rows if row.get(field) != value]
+            self.__rows.clear()
+            self.__rows.extend(rows)
+            return
+        for key in [key for key, row in self.__rows.items() if row.get(field) == value]:
+            del self.__rows[key]
+
+    def clear(self):
+        self.__rows.clear()
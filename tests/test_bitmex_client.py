@@ -0,0 +1,125 @@
+# BitmexClient against a local HTTP stand-in of the BitMEX REST API.
+# The server counts the requests it gets and can lose a response (read the request, then close
+# the connection) or close a keep-alive connection after answering, to check when requests
+# are sent again.
+#
+# Run from the repository root:
+#   python -m unittest discover tests
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bitmex_client import BitmexClient, RestError
+
+
+class StandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.requests = []
+        # Requests ("POST /api/v1/order/bulk") whose next response is lost
+        self.lose = set()
+        # Close the connection after the next response, without telling the client
+        self.closeAfter = False
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def __handle(self):
+        length = int(self.headers.get('content-length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        request = '{} {}'.format(self.command, self.path.split('?')[0])
+        self.server.requests.append(request)
+        if request in self.server.lose:
+            self.server.lose.discard(request)
+            self.close_connection = True
+            return
+
+        status, result = 200, body
+        if request == 'GET /api/v1/instrument':
+            result = [{'symbol': 'XBTUSD', 'timestamp': '2020-01-01T00:00:00.000Z'}]
+        elif request == 'POST /api/v1/order/bulk':
+            if any(order.get('orderQty', 0) <= 0 for order in body['orders']):
+                status, result = 400, {'error': {'message': 'Invalid orderQty', 'name': 'ValidationError'}}
+            else:
+                result = [dict(order, orderID='order-%d' % i) for i, order in enumerate(body['orders'])]
+        payload = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(payload)))
+        self.send_header('x-ratelimit-remaining', '59')
+        self.end_headers()
+        self.wfile.write(payload)
+        if self.server.closeAfter:
+            self.server.closeAfter = False
+            self.close_connection = True
+
+    do_GET = do_POST = do_PUT = do_DELETE = __handle
+
+
+class BitmexClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandIn()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        url = 'http://127.0.0.1:{}/api/v1'.format(self.server.server_address[1])
+        self.client = BitmexClient(baseUrl=url, poolSize=1, timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, request):
+        return self.server.requests.count(request)
+
+    def test_result_and_headers(self):
+        result, headers = self.client.Instrument_get(symbol='XBTUSD', count=1)
+        self.assertEqual(result[0]['symbol'], 'XBTUSD')
+        self.assertEqual(headers['x-ratelimit-remaining'], '59')
+
+    def test_error_raises_rest_error(self):
+        with self.assertRaises(RestError) as context:
+            self.client.Order_newBulk(orders=[{'symbol': 'XBTUSD', 'orderQty': 0}])
+        self.assertEqual(context.exception.status_code, 400)
+        self.assertIn('Invalid orderQty', str(context.exception))
+        self.assertEqual(context.exception.headers['x-ratelimit-remaining'], '59')
+
+    def test_lost_post_response_is_not_resent(self):
+        self.server.lose.add('POST /api/v1/order/bulk')
+        with self.assertRaises(ConnectionError):
+            self.client.Order_newBulk(orders=[{'symbol': 'XBTUSD', 'orderQty': 100}])
+        self.assertEqual(self.count('POST /api/v1/order/bulk'), 1)
+
+    def test_lost_get_response_is_resent(self):
+        self.server.lose.add('GET /api/v1/instrument')
+        result, _ = self.client.Instrument_get(symbol='XBTUSD')
+        self.assertEqual(result[0]['symbol'], 'XBTUSD')
+        self.assertEqual(self.count('GET /api/v1/instrument'), 2)
+
+    def test_lost_delete_response_is_resent(self):
+        self.server.lose.add('DELETE /api/v1/order')
+        result, _ = self.client.Order_cancel(orderID=['order-0'])
+        self.assertEqual(result, {'orderID': ['order-0']})
+        self.assertEqual(self.count('DELETE /api/v1/order'), 2)
+
+    def test_stale_keep_alive_connection_is_replaced_before_post(self):
+        self.server.closeAfter = True
+        self.client.Instrument_get(symbol='XBTUSD')
+        # Let the close of the server arrive while the connection is idle in the pool
+        time.sleep(0.2)
+        result, _ = self.client.Order_newBulk(orders=[{'symbol': 'XBTUSD', 'orderQty': 100}])
+        self.assertEqual(result[0]['orderID'], 'order-0')
+        self.assertEqual(self.count('POST /api/v1/order/bulk'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
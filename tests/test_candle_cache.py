@@ -0,0 +1,36 @@
+# missing_ranges: the bins of a requested range that have to be downloaded.
+#
+# Run from the repository root:
+#   python -m unittest discover tests
+import unittest
+from candle_cache import missing_ranges
+
+
+def candles(*timestamps):
+    return [{'timestamp': timestamp} for timestamp in timestamps]
+
+
+class MissingRangesTest(unittest.TestCase):
+
+    def test_empty_cache_misses_everything(self):
+        self.assertEqual(missing_ranges([], 600, 1200), [(600, 1200)])
+
+    def test_complete_cache_misses_nothing(self):
+        self.assertEqual(missing_ranges(candles(*range(600, 1260, 60)), 600, 1200), [])
+
+    def test_head_gap_and_tail(self):
+        self.assertEqual(missing_ranges(candles(780, 840, 1020), 600, 1200),
+                         [(600, 720), (900, 960), (1080, 1200)])
+
+    def test_candles_outside_the_range_are_ignored(self):
+        self.assertEqual(missing_ranges(candles(480, 540, 660, 1260), 600, 780), [(600, 600), (720, 780)])
+
+    def test_empty_range(self):
+        self.assertEqual(missing_ranges(candles(600), 660, 600), [])
+
+    def test_step(self):
+        self.assertEqual(missing_ranges(candles(0, 600), 0, 1800, step=300), [(300, 300), (900, 1800)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+# OrderBook deltas and the top levels they report as changed.
+#
+# Run from the repository root:
+#   python -m unittest discover tests
+import unittest
+from order_book import OrderBook
+
+
+def level(id, side, price, size):
+    return {'id': id, 'side': side, 'price': price, 'size': size}
+
+
+class OrderBookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.book = OrderBook('XBTUSD', depth=2)
+        self.book.apply('partial', [level(1, 'Buy', 100.0, 10), level(2, 'Buy', 99.0, 20), level(3, 'Buy', 98.0, 30),
+                                    level(4, 'Sell', 101.0, 10), level(5, 'Sell', 102.0, 20)])
+
+    def test_update_below_the_top_levels_is_not_a_change(self):
+        self.assertFalse(self.book.apply('update', [{'id': 3, 'side': 'Buy', 'size': 35}]))
+        self.assertTrue(self.book.apply('update', [{'id': 2, 'side': 'Buy', 'size': 25}]))
+        self.assertEqual(self.book.top(), ([(100.0, 10), (99.0, 25)], [(101.0, 10), (102.0, 20)]))
+
+    def test_level_moving_out_of_the_top_levels_is_a_change(self):
+        self.assertTrue(self.book.apply('update', [{'id': 1, 'side': 'Buy', 'price': 97.0, 'size': 10}]))
+        self.assertEqual(self.book.top()[0], [(99.0, 20), (98.0, 30)])
+
+    def test_level_moving_into_the_top_levels_is_a_change(self):
+        self.assertTrue(self.book.apply('update', [{'id': 3, 'side': 'Buy', 'price': 100.5, 'size': 30}]))
+        self.assertEqual(self.book.top()[0], [(100.5, 30), (100.0, 10)])
+
+    def test_level_moving_below_the_top_levels_is_not_a_change(self):
+        self.assertFalse(self.book.apply('update', [{'id': 3, 'side': 'Buy', 'price': 97.0, 'size': 30}]))
+        # The old price is gone from the ladder, an update of the level finds it at the new one
+        self.assertFalse(self.book.apply('update', [{'id': 3, 'side': 'Buy', 'size': 5}]))
+        self.assertEqual(self.book.bids.top(3), [(100.0, 10), (99.0, 20), (97.0, 5)])
+
+    def test_delete(self):
+        self.assertFalse(self.book.apply('delete', [{'id': 3, 'side': 'Buy'}]))
+        self.assertTrue(self.book.apply('delete', [{'id': 4, 'side': 'Sell'}]))
+        self.assertFalse(self.book.apply('delete', [{'id': 4, 'side': 'Sell'}]))
+        self.assertEqual(self.book.top()[1], [(102.0, 20)])
+
+
+if __name__ == '__main__':
+    unittest.main()
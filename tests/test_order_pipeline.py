@@ -0,0 +1,92 @@
+# OrderPipeline against a stand-in BitmexClient that records the bulk requests it gets and
+# a stand-in order pipe that collects the replies.
+#
+# Run from the repository root:
+#   python -m unittest discover tests
+import json
+import threading
+import time
+import unittest
+from bitmex_client import RestError
+from order_pipeline import OrderPipeline
+
+
+class Pipe:
+
+    def __init__(self):
+        self.replies = []
+
+    def Send(self, pstring):
+        self.replies.append(pstring)
+
+
+class Client:
+
+    def __init__(self):
+        self.requests = []
+        # Order_newBulk waits for this until it answers
+        self.release = threading.Event()
+        self.release.set()
+
+    def Order_newBulk(self, orders):
+        self.requests.append(('order', orders))
+        self.release.wait(5)
+        if any(order.get('orderQty', 0) <= 0 for order in orders):
+            raise RestError(400, 'Invalid orderQty')
+        return [dict(order, orderID='order-%s' % order.get('clOrdID')) for order in orders], {}
+
+    def Order_amendBulk(self, orders):
+        self.requests.append(('amend', orders))
+        return orders, {}
+
+    def Order_cancel(self, **ids):
+        self.requests.append(('cancel', ids))
+        return [], {}
+
+
+class OrderPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pipe = Pipe()
+        self.client = Client()
+        self.pipeline = OrderPipeline(self.client, self.pipe, coalesceWindow=0.05)
+
+    def replies(self, count):
+        '''Wait for count replies and return them by correlation id.'''
+        deadline = time.monotonic() + 5
+        while len(self.pipe.replies) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.pipe.replies), count, self.pipe.replies)
+        return {reply.split(',', 2)[1]: reply for reply in self.pipe.replies}
+
+    def test_cancel_without_ids_is_refused(self):
+        self.assertFalse(self.pipeline.Submit('cancel,1,{}'))
+        self.assertFalse(self.pipeline.Submit('cancel,2,[]'))
+        self.assertFalse(self.pipeline.Submit('cancel,3,{"orderID": []}'))
+        replies = self.replies(3)
+        self.assertTrue(all(reply.startswith('err,') for reply in replies.values()))
+        self.assertEqual(self.client.requests, [])
+
+    def test_amend_does_not_overtake_its_order(self):
+        self.client.release.clear()
+        self.pipeline.Submit('order,1,[{"clOrdID": "a", "symbol": "XBTUSD", "orderQty": 100}]')
+        self.pipeline.Submit('amend,2,[{"clOrdID": "a", "price": 9000}]')
+        self.pipeline.Submit('cancel,3,{"clOrdID": ["a"]}')
+        time.sleep(0.2)
+        self.assertEqual([request[0] for request in self.client.requests], ['order'])
+        self.client.release.set()
+        replies = self.replies(3)
+        self.assertEqual([request[0] for request in self.client.requests], ['order', 'amend', 'cancel'])
+        self.assertTrue(all(reply.startswith('ack,') for reply in replies.values()))
+
+    def test_rejected_bulk_is_resent_per_command(self):
+        self.pipeline.Submit('order,1,[{"clOrdID": "a", "symbol": "XBTUSD", "orderQty": 100}]')
+        self.pipeline.Submit('order,2,[{"clOrdID": "b", "symbol": "XBTUSD", "orderQty": 0}]')
+        replies = self.replies(2)
+        self.assertEqual([len(orders) for _, orders in self.client.requests], [2, 1, 1])
+        self.assertEqual(json.loads(replies['1'].split(',', 2)[2])[0]['orderID'], 'order-a')
+        self.assertTrue(replies['2'].startswith('err,2,HTTP 400'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# PipeHub with two PipeHubClients on a Unix domain socket: commands are tagged with the client
+# they came from and the ack/err replies go back only to that client.
+#
+# Run from the repository root:
+#   python -m unittest discover tests
+import os
+import time
+import unittest
+from PipeHub import PipeHub, PipeHubClient
+
+
+class PipeHubTest(unittest.TestCase):
+
+    def setUp(self):
+        name = 'test-pipe-hub-%d' % os.getpid()
+        self.hub = PipeHub(name, True)
+        self.hub.Connect()
+        self.a = PipeHubClient(name)
+        self.a.Connect()
+        self.b = PipeHubClient(name)
+        self.b.Connect()
+        for client in (self.a, self.b):
+            client.sock.settimeout(5)
+        # Let the hub thread register both clients
+        time.sleep(0.2)
+
+    def tearDown(self):
+        self.a.Disconnect()
+        self.b.Disconnect()
+        self.hub.Disconnect()
+
+    def command(self, client, text):
+        client.Send(text)
+        return self.hub.Receive()
+
+    def test_commands_are_tagged_with_their_client(self):
+        a = self.command(self.a, 'order,7,[{"clOrdID": "a"}]')
+        b = self.command(self.b, 'order,[{"clOrdID": "b"}]')
+        tagA = a.split(',', 2)[1].partition(':')[0]
+        tagB = b.split(',', 2)[1].partition(':')[0]
+        self.assertNotEqual(tagA, tagB)
+        self.assertEqual(a, 'order,%s:7,[{"clOrdID": "a"}]' % tagA)
+        self.assertEqual(b, 'order,%s:,[{"clOrdID": "b"}]' % tagB)
+
+    def test_reply_goes_only_to_the_client_of_the_command(self):
+        a = self.command(self.a, 'order,7,[{"clOrdID": "a"}]')
+        b = self.command(self.b, 'position,{"symbol": "XBTUSD"}')
+        self.hub.Send('ack,%s,[]' % a.split(',', 2)[1])
+        self.hub.Send('err,%s,not subscribed: position' % b.split(',', 2)[1])
+        # A reply to a client that is gone is dropped
+        self.hub.Send('ack,h999:1,[]')
+        self.hub.Send('qt,XBTUSD,1,10.0,10.5')
+        self.assertEqual(self.a.Receive(), 'ack,7,[]')
+        self.assertEqual(self.a.Receive(), 'qt,XBTUSD,1,10.0,10.5')
+        self.assertEqual(self.b.Receive(), 'err,,not subscribed: position')
+        self.assertEqual(self.b.Receive(), 'qt,XBTUSD,1,10.0,10.5')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,302 @@
+import calendar
+import math
+import struct
+import uuid
+
+# Messages sent from the bridge to MT5.
+#
+# Text mode (compatibility) sends every message as its own pipe message:
+#   qt,symbol,time,bid,ask
+#   cndl,symbol,time,open,high,low,close,volume
+#   ordersupdt,count
+#   ordrtbl,orderID,clOrdID,clOrdLinkID,account,symbol,side,orderQty,price,ordType,ordStatus,triggered,leavesQty,text,transactTime
+#   depth,symbol,time,nbids,nasks,bidPrice,bidSize,...,askPrice,askSize,...
+#   bar,symbol,interval,time,open,high,low,close,volume,closed
+#   pos,symbol,currentQty,avgEntryPrice,markPrice,liquidationPrice,unrealisedPnl,realisedPnl,leverage
+#   margin,currency,walletBalance,marginBalance,availableMargin,maintMargin,unrealisedPnl,realisedPnl
+#
+# bar messages carry the locally aggregated bars of interval seconds, time is the open time.
+# closed is 0 while the bar is forming and 1 once it is final, a closed bar can be sent again
+# with corrected values after it was reconciled with the exchange bin. pos and margin are
+# sent whenever one of their values changes, margin amounts are in satoshis like on BitMEX.
+# Binary mode packs many fixed width records into one frame and sends the frame as a single
+# pipe message. All numbers are little endian, strings are utf-8 padded with zeros.
+#   frame header: magic 'BX', version (uint8), flags (uint8), record count (uint16), payload length (uint32)
+#   records:      record type (uint8) followed by the fixed layout of that type
+# Times are unix seconds, transactTime is unix milliseconds. Missing prices are NaN.
+# Order records pack the orderID (a UUID) as its 16 raw bytes and end with the lengths (uint8) of
+# the ORDER_STRINGS followed by those strings without padding, so their size varies (record_size).
+
+MAGIC = b'BX'
+VERSION = 2
+
+REC_QUOTE = 1
+REC_CANDLE = 2
+REC_ORDERS_UPDATE = 3
+REC_ORDER = 4
+REC_DEPTH = 5
+REC_BAR = 6
+REC_POSITION = 7
+REC_MARGIN = 8
+
+DEPTH_LEVELS = 20
+
+# Stay below the 64k buffers of the named pipe
+MAX_FRAME_SIZE = 60000
+
+FRAME_HEADER = struct.Struct('<2sBBHI')
+RECORDS = {
+    REC_QUOTE: struct.Struct('<B12sqdd'),
+    REC_CANDLE: struct.Struct('<B12sqddddd'),
+    REC_ORDERS_UPDATE: struct.Struct('<BI'),
+    REC_ORDER: struct.Struct('<B16sq12sBdddqBBBBBB'),
+    REC_DEPTH: struct.Struct('<B12sqBB%dd' % (DEPTH_LEVELS * 4)),
+    REC_BAR: struct.Struct('<B12sIqdddddB'),
+    REC_POSITION: struct.Struct('<B12sddddddd'),
+    REC_MARGIN: struct.Struct('<B12sdddddd'),
+}
+
+# Row fields of the pos and margin messages, in message order
+POSITION_FIELDS = ('symbol', 'currentQty', 'avgEntryPrice', 'markPrice', 'liquidationPrice', 'unrealisedPnl',
+                   'realisedPnl', 'leverage')
+MARGIN_FIELDS = ('currency', 'walletBalance', 'marginBalance', 'availableMargin', 'maintMargin', 'unrealisedPnl',
+                 'realisedPnl')
+
+# Variable length strings at the end of order records, in record order
+ORDER_STRINGS = ('clOrdID', 'clOrdLinkID', 'ordType', 'ordStatus', 'triggered', 'text')
+
+SIDES = {'Buy': 1, 'Sell': 2}
+SIDE_NAMES = {1: 'Buy', 2: 'Sell'}
+
+
+def format_order(order):
+    return "ordrtbl,{},{},{},{},{},{},{},{},{},{},{},{},{},{}".format(order['orderID'],
+                                                                      order['clOrdID'],
+                                                                      order['clOrdLinkID'],
+                                                                      order['account'],
+                                                                      order['symbol'],
+                                                                      order['side'],
+                                                                      order['orderQty'],
+                                                                      order['price'],
+                                                                      order['ordType'],
+                                                                      order['ordStatus'],
+                                                                      order['triggered'],
+                                                                      order['leavesQty'],
+                                                                      order['text'],
+                                                                      order['transactTime'])
+
+
+def _uuid(value):
+    '''orderIDs are UUIDs, anything else (or no ID) is sent as zeros.'''
+    try:
+        return uuid.UUID(value).bytes
+    except (TypeError, ValueError, AttributeError):
+        return bytes(16)
+
+
+def _text(value, size):
+    if value is None:
+        return b''
+    return str(value).encode('utf-8')[:size]
+
+
+def _number(value):
+    return float('nan') if value is None else float(value)
+
+
+def _millis(timestamp):
+    '''transactTime comes as ISO 8601 string (2020-01-01T00:00:00.000Z) from the websocket.
+    The layout is fixed, slicing it is a lot cheaper than strptime.'''
+    if not timestamp:
+        return 0
+    if not isinstance(timestamp, str):
+        return int(timestamp.timestamp() * 1000)
+    seconds = calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                               int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19])))
+    fraction = timestamp[20:23] if len(timestamp) > 20 and timestamp[19] == '.' else '0'
+    return seconds * 1000 + int(fraction)
+
+
+class MessageWriter:
+    '''Encodes bridge messages for a pipe. In binary mode records are collected until Flush
+    and written with one SendRaw per frame.'''
+
+    def __init__(self, pipe, binary=False):
+        self.pipe = pipe
+        self.binary = binary
+        self.__buffer = bytearray()
+        self.__count = 0
+
+    def __add(self, record):
+        if len(self.__buffer) + len(record) > MAX_FRAME_SIZE - FRAME_HEADER.size or self.__count == 0xFFFF:
+            self.Flush()
+        self.__buffer += record
+        self.__count += 1
+
+    def Flush(self):
+        if not self.__count:
+            return
+        header = FRAME_HEADER.pack(MAGIC, VERSION, 0, self.__count, len(self.__buffer))
+        frame = header + self.__buffer
+        self.__buffer = bytearray()
+        self.__count = 0
+        self.pipe.SendRaw(frame)
+
+    def Quote(self, symbol, timestamp, bid, ask):
+        if not self.binary:
+            self.pipe.Send("qt,{},{},{},{}".format(symbol,timestamp,bid,ask))
+            return
+        self.__add(RECORDS[REC_QUOTE].pack(REC_QUOTE, _text(symbol, 12), timestamp, bid, ask))
+
+    def Candle(self, symbol, timestamp, open, high, low, close, volume):
+        if not self.binary:
+            self.pipe.Send("cndl,{},{},{},{},{},{},{}".format(symbol,timestamp,open,high,low,close,volume))
+            return
+        self.__add(RECORDS[REC_CANDLE].pack(REC_CANDLE, _text(symbol, 12), timestamp,
+                                            _number(open), _number(high), _number(low), _number(close),
+                                            _number(volume)))
+
+    def OrdersUpdate(self, count):
+        if not self.binary:
+            self.pipe.Send("ordersupdt,{}".format(count))
+            return
+        self.__add(RECORDS[REC_ORDERS_UPDATE].pack(REC_ORDERS_UPDATE, count))
+
+    def Order(self, order):
+        if not self.binary:
+            self.pipe.Send(format_order(order))
+            return
+        strings = [_text(order[field], 255) for field in ORDER_STRINGS]
+        self.__add(RECORDS[REC_ORDER].pack(REC_ORDER,
+                                           _uuid(order['orderID']),
+                                           int(order['account'] or 0),
+                                           _text(order['symbol'], 12),
+                                           SIDES.get(order['side'], 0),
+                                           _number(order['orderQty']),
+                                           _number(order['price']),
+                                           _number(order['leavesQty']),
+                                           _millis(order['transactTime']),
+                                           *map(len, strings)) + b''.join(strings))
+
+    def Depth(self, symbol, timestamp, bids, asks):
+        if not self.binary:
+            levels = ','.join('{},{}'.format(price, size) for price, size in bids + asks)
+            self.pipe.Send("depth,{},{},{},{},{}".format(symbol,timestamp,len(bids),len(asks),levels))
+            return
+        bids = bids[:DEPTH_LEVELS]
+        asks = asks[:DEPTH_LEVELS]
+        levels = [0.0] * (DEPTH_LEVELS * 4)
+        for i, (price, size) in enumerate(bids):
+            levels[2 * i] = price
+            levels[2 * i + 1] = size
+        offset = DEPTH_LEVELS * 2
+        for i, (price, size) in enumerate(asks):
+            levels[offset + 2 * i] = price
+            levels[offset + 2 * i + 1] = size
+        self.__add(RECORDS[REC_DEPTH].pack(REC_DEPTH, _text(symbol, 12), timestamp, len(bids), len(asks), *levels))
+
+    def Bar(self, symbol, interval, timestamp, open, high, low, close, volume, closed):
+        if not self.binary:
+            self.pipe.Send("bar,{},{},{},{},{},{},{},{},{}".format(symbol,interval,timestamp,open,high,low,close,volume,
+                                                                  1 if closed else 0))
+            return
+        self.__add(RECORDS[REC_BAR].pack(REC_BAR, _text(symbol, 12), interval, timestamp,
+                                         _number(open), _number(high), _number(low), _number(close),
+                                         _number(volume), 1 if closed else 0))
+
+    def Position(self, symbol, currentQty, avgEntryPrice, markPrice, liquidationPrice, unrealisedPnl, realisedPnl,
+                 leverage):
+        if not self.binary:
+            self.pipe.Send("pos,{},{},{},{},{},{},{},{}".format(symbol,currentQty,avgEntryPrice,markPrice,liquidationPrice,
+                                                             unrealisedPnl,realisedPnl,leverage))
+            return
+        self.__add(RECORDS[REC_POSITION].pack(REC_POSITION, _text(symbol, 12), _number(currentQty),
+                                              _number(avgEntryPrice), _number(markPrice), _number(liquidationPrice),
+                                              _number(unrealisedPnl), _number(realisedPnl), _number(leverage)))
+
+    def Margin(self, currency, walletBalance, marginBalance, availableMargin, maintMargin, unrealisedPnl, realisedPnl):
+        if not self.binary:
+            self.pipe.Send("margin,{},{},{},{},{},{},{}".format(currency,walletBalance,marginBalance,availableMargin,
+                                                             maintMargin,unrealisedPnl,realisedPnl))
+            return
+        self.__add(RECORDS[REC_MARGIN].pack(REC_MARGIN, _text(currency, 12), _number(walletBalance),
+                                            _number(marginBalance), _number(availableMargin), _number(maintMargin),
+                                            _number(unrealisedPnl), _number(realisedPnl)))
+
+
+# Reference decoder for the binary format.
+def _string(value):
+    return value.rstrip(b'\x00').decode('utf-8')
+
+
+def record_size(frame, offset):
+    '''Size of the record starting at offset, including the strings at the end of order records.'''
+    recordType = frame[offset]
+    size = RECORDS[recordType].size
+    if recordType == REC_ORDER:
+        size += sum(frame[offset + size - len(ORDER_STRINGS):offset + size])
+    return size
+
+
+def decode_record(recordType, fields, tail=b''):
+    '''tail holds the bytes after the fixed layout, the strings of order records.'''
+    if recordType == REC_QUOTE:
+        _, symbol, timestamp, bid, ask = fields
+        return {'type': 'qt', 'symbol': _string(symbol), 'timestamp': timestamp, 'bid': bid, 'ask': ask}
+    if recordType == REC_CANDLE:
+        _, symbol, timestamp, open, high, low, close, volume = fields
+        return {'type': 'cndl', 'symbol': _string(symbol), 'timestamp': timestamp, 'open': open,
+                'high': high, 'low': low, 'close': close, 'volume': volume}
+    if recordType == REC_ORDERS_UPDATE:
+        return {'type': 'ordersupdt', 'count': fields[1]}
+    if recordType == REC_ORDER:
+        _, orderID, account, symbol, side, orderQty, price, leavesQty, transactTime = fields[:9]
+        record = {'type': 'ordrtbl', 'orderID': str(uuid.UUID(bytes=orderID)) if any(orderID) else '',
+                  'account': account, 'symbol': _string(symbol), 'side': SIDE_NAMES.get(side, ''),
+                  'orderQty': orderQty, 'price': None if math.isnan(price) else price, 'leavesQty': leavesQty,
+                  'transactTime': transactTime}
+        start = 0
+        for field, length in zip(ORDER_STRINGS, fields[9:]):
+            # Strings cut at 255 bytes may end inside a character
+            record[field] = bytes(tail[start:start + length]).decode('utf-8', 'ignore')
+            start += length
+        return record
+    if recordType == REC_DEPTH:
+        symbol, timestamp, nbids, nasks = fields[1:5]
+        levels = fields[5:]
+        offset = DEPTH_LEVELS * 2
+        bids = [(levels[2 * i], levels[2 * i + 1]) for i in range(nbids)]
+        asks = [(levels[offset + 2 * i], levels[offset + 2 * i + 1]) for i in range(nasks)]
+        return {'type': 'depth', 'symbol': _string(symbol), 'timestamp': timestamp, 'bids': bids, 'asks': asks}
+    if recordType == REC_BAR:
+        _, symbol, interval, timestamp, open, high, low, close, volume, closed = fields
+        return {'type': 'bar', 'symbol': _string(symbol), 'interval': interval, 'timestamp': timestamp,
+                'open': open, 'high': high, 'low': low, 'close': close, 'volume': volume, 'closed': bool(closed)}
+    if recordType == REC_POSITION:
+        record = dict(zip(POSITION_FIELDS[1:], (None if math.isnan(value) else value for value in fields[2:])))
+        record.update(type='pos', symbol=_string(fields[1]))
+        return record
+    if recordType == REC_MARGIN:
+        record = dict(zip(MARGIN_FIELDS[1:], (None if math.isnan(value) else value for value in fields[2:])))
+        record.update(type='margin', currency=_string(fields[1]))
+        return record
+    raise Exception("Unknown record type: %s" % recordType)
+
+
+def decode_frame(frame):
+    '''Decode one binary frame into a list of record dicts.'''
+    magic, version, flags, count, length = FRAME_HEADER.unpack_from(frame, 0)
+    if magic != MAGIC:
+        raise Exception("Not a binary frame")
+    if version != VERSION:
+        raise Exception("Unsupported protocol version: %s" % version)
+    records = []
+    offset = FRAME_HEADER.size
+    for _ in range(count):
+        recordType = frame[offset]
+        record = RECORDS[recordType]
+        size = record_size(frame, offset)
+        records.append(decode_record(recordType, record.unpack_from(frame, offset),
+                                     frame[offset + record.size:offset + size]))
+        offset += size
+    return records